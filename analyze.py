@@ -0,0 +1,513 @@
+#!/usr/bin/env python3
+
+# Static analysis of assembled images, without running them:
+# a control-flow graph of basic blocks, loops, code which is never reached,
+# and register and flag liveness.
+#
+#   analyze.py program.bin [--debug-info program.dbg]
+#
+# Register jumps ('jmp r1') can go anywhere, so their targets are guessed:
+# immediates which are stored (like the return addresses pushed by
+# 'st retaddr') or moved into a register which is then jumped through,
+# and which point at a valid instruction, are treated as possible targets.
+
+import assembler as asm
+import emulator
+import sys
+
+FLAGS = ("c", "s", "z", "o")
+
+# The flags read by each jump condition
+COND_FLAGS = {
+    asm.JC_ALWAYS: (),
+    asm.JC_JEQ: ("z",),
+    asm.JC_JGT: ("c", "z"),
+    asm.JC_JGE: ("c",),
+    asm.JC_JGTS: ("z", "o", "s"),
+    asm.JC_JGES: ("o", "s"),
+}
+
+# Everything the analysis needs to know about one instruction.
+# Registers are 0-7 and flags are "c", "s", "z" and "o".
+# * uses: Registers and flags read to compute the result
+# * flag_uses: Registers only read to compute the flags
+# * defs: The register written, if any
+class Instr:
+    def __init__(self, addr, hi, lo):
+        self.addr = addr
+        self.op = (hi & 0b11111000) >> 3
+        self.rc = (hi & 0b00000111)
+        self.imm = lo
+        self.text = emulator.disassemble(hi, lo)
+
+        isel = (lo & 0b10000000) >> 7
+        ra =   (lo & 0b01110000) >> 4
+        rb =   (lo & 0b00001111)
+        srcs = {ra} if isel else {ra, rb % 8}
+
+        op = self.op
+        self.uses = set()
+        self.flag_uses = set()
+        self.defs = None
+        if op >= asm.INS_IMM_START and op <= asm.INS_IMM_END:
+            if op == asm.INS_JMPI:
+                self.uses.update(COND_FLAGS[self.rc])
+            elif op == asm.INS_IMM:
+                self.defs = self.rc
+            else:
+                self.uses.add(7)
+        elif op in asm.ALU_WRITE_OPS or op == asm.INS_CMP or op == asm.INS_CMPC:
+            self.uses.update(srcs)
+            if op in asm.CARRY_OPS:
+                self.uses.add("c")
+            if op in asm.ALU_WRITE_OPS:
+                self.defs = self.rc
+        elif op == asm.INS_JMP:
+            self.uses.update(srcs)
+            self.uses.update(COND_FLAGS[self.rc])
+        elif op == asm.INS_ST:
+            self.uses.update(srcs)
+            self.uses.add(7)
+        else:
+            # NOP, LD, RAND and HALT have an output of 0,
+            # but A and B still go into the overflow flag
+            self.flag_uses.update(srcs)
+            if op == asm.INS_LD:
+                self.uses.add(7)
+            if op == asm.INS_LD or op == asm.INS_RAND:
+                self.defs = self.rc
+
+    def is_jump(self):
+        return self.op == asm.INS_JMP or self.op == asm.INS_JMPI
+
+    def falls_through(self):
+        if self.is_jump():
+            return self.rc != asm.JC_ALWAYS
+        return self.op != asm.INS_HALT
+
+    def live_before(self, live):
+        out = set(live)
+        if self.defs is not None:
+            out.discard(self.defs)
+        out.difference_update(FLAGS)
+        out.update(self.uses)
+        if "o" in live:
+            out.update(self.flag_uses)
+        return out
+
+class Block:
+    def __init__(self, start):
+        self.start = start
+        self.instrs = []
+        self.succs = []
+        self.preds = []
+
+        # Ends with a register jump, so the successors are unknown
+        self.indirect = False
+
+        # Runs into something which isn't a valid instruction
+        self.falls_off = False
+
+        self.live_in = set()
+        self.live_out = set()
+
+    def end(self):
+        return self.instrs[-1].addr
+
+class Loop:
+    def __init__(self, header, body, latches):
+        self.header = header
+        self.body = body
+        self.latches = latches
+
+        # Cycles for one iteration, along the shortest and longest
+        # path from the header back to the header
+        self.min_cycles = None
+        self.max_cycles = None
+
+class Analysis:
+    # 'cost' maps an Instr, and whether it's a jump which is taken,
+    # to its cycle count; by default every instruction takes one cycle,
+    # like in the emulator
+    def __init__(self, bs, entries=(0,), cost=None):
+        self.bs = bytes(bs)
+        self.cost = cost if cost is not None else (lambda instr, taken: 1)
+        self.entries = list(entries)
+        self.indirect_entries = []
+
+        self.instrs = {}
+        self.find_code()
+        self.blocks = {}
+        self.build_blocks()
+        self.compute_liveness()
+        self.doms = self.dominators()
+        self.loops = self.find_loops()
+
+    def decode(self, addr):
+        if addr in self.instrs:
+            return self.instrs[addr]
+        if addr + 1 >= len(self.bs):
+            return None
+        try:
+            instr = Instr(addr, self.bs[addr], self.bs[addr + 1])
+        except Exception:
+            return None
+        self.instrs[addr] = instr
+        return instr
+
+    # Follow control flow from the entry points, like emulator.trace_code.
+    # If a reachable register jump exists, immediates which point at code
+    # become entry points too.
+    def find_code(self):
+        self.targets = set()
+        seen = set()
+        work = list(self.entries)
+        while True:
+            while len(work) > 0:
+                addr = work.pop()
+                if addr in seen:
+                    continue
+                seen.add(addr)
+                instr = self.decode(addr)
+                if instr is None:
+                    continue
+                if instr.op == asm.INS_JMPI:
+                    self.targets.add(instr.imm)
+                    work.append(instr.imm)
+                if instr.falls_through():
+                    work.append(addr + 2)
+
+            self.code = [addr for addr in sorted(seen) if addr in self.instrs]
+            if not any(self.instrs[addr].op == asm.INS_JMP for addr in self.code):
+                return
+
+            for addr in self.code:
+                instr = self.instrs[addr]
+                if instr.op != asm.INS_STI and not self.jumps_through(instr):
+                    continue
+                if instr.imm in seen or self.decode(instr.imm) is None:
+                    continue
+                self.indirect_entries.append(instr.imm)
+                work.append(instr.imm)
+            if len(work) == 0:
+                return
+
+    # Whether 'instr' is a mov immediate into a register which a later
+    # register jump in the same straight line of code jumps through
+    def jumps_through(self, instr):
+        if instr.op != asm.INS_IMM:
+            return False
+        addr = instr.addr + 2
+        while addr in self.instrs:
+            nxt = self.instrs[addr]
+            if nxt.op == asm.INS_JMP and instr.rc in nxt.uses:
+                return True
+            if nxt.defs == instr.rc or nxt.is_jump() or not nxt.falls_through():
+                return False
+            addr += 2
+        return False
+
+    def build_blocks(self):
+        code = set(self.code)
+        leaders = set(self.entries) | set(self.indirect_entries) | self.targets
+        for addr in self.code:
+            if self.instrs[addr].is_jump() or not self.instrs[addr].falls_through():
+                leaders.add(addr + 2)
+        leaders &= code
+
+        for start in sorted(leaders):
+            block = Block(start)
+            addr = start
+            while True:
+                instr = self.instrs[addr]
+                block.instrs.append(instr)
+                if instr.op == asm.INS_JMPI:
+                    if instr.imm in code:
+                        block.succs.append(instr.imm)
+                    else:
+                        block.falls_off = True
+                elif instr.op == asm.INS_JMP:
+                    block.indirect = True
+                if not instr.falls_through():
+                    break
+                addr += 2
+                if addr not in code:
+                    block.falls_off = True
+                    break
+                if instr.is_jump() or addr in leaders:
+                    block.succs.append(addr)
+                    break
+            self.blocks[start] = block
+
+        for block in self.blocks.values():
+            for succ in block.succs:
+                self.blocks[succ].preds.append(block.start)
+
+    # Backwards liveness over the blocks. Anything might be used after a
+    # register jump, and nothing is used after a halt.
+    def compute_liveness(self):
+        everything = set(range(0, 8)) | set(FLAGS)
+        changed = True
+        while changed:
+            changed = False
+            for start in sorted(self.blocks, reverse=True):
+                block = self.blocks[start]
+                live = set()
+                if block.indirect or block.falls_off:
+                    live = set(everything)
+                for succ in block.succs:
+                    live |= self.blocks[succ].live_in
+                block.live_out = live
+                for instr in reversed(block.instrs):
+                    live = instr.live_before(live)
+                if live != block.live_in:
+                    block.live_in = live
+                    changed = True
+
+    # Returns (instr, live after instr) for every instruction in a block
+    def instr_liveness(self, block):
+        out = []
+        live = block.live_out
+        for instr in reversed(block.instrs):
+            out.append((instr, live))
+            live = instr.live_before(live)
+        out.reverse()
+        return out
+
+    def dominators(self):
+        roots = [addr for addr in self.entries + self.indirect_entries if addr in self.blocks]
+        order = []
+        seen = set()
+        for root in roots:
+            stack = [(root, iter(self.blocks[root].succs))]
+            seen.add(root)
+            while stack:
+                node, it = stack[-1]
+                nxt = next(it, None)
+                if nxt is None:
+                    order.append(node)
+                    stack.pop()
+                elif nxt not in seen:
+                    seen.add(nxt)
+                    stack.append((nxt, iter(self.blocks[nxt].succs)))
+        order.reverse()
+
+        doms = {node: set(seen) for node in seen}
+        for root in roots:
+            doms[root] = {root}
+        changed = True
+        while changed:
+            changed = False
+            for node in order:
+                if node in roots:
+                    continue
+                preds = [p for p in self.blocks[node].preds if p in doms]
+                new = set.intersection(*(doms[p] for p in preds)) if preds else set()
+                new = new | {node}
+                if new != doms[node]:
+                    doms[node] = new
+                    changed = True
+        return doms
+
+    def find_loops(self):
+        loops = {}
+        for block in self.blocks.values():
+            for succ in block.succs:
+                if block.start in self.doms and succ in self.doms[block.start]:
+                    body = loops[succ].body if succ in loops else {succ}
+                    work = [block.start]
+                    while work:
+                        node = work.pop()
+                        if node not in body:
+                            body.add(node)
+                            work.extend(self.blocks[node].preds)
+                    if succ not in loops:
+                        loops[succ] = Loop(succ, body, [])
+                    loops[succ].latches.append(block.start)
+
+        for loop in loops.values():
+            loop.min_cycles, loop.max_cycles = self.loop_cycles(loop, loops)
+        return sorted(loops.values(), key=lambda loop: loop.header)
+
+    # Path lengths from the header back to itself. Inner loops are counted
+    # as a single pass, since their back edges are skipped.
+    def loop_cycles(self, loop, loops):
+        memo = {}
+        def paths(node):
+            if node in memo:
+                return memo[node]
+            memo[node] = None
+            block = self.blocks[node]
+            last = block.instrs[-1]
+            cost = sum(self.cost(instr, False) for instr in block.instrs[:-1])
+            best = None
+            for i, succ in enumerate(block.succs):
+                if succ == loop.header:
+                    sub = (0, 0)
+                elif succ not in loop.body or (succ in loops and node in loops[succ].latches):
+                    continue
+                else:
+                    sub = paths(succ)
+                if sub is None:
+                    continue
+
+                # The last instruction's cost depends on the edge: a jump's
+                # target comes first in succs, the fall through after it
+                taken = last.op == asm.INS_JMPI and i == 0 and succ == last.imm
+                edge = cost + self.cost(last, taken)
+                sub = (sub[0] + edge, sub[1] + edge)
+                if best is None:
+                    best = sub
+                else:
+                    best = (min(best[0], sub[0]), max(best[1], sub[1]))
+            memo[node] = best
+            return best
+
+        res = paths(loop.header)
+        return res if res is not None else (None, None)
+
+    # Byte ranges which no reachable instruction covers, as (start, end) pairs
+    def unreachable(self):
+        covered = [False] * len(self.bs)
+        for addr in self.code:
+            covered[addr] = True
+            covered[addr + 1] = True
+
+        ranges = []
+        start = None
+        for addr, cov in enumerate(covered + [True]):
+            if not cov and start is None:
+                start = addr
+            elif cov and start is not None:
+                ranges.append((start, addr - 1))
+                start = None
+        return ranges
+
+    # Instructions whose only effects are a register write or flags
+    # which are never read. LD and RAND aren't included, since a load can
+    # have side effects on a device and RAND advances the generator.
+    def dead_code(self):
+        dead = []
+        for start in sorted(self.blocks):
+            for instr, live in self.instr_liveness(self.blocks[start]):
+                flags_live = any(flag in live for flag in FLAGS)
+                if instr.op in (asm.INS_CMP, asm.INS_CMPC) and not flags_live:
+                    dead.append((instr, "flags are never read"))
+                elif instr.defs is not None and instr.defs not in live and not flags_live and \
+                        instr.op != asm.INS_LD and instr.op != asm.INS_RAND:
+                    dead.append((instr, f"r{instr.defs} is never read"))
+        return dead
+
+    # How many instructions have flags which are read afterwards
+    def flag_usage(self):
+        read = 0
+        total = 0
+        for block in self.blocks.values():
+            for instr, live in self.instr_liveness(block):
+                total += 1
+                if any(flag in live for flag in FLAGS):
+                    read += 1
+        return read, total
+
+    def describe(self, addr, debug):
+        if debug is not None and addr < len(debug["addrs"]):
+            linenum, label = debug["addrs"][addr]
+            return f"{addr}: line {linenum}: " + debug["lines"][linenum - 1].strip()
+        instr = self.instrs.get(addr)
+        return f"{addr}: " + (instr.text if instr is not None else "???")
+
+    def name(self, addr, debug):
+        if debug is not None:
+            for name, labeladdr in debug["labels"].items():
+                if labeladdr == addr:
+                    return f"{name} ({addr})"
+        return str(addr)
+
+    def report(self, f=sys.stdout, debug=None):
+        def regs(live):
+            names = [f"r{r}" for r in sorted(r for r in live if r not in FLAGS)]
+            names += [flag for flag in FLAGS if flag in live]
+            return " ".join(names) if names else "-"
+
+        f.write(f"Analysis: {len(self.code)} instructions in {len(self.blocks)} blocks\n")
+        if self.indirect_entries:
+            f.write("Possible register jump targets: " +
+                    ", ".join(self.name(addr, debug) for addr in sorted(self.indirect_entries)) + "\n")
+
+        f.write("\nBlocks:\n")
+        for start in sorted(self.blocks):
+            block = self.blocks[start]
+            succs = [self.name(succ, debug) for succ in block.succs]
+            if block.indirect:
+                succs.append("(register jump)")
+            if block.falls_off:
+                succs.append("(invalid code)")
+            if not succs:
+                succs.append("(halt)")
+            f.write(f"  {self.name(start, debug)}-{block.end()}: {len(block.instrs)} instructions"
+                    f" -> {', '.join(succs)}\n")
+            f.write(f"    live in: {regs(block.live_in)}\n")
+
+        f.write("\nLoops:\n")
+        if not self.loops:
+            f.write("  none\n")
+        for loop in self.loops:
+            end = max(self.blocks[node].end() for node in loop.body)
+            if loop.min_cycles == loop.max_cycles:
+                cycles = f"{loop.min_cycles}"
+            else:
+                cycles = f"{loop.min_cycles}-{loop.max_cycles}"
+            f.write(f"  {self.name(loop.header, debug)}-{end}: {len(loop.body)} blocks,"
+                    f" {cycles} cycles per iteration\n")
+
+        f.write("\nUnreachable:\n")
+        ranges = self.unreachable()
+        if not ranges:
+            f.write("  none\n")
+        for start, end in ranges:
+            f.write(f"  {start}-{end}: {end - start + 1} bytes\n")
+
+        f.write("\nDead code:\n")
+        dead = self.dead_code()
+        if not dead:
+            f.write("  none\n")
+        for instr, why in dead:
+            f.write(f"  {self.describe(instr.addr, debug)}  ({why})\n")
+
+        read, total = self.flag_usage()
+        f.write(f"\nFlags are read after {read} of {total} instructions\n")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("infile", help="Assembled program to analyze")
+    parser.add_argument(
+            "--entry", type=lambda s: int(s, 0), action="append", default=None,
+            help="Entry point address (may be given multiple times, default 0)")
+    parser.add_argument(
+            "--debug-info", default=None,
+            help="Debug info file from 'assembler.py --debug-info', to show labels and source lines")
+    parser.add_argument(
+            "--cost-model", default=None,
+            help="Count loop cycles with the cycle costs in this file (see emulator.CostModel)")
+    args = parser.parse_args()
+
+    # Banks can't be executed, so only the RAM image is analyzed
+    with open(args.infile, "rb") as f:
+        bs = asm.read_banked_image(f.read())[0]
+
+    debug = None
+    if args.debug_info is not None:
+        with open(args.debug_info, "r") as f:
+            debug = asm.read_debug_info(f)
+
+    cost = None
+    if args.cost_model is not None:
+        try:
+            model = emulator.load_cost_model(args.cost_model)
+        except Exception as ex:
+            parser.error(args.cost_model + ": " + str(ex))
+        cost = lambda instr, taken: model.static_cost(instr.op, taken)
+
+    Analysis(bs, args.entry or (0,), cost).report(sys.stdout, debug)
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 
 import sys
+import json
+import re
+import struct
 
 class AsmError(Exception):
     pass
@@ -9,14 +12,18 @@ TAG_INT = 0
 TAG_REG = 1
 TAG_STRING = 2
 TAG_LABEL = 3
+TAG_EXPR = 4
 
-def tokenize_line(line, defs):
-    idx = 0
-    def checkidx():
-        if idx >= len(line):
-            raise AsmError("Unexpected EOL")
+REGISTERS = {"r" + str(i): (TAG_REG, i) for i in range(0, 8)}
+
+CHAR_ESCAPES = {"n": "\n", "r": "\r", "t": "\t", "0": "\0"}
+
+# Matches a char literal on its own, a comment, or any other
+# whitespace-separated part, which may contain char literals (like 'a'+1)
+TOKEN_RE = re.compile(r"'(?:\\(.)|([^\\']))'(?![^\s#])|(#)|((?:'(?:\\.|[^\\'])'|[^\s#'])(?:'(?:\\.|[^\\'])'|\S)*)|\S+")
 
-    def parse_number(part):
+def parse_number(part):
+    try:
         if part.startswith("0x"):
             return int(part[2:], 16)
         elif part.startswith("0b"):
@@ -25,83 +32,272 @@ def tokenize_line(line, defs):
             return int(part[2:], 8)
         elif part.isnumeric():
             return int(part, 10)
+    except ValueError:
+        pass
+    raise AsmError("Bad number literal")
+
+# Only used for malformed char literals, to produce the right error
+def char_literal_error(line, idx):
+    idx += 1
+    if idx >= len(line):
+        raise AsmError("Unexpected EOL")
+    if line[idx] == '\'':
+        raise AsmError("Char literal needs contents")
+    if line[idx] == '\\':
+        idx += 1
+    idx += 1
+    if idx >= len(line):
+        raise AsmError("Unexpected EOL")
+    raise AsmError("Missing closing quote in char literal")
+
+# Tokens which don't depend on the defines are cached. Define names are
+# always plain strings, so the defines only need to be checked first.
+# Labels differ between programs, so the cache is emptied when it grows
+# past STATIC_TOKENS_MAX, to bound it when assembling many programs.
+STATIC_TOKENS_MAX = 4096
+static_tokens = dict(REGISTERS)
+
+def classify_part(part):
+    if part[0].isnumeric():
+        return (TAG_INT, parse_number(part))
+    elif len(part) >= 2 and part[0] == '-' and part[1].isnumeric():
+        return (TAG_INT, -parse_number(part[1:]))
+    elif part.endswith(":"):
+        return (TAG_LABEL, part[:-1])
+    else:
+        return (TAG_STRING, part)
+
+def split_line(line):
+    if "'" not in line and "#" not in line:
+        return line.split()
+
+    parts = []
+    for match in TOKEN_RE.finditer(line):
+        escaped, ch, comment, part = match.groups()
+        if comment is not None:
+            break
+        elif ch is not None:
+            parts.append((TAG_INT, ord(ch)))
+        elif escaped is not None:
+            parts.append((TAG_INT, ord(CHAR_ESCAPES.get(escaped, escaped))))
+        elif part is not None:
+            parts.append(part)
+        elif match.group()[0] == '\'':
+            # Report the malformed literal once the tokens before it are parsed
+            parts.append((None, match.start()))
+        else:
+            parts.append(match.group())
+    return parts
+
+# Constant expressions, like 'end-start' or '((size << 1) | 1)', with the
+# operators | & << >> + - * and unary - ~, from lowest to highest precedence.
+# Parts with operators in them are expressions. They can't contain spaces
+# unless they're in parentheses, except in the value of a def.
+# Names are defines, or labels. Expressions without labels are folded
+# into ints right away, the rest are TAG_EXPR tokens, evaluated when
+# the instruction is serialized.
+
+EXPR_RE = re.compile(r"[-+*<>&|~()]")
+EXPR_TOKEN_RE = re.compile(r"\s*(?:(<<|>>|[-+*&|~()])|'(?:\\(.)|([^\\']))'|(\w+))")
+
+EXPR_BINARY_OPS = [
+    {"|": lambda a, b: a | b},
+    {"&": lambda a, b: a & b},
+    {"<<": lambda a, b: a << b, ">>": lambda a, b: a >> b},
+    {"+": lambda a, b: a + b, "-": lambda a, b: a - b},
+    {"*": lambda a, b: a * b},
+]
+EXPR_UNARY_OPS = {"-": lambda a: -a, "~": lambda a: ~a}
+
+# Negative numbers, and prefixed literals with a sign like '0x-1',
+# aren't expressions
+SIGNED_NUMBER_RE = re.compile(r"-?(?:0[xbo][-+]\w+|\d\w*)")
+
+def is_expression(part):
+    if EXPR_RE.search(part) is None or part.endswith(":"):
+        return False
+    return SIGNED_NUMBER_RE.fullmatch(part) is None
+
+# Split a part into operators (as strings) and (TAG_INT, val) or
+# (TAG_STRING, name) operands
+def lex_expression(part):
+    out = []
+    pos = 0
+    while pos < len(part):
+        match = EXPR_TOKEN_RE.match(part, pos)
+        if match is None:
+            if part[pos:].strip() == "":
+                break
+            raise AsmError("Bad expression: " + part)
+        op, escaped, ch, word = match.groups()
+        if op is not None:
+            out.append(op)
+        elif ch is not None:
+            out.append((TAG_INT, ord(ch)))
+        elif escaped is not None:
+            out.append((TAG_INT, ord(CHAR_ESCAPES.get(escaped, escaped))))
+        elif word[0].isnumeric():
+            out.append((TAG_INT, parse_number(word)))
         else:
-            raise AsmError("Bad number literal")
+            out.append((TAG_STRING, word))
+        pos = match.end()
+    return out
+
+# Parse lexed expression tokens into a tree of tuples: ("int", val),
+# ("label", name), (unary op, a) or (binary op, a, b)
+def parse_expression(tokens, defs):
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def operand():
+        nonlocal pos
+        tok = peek()
+        pos += 1
+        if tok is None:
+            raise AsmError("Unexpected end of expression")
+        if tok in EXPR_UNARY_OPS:
+            return (tok, operand())
+        if tok == "+":
+            return operand()
+        if tok == "(":
+            node = binary(0)
+            if peek() != ")":
+                raise AsmError("Missing closing parenthesis")
+            pos += 1
+            return node
+        if type(tok) is str:
+            raise AsmError("Unexpected '" + tok + "' in expression")
+        if tok[0] == TAG_INT:
+            return ("int", tok[1])
+
+        val = defs.get(tok[1], tok)
+        if val[0] == TAG_INT:
+            return ("int", val[1])
+        elif val[0] == TAG_EXPR:
+            return val[1]
+        elif val[0] == TAG_STRING:
+            return ("label", val[1])
+        raise AsmError("Only numbers and labels can be used in expressions")
+
+    def binary(level):
+        if level == len(EXPR_BINARY_OPS):
+            return operand()
+        nonlocal pos
+        node = binary(level + 1)
+        while peek() in EXPR_BINARY_OPS[level]:
+            op = tokens[pos]
+            pos += 1
+            node = (op, node, binary(level + 1))
+        return node
+
+    node = binary(0)
+    if pos != len(tokens):
+        tok = tokens[pos]
+        raise AsmError("Unexpected '" + (tok if type(tok) is str else str(tok[1])) + "' in expression")
+    return node
+
+def eval_expression(node, labels):
+    kind = node[0]
+    if kind == "int":
+        return node[1]
+    elif kind == "label":
+        if node[1] not in labels:
+            raise AsmError("Unknown label: " + node[1])
+        return labels[node[1]]
+    elif len(node) == 2:
+        return EXPR_UNARY_OPS[kind](eval_expression(node[1], labels))
+
+    a = eval_expression(node[1], labels)
+    b = eval_expression(node[2], labels)
+    if kind in ("<<", ">>") and b < 0:
+        raise AsmError("Negative shift count")
+    for ops in EXPR_BINARY_OPS:
+        if kind in ops:
+            return ops[kind](a, b)
+
+def has_labels(node):
+    if node[0] == "label":
+        return True
+    return any(type(child) is tuple and has_labels(child) for child in node[1:])
+
+# Turn a list of parts into an expression token
+def expression_token(parts, defs):
+    tokens = []
+    for part in parts:
+        if type(part) is tuple:
+            tokens.append(part)
+        else:
+            tokens += lex_expression(part)
+    node = parse_expression(tokens, defs)
+    if has_labels(node):
+        return (TAG_EXPR, node)
+    return (TAG_INT, eval_expression(node, {}))
+
+def paren_depth(part):
+    if type(part) is tuple:
+        return 0
+    return part.count("(") - part.count(")")
 
-    while idx < len(line):
-        if line[idx].isspace():
-            idx += 1
+def tokenize_line(line, defs):
+    parts = split_line(line)
+
+    # Everything after a def's name is its value
+    if len(parts) > 3 and parts[0] == "def":
+        parts = parts[:2] + [parts[2:]]
+
+    tokens = []
+    i = 0
+    while i < len(parts):
+        part = parts[i]
+        i += 1
+        if type(part) is list:
+            for p in part:
+                if type(p) is tuple and p[0] is None:
+                    char_literal_error(line, p[1])
+            tokens.append(expression_token(part, defs))
             continue
 
-        if line[idx] == '#':
-            break
+        if type(part) is tuple:
+            if part[0] is None:
+                char_literal_error(line, part[1])
+            tokens.append(part)
+            continue
 
-        if line[idx] == '\'':
-            idx += 1
-            if line[idx] == '\'':
-                raise AsmError("Char literal needs contents")
-
-            if line[idx] == '\\':
-                idx += 1
-                checkidx()
-                if line[idx] == 'n':
-                    ch = '\n'
-                elif line[idx] == 'r':
-                    ch = '\r'
-                elif line[idx] == 't':
-                    ch = '\t'
-                elif line[idx] == '0':
-                    ch = '\0'
-                else:
-                    ch = line[idx]
-            else:
-                ch = line[idx]
+        if part in defs:
+            tokens.append(defs[part])
+            continue
 
-            idx += 1
-            checkidx()
-            if line[idx] != '\'':
-                raise AsmError("Missing closing quote in char literal")
+        token = static_tokens.get(part)
+        if token is not None:
+            tokens.append(token)
+            continue
 
-            yield (TAG_INT, ord(ch))
-            idx += 1
+        if is_expression(part):
+            # Parentheses can span several parts
+            group = [part]
+            depth = paren_depth(part)
+            while depth > 0 and i < len(parts):
+                group.append(parts[i])
+                depth += paren_depth(parts[i])
+                i += 1
+            tokens.append(expression_token(group, defs))
             continue
 
-        start = idx
-        idx += 1
-        while idx < len(line) and not line[idx].isspace():
-            idx += 1
-
-        part = line[start:idx]
-        if part[0].isnumeric():
-            yield (TAG_INT, parse_number(part))
-        elif len(part) >= 2 and part[0] == '-' and part[1].isnumeric():
-            yield (TAG_INT, -parse_number(part[1:]))
-        elif part == "r0":
-            yield (TAG_REG, 0)
-        elif part == "r1":
-            yield (TAG_REG, 1)
-        elif part == "r2":
-            yield (TAG_REG, 2)
-        elif part == "r3":
-            yield (TAG_REG, 3)
-        elif part == "r4":
-            yield (TAG_REG, 4)
-        elif part == "r5":
-            yield (TAG_REG, 5)
-        elif part == "r6":
-            yield (TAG_REG, 6)
-        elif part == "r7":
-            yield (TAG_REG, 7)
-        elif part in defs:
-            yield defs[part]
-        elif part.endswith(":"):
-            yield (TAG_LABEL, part[:-1])
-        else:
-            yield (TAG_STRING, part)
+        token = classify_part(part)
+        if len(static_tokens) >= STATIC_TOKENS_MAX:
+            static_tokens.clear()
+            static_tokens.update(REGISTERS)
+        static_tokens[part] = token
+        tokens.append(token)
+    return tokens
 
 FMT_R = 0
 FMT_I = 1
 FMT_BYTE = 2
+FMT_ORG = 3
+FMT_BANK = 4
 
 INS_NOP = 0
 INS_ADD = 1
@@ -135,8 +331,112 @@ JC_JGE = 3
 JC_JGTS = 4
 JC_JGES = 5
 
+def require_args(op, args, *ns):
+    for n in ns:
+        if len(args) == n:
+            return
+    raise AsmError("Invalid argument count for " + op + ", expected " + str(ns))
+
+def is_immediate(arg):
+    return arg[0] == TAG_INT or arg[0] == TAG_STRING or arg[0] == TAG_EXPR
+
+def parse_byte(op, args):
+    require_args(op, args, 1)
+    return (FMT_BYTE, args[0])
+
+def parse_org(op, args):
+    require_args(op, args, 1)
+    if args[0][0] != TAG_INT:
+        raise AsmError("Org address must be a number")
+    return (FMT_ORG, args[0][1])
+
+def parse_bank(op, args):
+    require_args(op, args, 1)
+    if args[0][0] != TAG_INT or args[0][1] < 0 or args[0][1] > BANK_MAX:
+        raise AsmError("Bank must be a number between 0 and " + str(BANK_MAX))
+    return (FMT_BANK, args[0][1])
+
+def parse_nop(op, args):
+    require_args(op, args, 0)
+    return (FMT_R, INS_NOP, (TAG_REG, 0), (TAG_INT, 0), (TAG_INT, 0))
+
+def parse_alu(op, args):
+    require_args(op, args, 3)
+    return (FMT_R, ALU_OPS[op], args[0], args[1], args[2])
+
+def parse_mov(op, args):
+    require_args(op, args, 2)
+    if is_immediate(args[1]):
+        return (FMT_I, INS_IMM, args[0], args[1])
+    else:
+        return (FMT_R, INS_ADD, args[0], args[1], (TAG_INT, 0))
+
+def parse_cmp(op, args):
+    require_args(op, args, 2)
+    return (FMT_R, INS_CMP, (TAG_REG, 0), args[0], args[1])
+
+def parse_jump(op, args):
+    require_args(op, args, 1, 2)
+    cond = JUMP_CONDS[op]
+    if len(args) == 1 and is_immediate(args[0]):
+        return (FMT_I, INS_JMPI, (TAG_REG, cond), args[0])
+    elif len(args) == 1:
+        return (FMT_R, INS_JMP, (TAG_REG, cond), args[0], (TAG_INT, 0))
+    else:
+        return (FMT_R, INS_JMP, (TAG_REG, cond), args[0], args[1])
+
+def parse_ld(op, args):
+    require_args(op, args, 1)
+    return (FMT_R, INS_LD, args[0], (TAG_REG, 0), (TAG_REG, 0))
+
+def parse_st(op, args):
+    require_args(op, args, 1, 2)
+    if len(args) == 1 and is_immediate(args[0]):
+        return (FMT_I, INS_STI, (TAG_REG, 0), args[0])
+    elif len(args) == 1:
+        return (FMT_R, INS_ST, (TAG_REG, 0), args[0], (TAG_INT, 0))
+    else:
+        return (FMT_R, INS_ST, (TAG_REG, 0), args[0], args[1])
+
+def parse_rand(op, args):
+    require_args(op, args, 1)
+    return (FMT_R, INS_RAND, args[0], (TAG_REG, 0), (TAG_REG, 0))
+
+def parse_halt(op, args):
+    require_args(op, args, 0)
+    return (FMT_R, INS_HALT, (TAG_REG, 0), (TAG_REG, 0), (TAG_REG, 0))
+
+ALU_OPS = {
+    "add": INS_ADD, "sub": INS_SUB, "xor": INS_XOR, "nand": INS_NAND,
+    "or": INS_OR, "and": INS_AND, "shr": INS_SHR, "addc": INS_ADDC,
+    "subc": INS_SUBC, "shrc": INS_SHRC, "cmpc": INS_CMPC,
+}
+
+JUMP_CONDS = {
+    "jmp": JC_ALWAYS, "jeq": JC_JEQ, "jgt": JC_JGT,
+    "jge": JC_JGE, "jgts": JC_JGTS, "jges": JC_JGES,
+}
+
+# Parsers for each mnemonic other than 'def', which needs the defines
+MNEMONICS = {
+    "byte": parse_byte,
+    "org": parse_org,
+    "bank": parse_bank,
+    "nop": parse_nop,
+    "mov": parse_mov,
+    "cmp": parse_cmp,
+    "ld": parse_ld,
+    "st": parse_st,
+    "rand": parse_rand,
+    "halt": parse_halt,
+}
+for name in ALU_OPS:
+    MNEMONICS[name] = parse_alu
+for name in JUMP_CONDS:
+    MNEMONICS[name] = parse_jump
+
 def parse_line(line, defines, labels, iptr):
-    parts = list(tokenize_line(line, defines))
+    parts = tokenize_line(line, defines)
 
     while len(parts) > 0 and parts[0][0] == TAG_LABEL:
         labels[parts[0][1]] = iptr
@@ -151,113 +451,17 @@ def parse_line(line, defines, labels, iptr):
 
     args = parts[1:]
 
-    def require_args(*ns):
-        for n in ns:
-            if len(args) == n:
-                return
-        raise AsmError("Invalid argument count for " + op + ", expected " + str(ns))
-
     if op == "def":
-        require_args(2)
+        require_args(op, args, 2)
         if parts[1][0] != TAG_STRING:
             raise AsmError("Define name must be string")
         defines[parts[1][1]] = args[1]
         return None
-    if op == "byte":
-        require_args(1)
-        return (FMT_BYTE, args[0])
-    if op == "nop":
-        require_args(0)
-        return (FMT_R, INS_NOP, (TAG_REG, 0), (TAG_INT, 0), (TAG_INT, 0))
-    if op == "add":
-        require_args(3)
-        return (FMT_R, INS_ADD, args[0], args[1], args[2])
-    if op == "mov":
-        require_args(2)
-        if args[1][0] == TAG_INT or args[1][0] == TAG_STRING:
-            return (FMT_I, INS_IMM, args[0], args[1])
-        else:
-            return (FMT_R, INS_ADD, args[0], args[1], (TAG_INT, 0))
-        return (FMT_R, INS_ADD, args[0], (TAG_REG, 0), args[1])
-    if op == "sub":
-        require_args(3)
-        return (FMT_R, INS_SUB, args[0], args[1], args[2])
-    if op == "xor":
-        require_args(3)
-        return (FMT_R, INS_XOR, args[0], args[1], args[2])
-    if op == "nand":
-        require_args(3)
-        return (FMT_R, INS_NAND, args[0], args[1], args[2])
-    if op == "or":
-        require_args(3)
-        return (FMT_R, INS_OR, args[0], args[1], args[2])
-    if op == "and":
-        require_args(3)
-        return (FMT_R, INS_AND, args[0], args[1], args[2])
-    if op == "shr":
-        require_args(3)
-        return (FMT_R, INS_SHR, args[0], args[1], args[2])
-    if op == "cmp":
-        require_args(2)
-        return (FMT_R, INS_CMP, (TAG_REG, 0), args[0], args[1])
-    if (
-            op == "jmp" or op == "jeq" or
-            op == "jgt" or op == "jge" or
-            op == "jgts" or op == "jges"):
-        require_args(1, 2)
-        if op == "jmp":
-            cond = JC_ALWAYS
-        elif op == "jeq":
-            cond = JC_JEQ
-        elif op == "jgt":
-            cond = JC_JGT
-        elif op == "jge":
-            cond = JC_JGE
-        elif op == "jgts":
-            cond = JC_JGTS
-        elif op == "jges":
-            cond = JC_JGES
-
-        if (
-                len(args) == 1 and
-                (args[0][0] == TAG_INT or args[0][0] == TAG_STRING)):
-            return (FMT_I, INS_JMPI, (TAG_REG, cond), args[0])
-        else:
-            if len(args) == 1:
-                return (FMT_R, INS_JMP, (TAG_REG, cond), args[0], (TAG_INT, 0))
-            else:
-                return (FMT_R, INS_JMP, (TAG_REG, cond), args[0], args[1])
-    if op == "ld":
-        require_args(1)
-        return (FMT_R, INS_LD, args[0], (TAG_REG, 0), (TAG_REG, 0))
-    if op == "st":
-        require_args(1, 2)
-        if len(args) == 1 and (args[0][0] == TAG_INT or args[0][0] == TAG_STRING):
-            return (FMT_I, INS_STI, (TAG_REG, 0), args[0])
-        elif len(args) == 1:
-            return (FMT_R, INS_ST, (TAG_REG, 0), args[0], (TAG_INT, 0))
-        else:
-            return (FMT_R, INS_ST, (TAG_REG, 0), args[0], args[1])
-    if op == "addc":
-        require_args(3)
-        return (FMT_R, INS_ADDC, args[0], args[1], args[2])
-    if op == "subc":
-        require_args(3)
-        return (FMT_R, INS_SUBC, args[0], args[1], args[2])
-    if op == "shrc":
-        require_args(3)
-        return (FMT_R, INS_SHRC, args[0], args[1], args[2])
-    if op == "cmpc":
-        require_args(3)
-        return (FMT_R, INS_CMPC, args[0], args[1], args[2])
-    if op == "rand":
-        require_args(1)
-        return (FMT_R, INS_RAND, args[0], (TAG_REG, 0), (TAG_REG, 0))
-    if op == "halt":
-        require_args(0)
-        return (FMT_R, INS_HALT, (TAG_REG, 0), (TAG_REG, 0), (TAG_REG, 0))
-
-    raise AsmError("Unknown op " + op)
+
+    parser = MNEMONICS.get(op)
+    if parser is None:
+        raise AsmError("Unknown op " + op)
+    return parser(op, args)
 
 def serialize_instr(instr, defines, labels):
     def unlabel(arg):
@@ -266,15 +470,25 @@ def serialize_instr(instr, defines, labels):
                 return (TAG_INT, labels[arg[1]])
             else:
                 raise AsmError("Unknown label: " + arg[1])
+        elif arg[0] == TAG_EXPR:
+            return (TAG_INT, eval_expression(arg[1], labels))
         else:
             return arg
 
+    # Values which fit in 8 bits, signed or unsigned
+    def to_byte(val, what):
+        if val < -128 or val > 255:
+            raise AsmError(what + " must be between -128 and 255")
+        return val % 256
+
+    if instr[0] == FMT_ORG:
+        return bytes(instr[1])
     if instr[0] == FMT_BYTE:
         fmt, b = instr
         b = unlabel(b)
         if b[0] != TAG_INT:
             raise AsmError("Bytes must be known at compile time")
-        return bytes((b[1],))
+        return bytes((to_byte(b[1], "Byte"),))
     if instr[0] == FMT_I:
         fmt, op, rc, imm = instr
         imm = unlabel(imm)
@@ -285,9 +499,7 @@ def serialize_instr(instr, defines, labels):
 
         if imm[0] != TAG_INT:
             raise AsmError("Immediate must me an integer")
-        imm = imm[1]
-        if imm < 0:
-            imm = (~(-imm) + 1) % 256
+        imm = to_byte(imm[1], "Immediate")
 
         hi = (op << 3) | rc
         lo = imm
@@ -320,42 +532,475 @@ def serialize_instr(instr, defines, labels):
         lo = (isel << 7) | (ra << 4) | rb
         return bytes((hi, lo))
 
-def assemble(inf, outf):
+# Peephole optimizer, run on the parsed instructions before serialization.
+#
+# Every instruction sets all four flags, so an instruction can only be
+# removed when the instruction after it doesn't read the flags, or when
+# the flags end up the same either way.
+# It assumes code is only referred to through labels; programs which jump
+# to numeric addresses or through registers are optimized less.
+# (Both encodings of 'mov' are 2 bytes and take a cycle, so there's no
+# shorter form of a mov immediate to pick.)
+
+ALU_WRITE_OPS = (
+    INS_ADD, INS_SUB, INS_XOR, INS_NAND, INS_OR, INS_AND, INS_SHR,
+    INS_ADDC, INS_SUBC, INS_SHRC)
+CARRY_OPS = (INS_ADDC, INS_SUBC, INS_SHRC, INS_CMPC)
+
+def operand_reg(arg):
+    if arg[0] == TAG_REG:
+        return arg[1]
+    return None
+
+# The registers an instruction reads. Every R-format instruction reads A and B,
+# if they're registers, since they go into the overflow flag.
+def instr_reads(instr):
+    if instr[0] != FMT_R:
+        return set()
+    fmt, op, rc, ra, rb = instr
+    regs = {operand_reg(ra), operand_reg(rb)}
+    if op in (INS_LD, INS_ST):
+        regs.add(7)
+    regs.discard(None)
+    return regs
+
+def instr_writes(instr):
+    op = instr[1]
+    if op in ALU_WRITE_OPS or op in (INS_IMM, INS_LD, INS_RAND):
+        return operand_reg(instr[2])
+    return None
+
+def instr_reads_flags(instr):
+    if instr[0] == FMT_BYTE:
+        return True
+    op = instr[1]
+    if op in CARRY_OPS:
+        return True
+    if op in (INS_JMP, INS_JMPI):
+        return instr[2] != (TAG_REG, JC_ALWAYS)
+    return False
+
+def instr_falls_through(instr):
+    if instr[0] == FMT_BYTE:
+        return True
+    op = instr[1]
+    if op in (INS_JMP, INS_JMPI):
+        return instr[2] != (TAG_REG, JC_ALWAYS)
+    return op != INS_HALT
+
+def is_mov(instr):
+    if instr[0] == FMT_I:
+        return instr[1] == INS_IMM
+    return instr[0] == FMT_R and instr[1] == INS_ADD and instr[4] == (TAG_INT, 0)
+
+def jump_label(instr):
+    if instr[0] == FMT_I and instr[1] == INS_JMPI and instr[3][0] == TAG_STRING:
+        return instr[3][1]
+    return None
+
+# 'entries' is a list of [linenum, instr, labels] where labels are the names
+# of the labels at the instruction. Labels after the last instruction are at
+# index len(entries).
+def find_unreachable(entries, label_index):
+    seen = set()
+    todo = [0]
+    while len(todo) > 0:
+        i = todo.pop()
+        if i in seen or i >= len(entries):
+            continue
+        seen.add(i)
+        instr = entries[i][1]
+        # Falling into data means the data is executed, which we can't follow
+        if instr[0] == FMT_BYTE:
+            return set()
+        if instr_falls_through(instr):
+            todo.append(i + 1)
+        target = jump_label(instr)
+        if target is not None:
+            todo.append(label_index[target])
+    return {i for i, e in enumerate(entries) if e[1][0] != FMT_BYTE and i not in seen}
+
+def optimize_pass(entries, end_labels, movable, report):
+    label_index = {name: len(entries) for name in end_labels}
+    for i, (linenum, instr, names) in enumerate(entries):
+        for name in names:
+            label_index[name] = i
+
+    def next_reads_flags(i):
+        return i + 1 >= len(entries) or instr_reads_flags(entries[i + 1][1])
+
+    remove = {}
+    for i, (linenum, instr, names) in enumerate(entries):
+        prev = entries[i - 1][1] if i > 0 else None
+
+        target = jump_label(instr)
+        if target is not None:
+            # Jumps to unconditional jumps go straight to their target.
+            # JMPI always sets the flags the same way, so skipping one doesn't matter.
+            seen = {target}
+            final = target
+            while label_index[final] < len(entries):
+                nxt = jump_label(entries[label_index[final]][1])
+                if nxt is None or entries[label_index[final]][1][2] != (TAG_REG, JC_ALWAYS):
+                    break
+                if nxt in seen:
+                    break
+                seen.add(nxt)
+                final = nxt
+            if final != target:
+                instr = instr[:3] + ((TAG_STRING, final),)
+                entries[i][1] = instr
+                report["folded"].append([linenum, target, final])
+                target = final
+
+        if not movable:
+            continue
+
+        if target is not None and label_index[target] == i + 1 and not next_reads_flags(i):
+            remove[i] = "jump to the next instruction"
+        elif is_mov(instr) and instr[0] == FMT_R and instr[2] == instr[3] and not next_reads_flags(i):
+            remove[i] = "self-move"
+        elif len(names) == 0 and prev is not None and i - 1 not in remove and is_mov(prev) and is_mov(instr):
+            # A mov right after the same mov, or after the reverse register
+            # mov, changes nothing (not even the flags)
+            if instr == prev:
+                remove[i] = "repeated mov"
+            elif instr[0] == FMT_R and prev[0] == FMT_R and instr[2] == prev[3] and instr[3] == prev[2]:
+                remove[i] = "mov back to the source register"
+
+        if i not in remove and is_mov(instr) and i + 1 < len(entries) and not next_reads_flags(i):
+            nxt = entries[i + 1][1]
+            dest = instr_writes(instr)
+            if dest is not None and instr_writes(nxt) == dest and dest not in instr_reads(nxt):
+                remove[i] = "mov overwritten by the next instruction"
+
+    if movable and len(remove) == 0:
+        for i in find_unreachable(entries, label_index):
+            remove[i] = "unreachable"
+
+    if len(remove) == 0:
+        return entries, end_labels, False
+
+    # Labels at removed instructions move to the next instruction which is kept
+    out = []
+    names = []
+    for i, entry in enumerate(entries):
+        if i in remove:
+            report["removed"].append([entry[0], remove[i]])
+            if remove[i] != "unreachable":
+                report["instrs"] += 1
+            names += entry[2]
+        else:
+            out.append([entry[0], entry[1], names + entry[2]])
+            names = []
+    return out, end_labels + names, True
+
+# Optimize a list of (linenum, instr). Returns the new instructions and labels.
+# 'report' is filled in with what was done:
+# * "removed": [linenum, reason] for each instruction which was removed
+# * "folded": [linenum, old label, new label] for each jump which was retargeted
+# * "bytes": Bytes saved
+# * "instrs": Instructions which no longer execute, counting each removed
+#   reachable instruction and each folded jump once. This is a static count,
+#   not weighted by how often the code runs.
+def optimize_instrs(instrs, labels, report):
+    by_addr = {}
+    for name, addr in labels.items():
+        by_addr.setdefault(addr, []).append(name)
+
+    entries = []
+    iptr = 0
+    for linenum, instr in instrs:
+        entries.append([linenum, instr, by_addr.pop(iptr, [])])
+        iptr += 1 if instr[0] == FMT_BYTE else 2
+    end_labels = by_addr.pop(iptr, [])
+    size = iptr
+
+    # Removing code moves everything after it, which is only safe if
+    # nothing refers to code by its address
+    movable = True
+    for linenum, instr in instrs:
+        if instr[0] == FMT_I and instr[1] == INS_JMPI and instr[3][0] != TAG_STRING:
+            movable = False
+        if instr[0] == FMT_R and instr[1] == INS_JMP:
+            movable = False
+
+    report.setdefault("removed", [])
+    report.setdefault("folded", [])
+    report.setdefault("instrs", 0)
+    changed = True
+    while changed:
+        entries, end_labels, changed = optimize_pass(entries, end_labels, movable, report)
+
+    labels = {}
     instrs = []
+    iptr = 0
+    for linenum, instr, names in entries:
+        for name in names:
+            labels[name] = iptr
+        instrs.append((linenum, instr))
+        iptr += 1 if instr[0] == FMT_BYTE else 2
+    for name in end_labels:
+        labels[name] = iptr
+
+    report["instrs"] += len(report["folded"])
+    report["bytes"] = size - iptr
+    return instrs, labels
+
+def write_optimize_report(f, report):
+    f.write(
+            f"Optimizer: {report['bytes']} bytes saved, {report['instrs']} instructions " +
+            "no longer executed (counted once each, not per run)\n")
+    notes = [(linenum, "removed " + reason) for linenum, reason in report["removed"]]
+    notes += [(linenum, f"jump to {old} goes straight to {new}") for linenum, old, new in report["folded"]]
+    for linenum, note in sorted(notes):
+        f.write(f"  line {linenum}: {note}\n")
+
+def serialize_line(linenum, instr, defines, labels):
+    try:
+        return serialize_instr(instr, defines, labels)
+    except AsmError as ex:
+        raise AsmError("Error on line " + str(linenum) + ": " + str(ex)) from None
+
+def serialize_instrs(instrs, defines, labels):
+    for linenum, instr in instrs:
+        serialize_line(linenum, instr, defines, labels)
+
+# Programs can have data (or code to copy into RAM) in the banks of an
+# extended memory device, which shows one bank at a time in a window of
+# BANK_WINDOW_SIZE bytes at BANK_WINDOW_ADDR. Writing to the two control
+# registers after the window (low byte first) selects the bank.
+#
+# 'bank <n>' puts everything after it into bank n. Labels in a bank are
+# addresses in the window. The RAM image of a program with banks must
+# end before the window. 'org <addr>' pads with zeros up to addr,
+# in RAM or in the window.
+#
+# Programs with banks are assembled into a banked image: a header, the RAM
+# image, and a record for each bank with its number, length and contents.
+BANK_WINDOW_ADDR = 192
+BANK_WINDOW_SIZE = 32
+BANK_MAX = 0xffff
+BANK_IMAGE_MAGIC = b"OCTBANKS"
+BANK_IMAGE_HEADER = struct.Struct("<8sBBB")
+BANK_RECORD = struct.Struct("<HB")
+
+def write_banked_image(main, banks):
+    out = bytearray(BANK_IMAGE_HEADER.pack(
+            BANK_IMAGE_MAGIC, BANK_WINDOW_ADDR, BANK_WINDOW_SIZE, len(main)))
+    out += main
+    for bank, data in sorted(banks.items()):
+        out += BANK_RECORD.pack(bank, len(data))
+        out += data
+    return bytes(out)
+
+def is_banked_image(bs):
+    return bs[0:len(BANK_IMAGE_MAGIC)] == BANK_IMAGE_MAGIC
+
+# Returns the RAM image, the window address and size, and a dict from bank
+# number to contents. Plain images have no banks.
+def read_banked_image(bs):
+    if not is_banked_image(bs):
+        return bytes(bs), BANK_WINDOW_ADDR, BANK_WINDOW_SIZE, {}
+
+    if len(bs) < BANK_IMAGE_HEADER.size:
+        raise AsmError("Truncated banked image")
+    magic, addr, size, length = BANK_IMAGE_HEADER.unpack_from(bs)
+    pos = BANK_IMAGE_HEADER.size
+    if pos + length > len(bs):
+        raise AsmError("Truncated banked image")
+    main = bytes(bs[pos:pos + length])
+    pos += length
+
+    banks = {}
+    while pos < len(bs):
+        if pos + BANK_RECORD.size > len(bs):
+            raise AsmError("Truncated banked image")
+        bank, length = BANK_RECORD.unpack_from(bs, pos)
+        pos += BANK_RECORD.size
+        if pos + length > len(bs) or length > size:
+            raise AsmError("Malformed record for bank " + str(bank))
+        banks[bank] = bytes(bs[pos:pos + length])
+        pos += length
+    return main, addr, size, banks
+
+# Assemble an iterable of source lines into bytes.
+# If 'debug' is a dict, it's filled in with debug info:
+# * "lines": The source lines
+# * "labels": A dict from label name to address
+# * "addrs": For each byte of the RAM image, a [linenum, label] pair, where
+#   label is the name of the closest label at or before the byte (or None)
+# If 'optimize' is a dict, the peephole optimizer is run and the dict is
+# filled in with its report (see optimize_instrs).
+# Programs with 'bank' directives are assembled into a banked image.
+def assemble_lines(inf, debug=None, optimize=None):
+    main_instrs = []
+    instrs = main_instrs
     defines = {}
     labels = {}
+    section_labels = labels
+    lines = []
     iptr = 0
     linenum = 1
+
+    # The instructions and labels in each bank
+    banks = {}
+    bank = None
     for line in inf:
+        if debug is not None:
+            lines.append(line.rstrip("\n"))
         try:
-            instr = parse_line(line, defines, labels, iptr)
+            instr = parse_line(line, defines, section_labels, iptr)
+            if instr is not None and instr[0] == FMT_BANK:
+                bank = instr[1]
+                if bank in banks:
+                    raise AsmError("Bank " + str(bank) + " is already defined")
+                banks[bank] = ([], {})
+                instrs, section_labels = banks[bank]
+                iptr = BANK_WINDOW_ADDR
+                instr = None
+            elif instr is not None and instr[0] == FMT_ORG:
+                if instr[1] < iptr:
+                    raise AsmError("Org address " + str(instr[1]) + " is before the current address " + str(iptr))
+                instr = (FMT_ORG, instr[1] - iptr)
         except AsmError as ex:
             raise AsmError("Error on line " + str(linenum) +": " + str(ex)) from None
 
         if instr != None:
             instrs.append((linenum, instr))
-            if instr[0] == FMT_BYTE:
+            if instr[0] == FMT_ORG:
+                iptr += instr[1]
+            elif instr[0] == FMT_BYTE:
                 iptr += 1
             else:
                 iptr += 2
+            if bank is not None and iptr > BANK_WINDOW_ADDR + BANK_WINDOW_SIZE:
+                raise AsmError("Error on line " + str(linenum) + ": Bank " + str(bank) + " is full")
         linenum += 1
-
+    instrs = main_instrs
+
+    if optimize is not None:
+        if len(banks) > 0 or any(instr[0] == FMT_ORG for linenum, instr in instrs):
+            raise AsmError("The optimizer can't be used with org or bank directives")
+        # Serialize everything first, so code the optimizer removes
+        # still reports its errors
+        serialize_instrs(instrs, defines, labels)
+        instrs, labels = optimize_instrs(instrs, labels, optimize)
+
+    # Labels are shared between RAM and the banks, so each name can
+    # only be defined in one of them
+    all_labels = labels
+    if len(banks) > 0:
+        all_labels = dict(labels)
+        owners = {name: "RAM" for name in labels}
+        for bank, (bank_instrs, bank_labels) in banks.items():
+            for name in bank_labels:
+                if name in owners:
+                    raise AsmError(
+                            "Label " + name + " is defined in both " + owners[name] +
+                            " and bank " + str(bank))
+                owners[name] = "bank " + str(bank)
+            all_labels.update(bank_labels)
+
+    out = bytearray()
+    addrs = []
     for linenum, instr in instrs:
+        bs = serialize_line(linenum, instr, defines, all_labels)
+
+        out += bs
+        if debug is not None:
+            for b in bs:
+                addrs.append(linenum)
+
+        # Loads and stores in the window go to the banks, not to RAM
+        if len(banks) > 0 and len(out) > BANK_WINDOW_ADDR:
+            raise AsmError(
+                    "Error on line " + str(linenum) + ": The program overlaps the bank window at " +
+                    str(BANK_WINDOW_ADDR))
+
+    if debug is not None:
+        debug["lines"] = lines
+        debug["labels"] = all_labels
+        debug["addrs"] = label_addrs(addrs, labels)
+
+    if len(banks) == 0:
+        return bytes(out)
+
+    bank_data = {}
+    for bank, (bank_instrs, bank_labels) in banks.items():
+        data = bytearray()
+        for linenum, instr in bank_instrs:
+            data += serialize_line(linenum, instr, defines, all_labels)
+        bank_data[bank] = bytes(data)
+    return write_banked_image(bytes(out), bank_data)
+
+def assemble(inf, outf, debug=None, optimize=None):
+    outf.write(assemble_lines(inf, debug, optimize))
+
+def assemble_source(source, debug=None, optimize=None):
+    return assemble_lines(source.splitlines(), debug, optimize)
+
+# Assemble many sources. Yields the bytes for each source in order,
+# or the AsmError for sources which fail to assemble.
+def assemble_many(sources):
+    for source in sources:
         try:
-            bs = serialize_instr(instr, defines, labels)
+            yield assemble_lines(source.splitlines())
         except AsmError as ex:
-            raise AsmError("Error on line " + str(linenum) + ": " + str(ex)) from None
+            yield ex
 
-        outf.write(bs)
+def label_addrs(addrs, labels):
+    by_addr = {}
+    for name, addr in labels.items():
+        by_addr.setdefault(addr, name)
+
+    out = []
+    label = None
+    for addr, linenum in enumerate(addrs):
+        if addr in by_addr:
+            label = by_addr[addr]
+        out.append([linenum, label])
+    return out
+
+def write_debug_info(f, debug):
+    json.dump(debug, f, indent=1)
+    f.write("\n")
+
+def read_debug_info(f):
+    return json.load(f)
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: " + sys.argv[0] + " <infile> <outfile>")
-        exit(1)
-    with open(sys.argv[1], "r") as inf:
-        with open(sys.argv[2], "wb") as outf:
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("infile", help="Assembly source file")
+    parser.add_argument("outfile", help="Output binary file")
+    parser.add_argument(
+            "-g", "--debug-info", default=None,
+            help="Write a file mapping each emitted byte to its source line and label")
+    parser.add_argument(
+            "-O", "--optimize", action="store_true",
+            help="Run the peephole optimizer and print what it did")
+    args = parser.parse_args()
+
+    debug = None
+    if args.debug_info is not None:
+        debug = {}
+    optimize = None
+    if args.optimize:
+        optimize = {}
+
+    with open(args.infile, "r") as inf:
+        with open(args.outfile, "wb") as outf:
             try:
-                assemble(inf, outf)
+                assemble(inf, outf, debug, optimize)
             except AsmError as ex:
                 print(str(ex))
                 exit(1)
+
+    if optimize is not None:
+        write_optimize_report(sys.stdout, optimize)
+
+    if debug is not None:
+        with open(args.debug_info, "w") as f:
+            write_debug_info(f, debug)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+# A batch of Octornado CPUs executing in lockstep, with each instance's
+# registers, RAM and flags stored as rows in NumPy arrays.
+# Every instance executes its own instruction on every step, so instances
+# which have taken different branches don't need to be masked out;
+# only halted and faulted instances are.
+
+import assembler as asm
+import numpy as np
+import random
+
+ALU_SUB_OPS = (asm.INS_SUB, asm.INS_CMP, asm.INS_SUBC, asm.INS_CMPC)
+ALU_WRITE_OPS = (
+        asm.INS_ADD, asm.INS_SUB, asm.INS_XOR, asm.INS_NAND, asm.INS_OR,
+        asm.INS_AND, asm.INS_SHR, asm.INS_ADDC, asm.INS_SUBC, asm.INS_SHRC)
+LEGAL_OPS = (
+        asm.INS_NOP, asm.INS_ADD, asm.INS_SUB, asm.INS_XOR, asm.INS_NAND,
+        asm.INS_OR, asm.INS_AND, asm.INS_SHR, asm.INS_CMP, asm.INS_JMP,
+        asm.INS_LD, asm.INS_ST, asm.INS_ADDC, asm.INS_SUBC, asm.INS_SHRC,
+        asm.INS_CMPC, asm.INS_JMPI, asm.INS_IMM, asm.INS_STI, asm.INS_RAND,
+        asm.INS_HALT)
+
+class BatchCPU:
+    def __init__(self, n, seeds=None):
+        self.n = n
+        self.regs = np.zeros((n, 8), dtype=np.int32)
+        self.ram = np.zeros((n, 256), dtype=np.uint8)
+        self.iptr = np.zeros(n, dtype=np.int32)
+        self.halted = np.zeros(n, dtype=bool)
+        self.cflag = np.zeros(n, dtype=np.int32)
+        self.sflag = np.zeros(n, dtype=np.int32)
+        self.zflag = np.zeros(n, dtype=np.int32)
+        self.oflag = np.zeros(n, dtype=np.int32)
+
+        # Instances which hit an illegal instruction or jump condition stop,
+        # the same way CPU.step() raises. 'errors' holds the message.
+        self.faulted = np.zeros(n, dtype=bool)
+        self.errors = [None] * n
+
+        self.cycles = np.zeros(n, dtype=np.int64)
+
+        self.hardware = []
+        self.is_hw = np.zeros(256, dtype=bool)
+
+        # Each instance has its own RNG, so instance i behaves exactly like
+        # a CPU run after random.seed(seeds[i])
+        if seeds is None:
+            self.rngs = [random.Random() for i in range(0, n)]
+        else:
+            if len(seeds) != n:
+                raise Exception("Expected " + str(n) + " seeds, got " + str(len(seeds)))
+            self.rngs = [random.Random(seed) for seed in seeds]
+
+    # Extended memory isn't emulated, so banked images (see assembler.py)
+    # are only accepted if they have no banks
+    def load_program(self, bs):
+        bs, addr, size, banks = asm.read_banked_image(bs)
+        if len(banks) > 0:
+            raise Exception("Images with banks aren't supported")
+        if len(bs) >= 256:
+            raise Exception("Program too big")
+
+        self.ram[:, 0:len(bs)] = np.frombuffer(bytes(bs), dtype=np.uint8)
+
+    # 'hws' is a list of n devices, one for each instance
+    def add_hardware(self, addr, hws):
+        if len(hws) != self.n:
+            raise Exception("Expected " + str(self.n) + " devices, got " + str(len(hws)))
+        self.hardware.append((addr, hws))
+        self.is_hw[addr] = True
+
+    def active(self):
+        return ~(self.halted | self.faulted)
+
+    def do_load(self, i, addr):
+        val = 0
+        for hwaddr, hws in self.hardware:
+            if hwaddr == addr:
+                val |= hws[i].read()
+        return val
+
+    def do_store(self, i, addr, val):
+        for hwaddr, hws in self.hardware:
+            if hwaddr == addr:
+                hws[i].write(val)
+
+    def jmp_cond(self, idx, cond):
+        c = self.cflag[idx]
+        z = self.zflag[idx]
+        s = self.sflag[idx]
+        o = self.oflag[idx]
+        return np.select(
+                [
+                    cond == asm.JC_ALWAYS,
+                    cond == asm.JC_JEQ,
+                    cond == asm.JC_JGT,
+                    cond == asm.JC_JGE,
+                    cond == asm.JC_JGTS,
+                    cond == asm.JC_JGES,
+                ],
+                [
+                    True,
+                    z != 0,
+                    (c != 0) & (z == 0),
+                    c != 0,
+                    (z == 0) & (o == s),
+                    o == s,
+                ],
+                False)
+
+    def fault(self, idx, iptr, msg, code):
+        self.faulted[idx] = True
+        for i, ip, val in zip(idx.tolist(), iptr.tolist(), code.tolist()):
+            self.errors[i] = msg(ip, val)
+
+    def step(self):
+        idx = np.flatnonzero(self.active())
+        if len(idx) == 0:
+            return 0
+
+        iptr = self.iptr[idx]
+        hi = self.ram[idx, iptr].astype(np.int32)
+        lo = self.ram[idx, (iptr + 1) % 256].astype(np.int32)
+        self.iptr[idx] = (iptr + 2) % 256
+
+        op = (hi & 0b11111000) >> 3
+        rc = (hi & 0b00000111)
+
+        # Illegal instructions and jump conditions fault without
+        # touching registers or flags, just like CPU.step() raising
+        illegal = ~np.isin(op, LEGAL_OPS)
+        badcond = ((op == asm.INS_JMP) | (op == asm.INS_JMPI)) & (rc > asm.JC_JGES)
+        if illegal.any():
+            self.fault(
+                    idx[illegal], iptr[illegal],
+                    lambda ip, op: "Illegal instruction at " + str(ip) + ": " + hex(op),
+                    op[illegal])
+        if badcond.any():
+            self.fault(
+                    idx[badcond], iptr[badcond],
+                    lambda ip, rc: "Illegal jump condition: " + hex(rc),
+                    rc[badcond])
+        if illegal.any() or badcond.any():
+            ok = ~(illegal | badcond)
+            idx, iptr, op, rc, lo = idx[ok], iptr[ok], op[ok], rc[ok], lo[ok]
+
+        self.cycles[idx] += 1
+
+        imm_fmt = (op >= asm.INS_IMM_START) & (op <= asm.INS_IMM_END)
+        isel = (lo & 0b10000000) >> 7
+        ra =   (lo & 0b01110000) >> 4
+        rb =   (lo & 0b00001111)
+        bimm = np.where(rb & 0b1000, rb | 0b11111000, rb)
+        a = np.where(imm_fmt, 0, self.regs[idx, ra])
+        b = np.where(imm_fmt, 0, np.where(isel != 0, bimm, self.regs[idx, rb % 8]))
+        imm = lo
+
+        cflag = self.cflag[idx]
+        b = np.where(np.isin(op, ALU_SUB_OPS), 0b11111111 ^ b, b)
+
+        sum_ab = a + b
+        shr = np.where(sum_ab & 0b1, 0, sum_ab >> 1) # Odd sums shift out everything
+        out = np.select(
+                [
+                    op == asm.INS_ADD,
+                    (op == asm.INS_SUB) | (op == asm.INS_CMP),
+                    op == asm.INS_XOR,
+                    op == asm.INS_NAND,
+                    op == asm.INS_OR,
+                    op == asm.INS_AND,
+                    op == asm.INS_SHR,
+                    (op == asm.INS_JMP) | (op == asm.INS_ST),
+                    (op == asm.INS_ADDC) | (op == asm.INS_SUBC) | (op == asm.INS_CMPC),
+                    op == asm.INS_SHRC,
+                ],
+                [
+                    sum_ab,
+                    sum_ab + 1,
+                    a ^ b,
+                    ~(a | b),
+                    a | b,
+                    a & b,
+                    shr,
+                    sum_ab,
+                    sum_ab + cflag,
+                    shr | (cflag << 7),
+                ],
+                0)
+
+        # Register writes from the ALU and IMM
+        write = np.isin(op, ALU_WRITE_OPS)
+        self.regs[idx[write], rc[write]] = out[write] % 256
+        write = op == asm.INS_IMM
+        self.regs[idx[write], rc[write]] = imm[write]
+
+        # Jumps use the flags from the previous instruction
+        jmp = (op == asm.INS_JMP) | (op == asm.INS_JMPI)
+        if jmp.any():
+            taken = np.zeros(len(idx), dtype=bool)
+            taken[jmp] = self.jmp_cond(idx[jmp], rc[jmp])
+            target = np.where(op == asm.INS_JMP, out % 256, imm)
+            self.iptr[idx[taken]] = target[taken]
+
+        ld = op == asm.INS_LD
+        if ld.any():
+            lidx = idx[ld]
+            addr = self.regs[lidx, 7]
+            vals = self.ram[lidx, addr].astype(np.int32)
+            hw = self.is_hw[addr]
+            for j in np.flatnonzero(hw).tolist():
+                vals[j] = self.do_load(int(lidx[j]), int(addr[j]))
+            self.regs[lidx, rc[ld]] = vals
+
+        st = (op == asm.INS_ST) | (op == asm.INS_STI)
+        if st.any():
+            sidx = idx[st]
+            addr = self.regs[sidx, 7]
+            vals = np.where(op[st] == asm.INS_ST, out[st] % 256, imm[st])
+            hw = self.is_hw[addr]
+            self.ram[sidx[~hw], addr[~hw]] = vals[~hw]
+            for j in np.flatnonzero(hw).tolist():
+                self.do_store(int(sidx[j]), int(addr[j]), int(vals[j]))
+
+        rand = op == asm.INS_RAND
+        if rand.any():
+            for i, r in zip(idx[rand].tolist(), rc[rand].tolist()):
+                self.regs[i, r] = self.rngs[i].randint(0, 255)
+
+        self.halted[idx[op == asm.INS_HALT]] = True
+
+        # Instructions which don't produce a value have an output of 0,
+        # and the I-format instructions have 0 as their A and B too
+        self.cflag[idx] = (out & 0b100000000) >> 8
+        self.sflag[idx] = (out & 0b10000000) >> 7
+        self.zflag[idx] = (out & 0b11111111) == 0
+        sa = a & 0b10000000
+        self.oflag[idx] = (sa == (b & 0b10000000)) & (sa != (out & 0b10000000))
+
+        return len(idx)
+
+    def run(self, max_steps=None):
+        steps = 0
+        while max_steps is None or steps < max_steps:
+            if self.step() == 0:
+                break
+            steps += 1
+        return steps
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("infile", help="Input file to execute")
+    parser.add_argument("-n", type=int, default=1000, help="Number of instances")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the first instance")
+    parser.add_argument("--max-steps", type=int, default=None, help="Maximum number of steps")
+    args = parser.parse_args()
+
+    batch = BatchCPU(args.n, range(args.seed, args.seed + args.n))
+    with open(args.infile, "rb") as f:
+        try:
+            batch.load_program(f.read())
+        except Exception as ex:
+            print(args.infile + ": " + str(ex))
+            exit(1)
+
+    steps = batch.run(args.max_steps)
+    print("Steps:", steps)
+    print("Halted:", int(batch.halted.sum()), "/", args.n)
+    print("Faulted:", int(batch.faulted.sum()), "/", args.n)
+    print("Cycles: min", int(batch.cycles.min()), "max", int(batch.cycles.max()))
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+# Throughput benchmarks for the assembler, emulator and schematic generator.
+#
+#   bench.py run [-o results.json]
+#   bench.py compare baseline.json results.json
+#
+# Every benchmark reports a rate (higher is better). Each one is repeated
+# a few times and the best rate is kept, to filter out noise.
+
+import assembler as asm
+import emulator
+import schemgen
+import glob
+import gzip
+import io
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+
+# Programs which never halt are stopped after this many cycles
+EMULATOR_MAX_CYCLES = 100000
+
+def measure(func, min_time, repeats):
+    best = 0
+    for i in range(0, repeats):
+        count = 0
+        start = time.perf_counter()
+        while True:
+            count += func()
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = max(best, count / elapsed)
+    return best
+
+def example_sources():
+    sources = {}
+    for path in sorted(glob.glob(os.path.join(EXAMPLES_DIR, "*.s"))):
+        with open(path, "r") as f:
+            sources[os.path.basename(path)] = f.read()
+    return sources
+
+def assemble(source):
+    out = io.BytesIO()
+    asm.assemble(io.StringIO(source), out)
+    return out.getvalue()
+
+# A large program using every kind of instruction and operand.
+# It's only ever assembled, so it doesn't need to fit in 256 bytes,
+# but label values must, so all jumps go to the start.
+def synthetic_source(lines, seed=1):
+    rng = random.Random(seed)
+    out = ["def answer 42", "def small -3", "start:"]
+    regs = ["r" + str(i) for i in range(0, 8)]
+    alu = ["add", "sub", "xor", "nand", "or", "and", "shr", "addc", "subc", "shrc", "cmpc"]
+    imms = ["answer", "0xff", "0b101", "'a'", "'\\n'"]
+    for i in range(0, lines):
+        kind = rng.randrange(0, 8)
+        if kind < 4:
+            b = rng.choice(regs + ["small", "7", "-8", "0x3"])
+            out.append(f"\t{rng.choice(alu)} {rng.choice(regs)} {rng.choice(regs)} {b}")
+        elif kind == 4:
+            out.append(f"\tmov {rng.choice(regs)} {rng.choice(imms)}")
+        elif kind == 5:
+            out.append(f"\t{rng.choice(['jmp', 'jeq', 'jgt', 'jge', 'jgts', 'jges'])} start")
+        elif kind == 6:
+            out.append(f"\tst {rng.choice(regs)} # store")
+        else:
+            out.append(f"\tcmp {rng.choice(regs)} 1")
+    return "\n".join(out) + "\n"
+
+def bench_assembler(results, min_time, repeats):
+    sources = example_sources()
+    sources["synthetic-10k"] = synthetic_source(10000)
+    for name, source in sources.items():
+        lines = source.count("\n")
+        def func():
+            assemble(source)
+            return lines
+        results["assembler/" + name] = (measure(func, min_time, repeats), "lines/s")
+
+def bench_emulator(results, min_time, repeats):
+    for name, source in example_sources().items():
+        bs = assemble(source)
+        for engine in ("interp", "predecode", "block"):
+            def func():
+                cpu = emulator.CPU(
+                        predecode=engine != "interp", blocks=engine == "block",
+                        rng=random.Random(0))
+                cpu.load_program(bs)
+                emulator.attach_displays(cpu, "headless")
+                return cpu.run(EMULATOR_MAX_CYCLES).cycles
+            results[f"emulator/{engine}/{name}"] = (measure(func, min_time, repeats), "instrs/s")
+
+def bench_disassemble(results, min_time, repeats):
+    pairs = []
+    for name, source in example_sources().items():
+        bs = assemble(source)
+        for i in range(0, len(bs) - 1, 2):
+            try:
+                emulator.disassemble(bs[i], bs[i + 1])
+                pairs.append((bs[i], bs[i + 1]))
+            except Exception:
+                pass
+
+    def func():
+        for hi, lo in pairs:
+            emulator.disassemble(hi, lo)
+        return len(pairs)
+    results["disassemble"] = (measure(func, min_time, repeats), "calls/s")
+
+def bench_schemgen(results, min_time, repeats):
+    rom = bytes(random.Random(1).randrange(0, 256) for i in range(0, 255))
+    def func():
+        with gzip.GzipFile(fileobj=io.BytesIO(), mode="wb") as f:
+            schemgen.write_rom(f, rom)
+        return len(rom)
+    results["schemgen/write_rom"] = (measure(func, min_time, repeats), "bytes/s")
+
+BENCHMARKS = {
+    "assembler": bench_assembler,
+    "emulator": bench_emulator,
+    "disassemble": bench_disassemble,
+    "schemgen": bench_schemgen,
+}
+
+def run(names, min_time, repeats):
+    results = {}
+    for name in names:
+        BENCHMARKS[name](results, min_time, repeats)
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "min_time": min_time,
+            "repeats": repeats,
+        },
+        "results": {key: {"value": val, "unit": unit} for key, (val, unit) in results.items()},
+    }
+
+# Returns the number of regressions: results which are slower than
+# the baseline by more than 'threshold' (as a fraction)
+def compare(baseline, current, threshold, f=sys.stdout):
+    regressions = 0
+    for key in sorted(set(baseline["results"]) | set(current["results"])):
+        if key not in baseline["results"]:
+            f.write(f"  {key}: new\n")
+            continue
+        if key not in current["results"]:
+            f.write(f"  {key}: missing\n")
+            continue
+
+        old = baseline["results"][key]["value"]
+        new = current["results"][key]["value"]
+        change = (new - old) / old if old > 0 else 0
+        mark = ""
+        if change < -threshold:
+            mark = "  REGRESSION"
+            regressions += 1
+        elif change > threshold:
+            mark = "  improved"
+        unit = current["results"][key]["unit"]
+        f.write(f"  {key}: {old:.0f} -> {new:.0f} {unit} ({change * 100:+.1f}%){mark}\n")
+
+    return regressions
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    runparser = sub.add_parser("run", help="Run the benchmarks")
+    runparser.add_argument("-o", "--output", default=None, help="Write results to this JSON file")
+    runparser.add_argument(
+            "-b", "--bench", action="append", choices=sorted(BENCHMARKS), default=None,
+            help="Only run these benchmarks (may be given multiple times)")
+    runparser.add_argument("--min-time", type=float, default=0.2, help="Minimum seconds per measurement")
+    runparser.add_argument("--repeats", type=int, default=3, help="Measurements per benchmark")
+    runparser.add_argument("--baseline", default=None, help="Compare against this results file")
+    runparser.add_argument("--threshold", type=float, default=0.1, help="Slowdown fraction counted as a regression")
+
+    cmpparser = sub.add_parser("compare", help="Compare results against a baseline")
+    cmpparser.add_argument("baseline", help="Baseline results file")
+    cmpparser.add_argument("current", help="Current results file")
+    cmpparser.add_argument("--threshold", type=float, default=0.1, help="Slowdown fraction counted as a regression")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        current = run(args.bench or list(BENCHMARKS), args.min_time, args.repeats)
+        for key, res in current["results"].items():
+            print(f"  {key}: {res['value']:.0f} {res['unit']}")
+        if args.output is not None:
+            with open(args.output, "w") as f:
+                json.dump(current, f, indent=1)
+                f.write("\n")
+        if args.baseline is None:
+            exit(0)
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+    else:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        with open(args.current, "r") as f:
+            current = json.load(f)
+
+    print("Comparison:")
+    regressions = compare(baseline, current, args.threshold)
+    if regressions > 0:
+        print(f"{regressions} regression(s)")
+        exit(1)
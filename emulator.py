@@ -1,81 +1,43 @@
 #!/usr/bin/env python3
 
 import assembler as asm
+import schemgen
+import tracefile
 import time
 import random
+import struct
+import sys
+import io
+import os
+import csv
+import json
+import mmap
+import multiprocessing
 
-def disassemble(hi, lo):
+OP_NAMES = {
+    asm.INS_NOP: "nop", asm.INS_ADD: "add", asm.INS_SUB: "sub",
+    asm.INS_XOR: "xor", asm.INS_NAND: "nand", asm.INS_OR: "or",
+    asm.INS_AND: "and", asm.INS_SHR: "shr", asm.INS_CMP: "cmp",
+    asm.INS_JMP: "jmp", asm.INS_LD: "ld", asm.INS_ST: "st",
+    asm.INS_ADDC: "addc", asm.INS_SUBC: "subc", asm.INS_SHRC: "shrc",
+    asm.INS_CMPC: "cmpc", asm.INS_JMPI: "jmpi", asm.INS_IMM: "imm",
+    asm.INS_STI: "sti", asm.INS_RAND: "rand", asm.INS_HALT: "halt",
+}
+
+JUMP_NAMES = ["jmp", "jeq", "jgt", "jge", "jgts", "jges"]
+
+def disassemble_uncached(hi, lo):
     op = (hi & 0b11111000) >> 3
     rc = (hi & 0b00000111)
 
-    if op == asm.INS_NOP:
-        name = "nop"
-    elif op == asm.INS_ADD:
-        name = "add"
-    elif op == asm.INS_SUB:
-        name = "sub"
-    elif op == asm.INS_XOR:
-        name = "xor"
-    elif op == asm.INS_NAND:
-        name = "nand"
-    elif op == asm.INS_OR:
-        name = "or"
-    elif op == asm.INS_AND:
-        name = "and"
-    elif op == asm.INS_SHR:
-        name = "shr"
-    elif op == asm.INS_CMP:
-        name = "cmp"
-    elif op == asm.INS_JMP:
-        if rc == asm.JC_ALWAYS:
-            name = "jmp"
-        elif rc == asm.JC_JEQ:
-            name = "jeq"
-        elif rc == asm.JC_JGT:
-            name = "jgt"
-        elif rc == asm.JC_JGE:
-            name = "jge"
-        elif rc == asm.JC_JGTS:
-            name = "jgts"
-        elif rc == asm.JC_JGES:
-            name = "jges"
-        else:
+    if op == asm.INS_JMP or op == asm.INS_JMPI:
+        if rc >= len(JUMP_NAMES):
             raise Exception("Illegal jump condition: " + hex(rc))
-    elif op == asm.INS_LD:
-        name = "ld"
-    elif op == asm.INS_ST:
-        name = "st"
-    elif op == asm.INS_ADDC:
-        name = "addc"
-    elif op == asm.INS_SUBC:
-        name = "subc"
-    elif op == asm.INS_SHRC:
-        name = "shrc"
-    elif op == asm.INS_CMPC:
-        name = "cmpc"
-    elif op == asm.INS_JMPI:
-        if rc == asm.JC_ALWAYS:
-            name = "jmpi"
-        elif rc == asm.JC_JEQ:
-            name = "jeqi"
-        elif rc == asm.JC_JGT:
-            name = "jgti"
-        elif rc == asm.JC_JGE:
-            name = "jgei"
-        elif rc == asm.JC_JGTS:
-            name = "jgtsi"
-        elif rc == asm.JC_JGES:
-            name = "jgesi"
-        else:
-            raise Exception("Illegal jump condition: " + hex(rc))
-    elif op == asm.INS_IMM:
-        name = "imm"
-    elif op == asm.INS_STI:
-        name = "sti"
-    elif op == asm.INS_HALT:
-        name = "halt"
-    elif op == asm.INS_RAND:
-        name = "rand"
+        name = JUMP_NAMES[rc]
+        if op == asm.INS_JMPI:
+            name += "i"
+    elif op in OP_NAMES:
+        name = OP_NAMES[op]
     else:
         raise Exception("Illegal instruction: " + hex(op))
 
@@ -90,28 +52,465 @@ def disassemble(hi, lo):
         else:
             return f"{name} r{rc} r{ra} r{rb}"
 
-class CPU:
+# The disassembly of every (hi, lo) pair, indexed by (hi << 8) | lo,
+# or None for illegal instructions. Built on first use.
+disasm_table = None
+
+def build_disasm_table():
+    table = []
+    for hi in range(0, 256):
+        for lo in range(0, 256):
+            try:
+                table.append(disassemble_uncached(hi, lo))
+            except Exception:
+                table.append(None)
+    return table
+
+def disassemble(hi, lo):
+    global disasm_table
+    if disasm_table is None:
+        disasm_table = build_disasm_table()
+
+    text = disasm_table[(hi << 8) | lo]
+    if text is None:
+        disassemble_uncached(hi, lo) # Raises the appropriate exception
+    return text
+
+# Returns the assembler source for an instruction, or None if the assembler
+# has no way to express that exact encoding. 'target' formats jump targets.
+def disassemble_source(hi, lo, target=str):
+    op = (hi & 0b11111000) >> 3
+    rc = (hi & 0b00000111)
+    isel = (lo & 0b10000000) >> 7
+    ra =   (lo & 0b01110000) >> 4
+    rb =   (lo & 0b00001111)
+
+    if op == asm.INS_JMPI and rc < len(JUMP_NAMES):
+        return f"{JUMP_NAMES[rc]} {target(lo)}"
+    elif op == asm.INS_IMM:
+        return f"mov r{rc} {lo}"
+    elif op == asm.INS_STI and rc == 0:
+        return f"st {lo}"
+
+    if isel:
+        b = str(rb - 16 if rb & 0b1000 else rb)
+    elif rb & 0b1000:
+        return None
+    else:
+        b = f"r{rb}"
+
+    if op in asm.ALU_OPS.values():
+        name = [name for name, val in asm.ALU_OPS.items() if val == op][0]
+        return f"{name} r{rc} r{ra} {b}"
+    elif op == asm.INS_CMP and rc == 0:
+        return f"cmp r{ra} {b}"
+    elif op == asm.INS_JMP and rc < len(JUMP_NAMES):
+        return f"{JUMP_NAMES[rc]} r{ra} {b}"
+    elif op == asm.INS_ST and rc == 0:
+        return f"st r{ra} {b}"
+    elif op == asm.INS_LD and lo == 0:
+        return f"ld r{rc}"
+    elif op == asm.INS_RAND and lo == 0:
+        return f"rand r{rc}"
+    elif op == asm.INS_HALT and rc == 0 and lo == 0:
+        return "halt"
+    else:
+        return None
+
+# Find the addresses of instructions reachable from the entry points,
+# and the targets of immediate jumps
+def trace_code(bs, entries=(0,)):
+    code = set()
+    targets = set()
+    work = list(entries)
+    while len(work) > 0:
+        addr = work.pop()
+        if addr in code or addr + 1 >= len(bs):
+            continue
+        hi, lo = bs[addr], bs[addr + 1]
+        try:
+            disassemble(hi, lo)
+        except Exception:
+            continue
+        code.add(addr)
+
+        op = (hi & 0b11111000) >> 3
+        rc = (hi & 0b00000111)
+        if op == asm.INS_JMPI:
+            targets.add(lo)
+            work.append(lo)
+            if rc == asm.JC_ALWAYS:
+                continue
+        elif op == asm.INS_JMP and rc == asm.JC_ALWAYS:
+            continue
+        elif op == asm.INS_HALT:
+            continue
+        work.append(addr + 2)
+    return code, targets
+
+# Disassemble a whole image into assembler source which reassembles to the
+# same bytes. Code is found by following control flow from the entry points;
+# everything else is emitted as 'byte' directives. Targets of immediate jumps
+# get labels, named from 'labels' (a name -> address dict) when available.
+def disassemble_image(bs, entries=(0,), labels=None):
+    code, targets = trace_code(bs, entries)
+
+    # Labels past the end of the image can't be emitted
+    names = {}
+    if labels is not None:
+        for name, addr in labels.items():
+            if addr <= len(bs):
+                names.setdefault(addr, name)
+
+    # Generated names mustn't collide with any of the given labels
+    taken = set(labels) if labels is not None else set()
+    for addr in sorted(targets):
+        if addr < len(bs) and addr not in names:
+            name = f"l{addr}"
+            while name in taken:
+                name += "_"
+            taken.add(name)
+            names[addr] = name
+
+    def target(addr):
+        return names.get(addr, str(addr))
+
+    lines = []
+    addr = 0
+    while addr < len(bs):
+        if addr in names:
+            lines.append(names[addr] + ":")
+
+        if addr in code and addr + 1 not in names:
+            text = disassemble_source(bs[addr], bs[addr + 1], target)
+            if text is not None:
+                lines.append(f"\t{text}")
+                addr += 2
+                continue
+            # The assembler can't produce this exact encoding
+            lines.append(f"\tbyte {bs[addr]} # {disassemble(bs[addr], bs[addr + 1])}")
+            lines.append(f"\tbyte {bs[addr + 1]}")
+            addr += 2
+            continue
+
+        comment = ""
+        if 32 <= bs[addr] < 127:
+            comment = f" # {chr(bs[addr])!r}"
+        lines.append(f"\tbyte {bs[addr]}{comment}")
+        addr += 1
+
+    if len(bs) in names:
+        lines.append(names[len(bs)] + ":")
+
+    return "\n".join(lines) + "\n"
+
+# Raised for illegal instructions and jump conditions,
+# which stop the CPU like a hardware fault would
+class IllegalInstruction(Exception):
+    pass
+
+# The memory bus maps each of the 256 addresses either to RAM, or to the
+# devices attached there. The per-address table is rebuilt when a device
+# is attached, so loads and stores never have to search for devices.
+#
+# Devices attached to a single address implement read() and write(val).
+# Devices covering a range of addresses implement read_at(offset) and
+# write_at(offset, val), where offset is relative to the start of the range.
+# When several devices share an address, writes go to all of them, and
+# their reads are OR-combined.
+class Bus:
     def __init__(self):
+        self.ram = bytearray(256)
+        self.devices = []
+        self.table = [None] * 256
+
+    def attach(self, addr, hw, size=1):
+        if addr < 0 or size < 1 or addr + size > 256:
+            raise Exception("Device range out of bounds: " + str(addr) + "+" + str(size))
+
+        self.devices.append((addr, size, hw))
+        self.build_table()
+
+    def build_table(self):
+        readers = {}
+        writers = {}
+        for start, size, hw in self.devices:
+            if size == 1 and not hasattr(hw, "read_at"):
+                readers.setdefault(start, []).append(hw.read)
+                writers.setdefault(start, []).append(hw.write)
+                continue
+
+            for offset in range(0, size):
+                readers.setdefault(start + offset, []).append(
+                        lambda hw=hw, offset=offset: hw.read_at(offset))
+                writers.setdefault(start + offset, []).append(
+                        lambda val, hw=hw, offset=offset: hw.write_at(offset, val))
+
+        # Updated in place, since profilers hold on to the table while running
+        self.table[:] = [None] * 256
+        for addr in readers:
+            self.table[addr] = (tuple(readers[addr]), tuple(writers[addr]))
+
+    def load(self, addr):
+        entry = self.table[addr]
+        if entry is None:
+            return self.ram[addr]
+
+        val = 0
+        for read in entry[0]:
+            val |= read()
+        return val
+
+    # Copy the bus with the same RAM contents. 'devices' maps the devices
+    # attached to this bus to the ones the copy should use instead.
+    def fork(self, devices=None):
+        if devices is None:
+            devices = {}
+        bus = Bus()
+        bus.ram[:] = self.ram
+        bus.devices = [(addr, size, devices.get(hw, hw)) for addr, size, hw in self.devices]
+        if len(devices) == 0:
+            bus.table = list(self.table)
+        else:
+            bus.build_table()
+        return bus
+
+    # Returns True if the value went to RAM rather than to devices
+    def store(self, addr, val):
+        entry = self.table[addr]
+        if entry is None:
+            self.ram[addr] = val
+            return True
+
+        for write in entry[1]:
+            write(val)
+        return False
+
+STOP_HALTED = "halted"
+STOP_BUDGET = "budget"
+STOP_BREAKPOINT = "breakpoint"
+STOP_ILLEGAL = "illegal"
+STOP_WATCHPOINT = "watchpoint"
+STOP_LOOP = "loop"
+
+# Why CPU.run() returned, and where. For breakpoints and exhausted budgets,
+# iptr is the address of the next instruction; for halts and illegal
+# instructions, it's the address of the instruction which stopped the CPU.
+class StopReason:
+    def __init__(self, kind, cpu, iptr=None, message=None):
+        self.kind = kind
+        self.iptr = cpu.iptr if iptr is None else iptr
+        self.cycles = cpu.cycles
+        self.message = message
+
+    def __str__(self):
+        if self.kind == STOP_HALTED:
+            return f"halted at {self.iptr} after {self.cycles} cycles"
+        elif self.kind == STOP_BUDGET:
+            return f"cycle budget exhausted at {self.iptr} after {self.cycles} cycles"
+        elif self.kind == STOP_BREAKPOINT:
+            return f"breakpoint at {self.iptr} after {self.cycles} cycles"
+        elif self.kind == STOP_LOOP:
+            return f"infinite loop detected at {self.iptr} after {self.cycles} cycles"
+        elif self.kind == STOP_WATCHPOINT:
+            return f"watchpoint at {self.iptr} after {self.cycles} cycles: {self.message}"
+        else:
+            return f"{self.message} (after {self.cycles} cycles)"
+
+# Detects when a deterministic program can never halt, because it got back
+# to a state it was in before. It uses Brent's cycle detection on the states
+# CPU.run() sees between instructions or blocks: a saved state is compared
+# against, and replaced after 1, 2, 4, 8... checks. Only the iptr is compared
+# until it matches, so most checks are cheap.
+# RAND and reads from devices make the program nondeterministic, so they
+# reset the detector, which starts over after them.
+class LoopDetector:
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.reset()
+
+        # Watch RAND and device reads through the CPU's RNG and do_load
+        self.saved = (cpu.rng, cpu.__dict__.get("do_load"))
+        self.cpu_load = cpu.do_load
+        self.rng = cpu.rng
+        cpu.rng = self
+        cpu.do_load = self.do_load
+
+    def close(self):
+        cpu = self.cpu
+        cpu.rng, load = self.saved
+        if load is None:
+            del cpu.do_load
+        else:
+            cpu.do_load = load
+
+    def reset(self):
+        self.state = None
+        self.state_iptr = None
+        self.power = 1
+        self.steps = 0
+
+    def randint(self, a, b):
+        self.reset()
+        return self.rng.randint(a, b)
+
+    def getstate(self):
+        return self.rng.getstate()
+
+    def setstate(self, state):
+        self.rng.setstate(state)
+
+    def do_load(self, addr):
+        if self.cpu.bus.table[addr] is not None:
+            self.reset()
+        return self.cpu_load(addr)
+
+    # Everything except the cycle count
+    def current(self):
+        return self.cpu.core_state()[:-8]
+
+    # Returns True if the CPU is in a state it has been in before
+    def check(self, iptr):
+        self.steps += 1
+        if iptr == self.state_iptr and self.current() == self.state:
+            return True
+        if self.steps == self.power:
+            self.state = self.current()
+            self.state_iptr = iptr
+            self.power *= 2
+            self.steps = 0
+        return False
+
+class CPU:
+    def __init__(self, predecode=True, blocks=True, rng=None):
         self.regs = [0] * 8
-        self.ram = [0] * 256
+        self.bus = Bus()
+        self.ram = self.bus.ram
         self.hardware = []
         self.iptr = 0
         self.halted = False
-        self.cflag = 0
-        self.sflag = 0
-        self.zflag = 0
-        self.oflag = 0
+
+        # Flags are evaluated lazily: instructions only record the a, b and
+        # out values the flags come from in flag_args, and the cflag, sflag,
+        # zflag and oflag properties compute them when they're read.
+        # Assigning a flag directly switches to the values in flag_values
+        # until the next instruction.
+        self.flag_args = None
+        self.flag_values = [0, 0, 0, 0]
+
+        # Number of instructions executed so far,
+        # including the one currently executing
+        self.cycles = 0
+
+        # Source of random numbers for the RAND instruction.
+        # Defaults to the global random module, so random.seed() applies.
+        self.rng = random if rng is None else rng
+
+        # When predecode is set, step() dispatches through the handler table
+        # using the decoded form of each instruction slot. Otherwise, it uses
+        # step_interp(), which decodes every instruction from scratch.
+        self.predecode = predecode
+        self.decoded = [None] * 256
+
+        # Translated basic blocks for step_block(), indexed by start address,
+        # as (function, instruction addresses) tuples, and for each RAM address,
+        # the start addresses of the blocks which contain code from that address.
+        # run() only uses blocks if use_blocks is set.
+        self.use_blocks = blocks
+        self.blocks = [None] * 256
+        self.block_refs = [[] for i in range(0, 256)]
 
     def load_program(self, bs):
         if len(bs) >= 256:
             raise Exception("Program too big")
 
-        for i, b in enumerate(bs):
-            self.ram[i] = b
+        self.ram[0:len(bs)] = bytes(bs)
+        self.decoded = [None] * 256
+        self.blocks = [None] * 256
+        self.block_refs = [[] for i in range(0, 256)]
 
-    def add_hardware(self, addr, hw):
+    def add_hardware(self, addr, hw, size=1):
+        self.bus.attach(addr, hw, size)
         self.hardware.append((addr, hw))
 
+    # The RAM, registers, iptr, flags, halted and cycle count, packed into bytes
+    def core_state(self):
+        flags = self.cflag | (self.sflag << 1) | (self.zflag << 2) | (self.oflag << 3)
+        return bytes(self.ram) + bytes(self.regs) + struct.pack(
+                "<BBBQ", self.iptr, flags, self.halted, self.cycles)
+
+    # Snapshots are immutable tuples of:
+    # * The core state, packed into bytes: 256 bytes of RAM, 8 registers,
+    #   iptr, the flags, halted, and the cycle count
+    # * The RNG state
+    # * For each attached device, the result of its snapshot() method,
+    #   or None for devices which don't implement snapshot() and restore()
+    def snapshot(self):
+        core = self.core_state()
+
+        devices = []
+        for addr, hw in self.hardware:
+            if hasattr(hw, "snapshot"):
+                devices.append(hw.snapshot())
+            else:
+                devices.append(None)
+
+        return (core, self.rng.getstate(), tuple(devices))
+
+    def restore(self, snap):
+        core, rngstate, devices = snap
+        if len(devices) != len(self.hardware):
+            raise Exception("Snapshot has a different set of devices")
+
+        self.ram[0:256] = core[0:256]
+        self.regs[:] = core[256:264]
+        iptr, flags, halted, cycles = struct.unpack("<BBBQ", core[264:])
+        self.iptr = iptr
+        self.cflag = flags & 1
+        self.sflag = (flags >> 1) & 1
+        self.zflag = (flags >> 2) & 1
+        self.oflag = (flags >> 3) & 1
+        self.halted = halted != 0
+        self.cycles = cycles
+        self.rng.setstate(rngstate)
+
+        for (addr, hw), state in zip(self.hardware, devices):
+            if state is not None:
+                hw.restore(state)
+
+        self.decoded = [None] * 256
+        self.blocks = [None] * 256
+        self.block_refs = [[] for i in range(0, 256)]
+
+    # Create a new CPU in the same state, sharing nothing mutable with this one
+    # except for devices which don't implement fork(cpu). The new CPU gets its
+    # own RNG, starting from this CPU's RNG state. The decoded instructions
+    # and translated blocks are carried over, so the fork starts out warm.
+    def fork(self):
+        rng = random.Random()
+        rng.setstate(self.rng.getstate())
+        cpu = CPU(self.predecode, self.use_blocks, rng)
+
+        devices = {}
+        for addr, size, hw in self.bus.devices:
+            if hasattr(hw, "fork") and hw not in devices:
+                devices[hw] = hw.fork(cpu)
+        cpu.bus = self.bus.fork(devices)
+        cpu.ram = cpu.bus.ram
+        cpu.hardware = [(addr, devices.get(hw, hw)) for addr, hw in self.hardware]
+
+        cpu.regs = list(self.regs)
+        cpu.iptr = self.iptr
+        cpu.halted = self.halted
+        cpu.flag_args = self.flag_args
+        cpu.flag_values = list(self.flag_values)
+        cpu.cycles = self.cycles
+
+        cpu.decoded = list(self.decoded)
+        cpu.blocks = list(self.blocks)
+        cpu.block_refs = [list(refs) for refs in self.block_refs]
+        return cpu
+
     def jmp_cond(self, cond):
         if cond == asm.JC_ALWAYS:
             return True
@@ -126,34 +525,407 @@ class CPU:
         elif cond == asm.JC_JGES:
             return self.oflag == self.sflag
         else:
-            raise Exception("Illegal jump condition: " + hex(cond))
+            raise IllegalInstruction("Illegal jump condition: " + hex(cond))
 
     def do_load(self, addr):
-        val = 0
-        did_load = False
-        for hwaddr, hw in self.hardware:
-            if hwaddr == addr:
-                val |= hw.read()
-                did_load = True
-
-        if did_load:
-            return val
-        else:
-            return self.ram[addr]
+        return self.bus.load(addr)
 
     def do_store(self, addr, val):
-        did_store = False
-        for hwaddr, hw in self.hardware:
-            if hwaddr == addr:
-                hw.write(val)
-                did_store = True
+        if self.bus.store(addr, val):
+            self.decoded[addr] = None
+            self.decoded[(addr - 1) % 256] = None
+            if self.block_refs[addr]:
+                self.invalidate_blocks(addr)
 
-        if did_store:
-            return
+    def invalidate_blocks(self, addr):
+        for start in self.block_refs[addr]:
+            self.blocks[start] = None
+        self.block_refs[addr] = []
+
+    def translate(self, iptr):
+        block = translate_block(self.ram, iptr)
+        if block is None:
+            return None
+
+        self.blocks[iptr] = block
+        for addr in block[1]:
+            self.block_refs[addr].append(iptr)
+            self.block_refs[(addr + 1) % 256].append(iptr)
+        return block
+
+    def step_block(self):
+        block = self.blocks[self.iptr]
+        if block is None:
+            block = self.translate(self.iptr)
+            if block is None:
+                # The block starts with an illegal instruction;
+                # let step() raise the appropriate exception
+                self.step()
+                return 1
+
+        return block[0](self)
+
+    # Run until the CPU halts or hits an illegal instruction, the cycle budget
+    # runs out, or execution reaches one of the breakpoints or until_addr.
+    # Breakpoints are checked before executing the instruction at that address,
+    # except for the first instruction, so that a run can be resumed
+    # from a breakpoint.
+    # With 'detect_loops', stops when the program gets back into a state
+    # it was in before (see LoopDetector)
+    def run(self, max_cycles=None, breakpoints=(), until_addr=None, detect_loops=False):
+        stops = set(breakpoints)
+        if until_addr is not None:
+            stops.add(until_addr)
+
+        end = None
+        if max_cycles is not None:
+            end = self.cycles + max_cycles
+
+        # Blocks which contain a stop address after their first instruction
+        # must be single-stepped
+        unsafe = {}
+
+        detector = None
+        if detect_loops:
+            detector = LoopDetector(self)
+
+        first = True
+        try:
+            while not self.halted:
+                iptr = self.iptr
+                if stops and not first and iptr in stops:
+                    return StopReason(STOP_BREAKPOINT, self)
+                if end is not None and self.cycles >= end:
+                    return StopReason(STOP_BUDGET, self)
+                if detector is not None and detector.check(iptr):
+                    return StopReason(STOP_LOOP, self)
+                first = False
+
+                if not self.use_blocks:
+                    self.step()
+                    continue
+
+                block = self.blocks[iptr]
+                if block is None:
+                    block = self.translate(iptr)
+                    if block is None:
+                        self.step()
+                        continue
+
+                if end is not None and self.cycles + len(block[1]) > end:
+                    self.step()
+                    continue
+
+                if stops:
+                    skip = unsafe.get(block)
+                    if skip is None:
+                        skip = any(addr in stops for addr in block[1][1:])
+                        unsafe[block] = skip
+                    if skip:
+                        self.step()
+                        continue
+
+                block[0](self)
+        except IllegalInstruction as ex:
+            return StopReason(STOP_ILLEGAL, self, (self.iptr - 2) % 256, str(ex))
+        finally:
+            if detector is not None:
+                detector.close()
+
+        return StopReason(STOP_HALTED, self, (self.iptr - 2) % 256)
+
+    def decode(self, iptr):
+        hi = self.ram[iptr]
+        lo = self.ram[(iptr + 1) % 256]
+
+        op = (hi & 0b11111000) >> 3
+        rc = (hi & 0b00000111)
+
+        handler = self.handlers[op]
+        if handler is None:
+            handler = CPU.exec_illegal
+            rc = op
+        elif op == asm.INS_JMP or op == asm.INS_JMPI:
+            if rc < len(self.conds):
+                rc = self.conds[rc]
+            else:
+                handler = CPU.exec_illegal_cond
+
+        if op >= asm.INS_IMM_START and op <= asm.INS_IMM_END:
+            instr = (handler, rc, 0, None, lo)
         else:
-            self.ram[addr] = val
+            isel = (lo & 0b10000000) >> 7
+            ra =   (lo & 0b01110000) >> 4
+            rb =   (lo & 0b00001111)
+            if isel:
+                b = rb
+                if b & 0b1000:
+                    b |= 0b11111000
+                instr = (handler, rc, ra, None, b)
+            else:
+                instr = (handler, rc, ra, rb % 8, 0)
+
+        self.decoded[iptr] = instr
+        return instr
+
+    @property
+    def cflag(self):
+        args = self.flag_args
+        if args is None:
+            return self.flag_values[0]
+        return (args[2] & 0b100000000) >> 8
+
+    @property
+    def sflag(self):
+        args = self.flag_args
+        if args is None:
+            return self.flag_values[1]
+        return (args[2] & 0b10000000) >> 7
+
+    @property
+    def zflag(self):
+        args = self.flag_args
+        if args is None:
+            return self.flag_values[2]
+        return 1 if (args[2] & 0b11111111) == 0 else 0
+
+    @property
+    def oflag(self):
+        args = self.flag_args
+        if args is None:
+            return self.flag_values[3]
+        a, b, out = args
+        overflowed = a & 0b10000000 == b & 0b10000000 and a & 0b10000000 != out & 0b10000000
+        return 1 if overflowed else 0
+
+    def set_flag(self, index, val):
+        if self.flag_args is not None:
+            self.flag_values = [self.cflag, self.sflag, self.zflag, self.oflag]
+            self.flag_args = None
+        self.flag_values[index] = val
+
+    @cflag.setter
+    def cflag(self, val):
+        self.set_flag(0, val)
+
+    @sflag.setter
+    def sflag(self, val):
+        self.set_flag(1, val)
+
+    @zflag.setter
+    def zflag(self, val):
+        self.set_flag(2, val)
+
+    @oflag.setter
+    def oflag(self, val):
+        self.set_flag(3, val)
 
     def step(self):
+        self.cycles += 1
+        if not self.predecode:
+            self.step_interp()
+            return
+
+        iptr = self.iptr
+        instr = self.decoded[iptr]
+        if instr is None:
+            instr = self.decode(iptr)
+        self.iptr = (iptr + 2) % 256
+        instr[0](self, instr)
+
+    # Instruction handlers, indexed by opcode through CPU.handlers.
+    # Each one gets the decoded instruction tuple (handler, rc, ra, rb, b),
+    # where rb is None if B is an immediate (or for I-format instructions,
+    # where b is the 8-bit immediate and ra is unused).
+
+    def exec_nop(self, instr):
+        _, rc, ra, rb, b = instr
+        a = self.regs[ra]
+        if rb is not None:
+            b = self.regs[rb]
+        self.flag_args = (a, b, 0)
+
+    def exec_add(self, instr):
+        _, rc, ra, rb, b = instr
+        a = self.regs[ra]
+        if rb is not None:
+            b = self.regs[rb]
+        out = a + b
+        self.regs[rc] = out % 256
+        self.flag_args = (a, b, out)
+
+    def exec_sub(self, instr):
+        _, rc, ra, rb, b = instr
+        a = self.regs[ra]
+        if rb is not None:
+            b = self.regs[rb]
+        b = 0b11111111 ^ b
+        out = a + b + 1
+        self.regs[rc] = out % 256
+        self.flag_args = (a, b, out)
+
+    def exec_xor(self, instr):
+        _, rc, ra, rb, b = instr
+        a = self.regs[ra]
+        if rb is not None:
+            b = self.regs[rb]
+        out = a ^ b
+        self.regs[rc] = out % 256
+        self.flag_args = (a, b, out)
+
+    def exec_nand(self, instr):
+        _, rc, ra, rb, b = instr
+        a = self.regs[ra]
+        if rb is not None:
+            b = self.regs[rb]
+        out = ~(a | b)
+        self.regs[rc] = out % 256
+        self.flag_args = (a, b, out)
+
+    def exec_or(self, instr):
+        _, rc, ra, rb, b = instr
+        a = self.regs[ra]
+        if rb is not None:
+            b = self.regs[rb]
+        out = (a | b)
+        self.regs[rc] = out % 256
+        self.flag_args = (a, b, out)
+
+    def exec_and(self, instr):
+        _, rc, ra, rb, b = instr
+        a = self.regs[ra]
+        if rb is not None:
+            b = self.regs[rb]
+        out = (a & b)
+        self.regs[rc] = out % 256
+        self.flag_args = (a, b, out)
+
+    def exec_shr(self, instr):
+        _, rc, ra, rb, b = instr
+        a = self.regs[ra]
+        if rb is not None:
+            b = self.regs[rb]
+        out = a + b
+        out >>= 1 | ((out & 0b1) << 8) # Put the shifted-out bit in cout
+        self.regs[rc] = out % 256
+        self.flag_args = (a, b, out)
+
+    def exec_cmp(self, instr):
+        _, rc, ra, rb, b = instr
+        a = self.regs[ra]
+        if rb is not None:
+            b = self.regs[rb]
+        b = 0b11111111 ^ b
+        out = a + b + 1
+        self.flag_args = (a, b, out)
+
+    def exec_jmp(self, instr):
+        _, cond, ra, rb, b = instr
+        a = self.regs[ra]
+        if rb is not None:
+            b = self.regs[rb]
+        out = a + b
+        if cond(self):
+            self.iptr = out % 256
+        self.flag_args = (a, b, out)
+
+    def exec_ld(self, instr):
+        _, rc, ra, rb, b = instr
+        a = self.regs[ra]
+        if rb is not None:
+            b = self.regs[rb]
+        self.regs[rc] = self.do_load(self.regs[7])
+        self.flag_args = (a, b, 0)
+
+    def exec_st(self, instr):
+        _, rc, ra, rb, b = instr
+        a = self.regs[ra]
+        if rb is not None:
+            b = self.regs[rb]
+        out = a + b
+        self.do_store(self.regs[7], out % 256)
+        self.flag_args = (a, b, out)
+
+    def exec_addc(self, instr):
+        _, rc, ra, rb, b = instr
+        a = self.regs[ra]
+        if rb is not None:
+            b = self.regs[rb]
+        out = a + b + self.cflag
+        self.regs[rc] = out % 256
+        self.flag_args = (a, b, out)
+
+    def exec_subc(self, instr):
+        _, rc, ra, rb, b = instr
+        a = self.regs[ra]
+        if rb is not None:
+            b = self.regs[rb]
+        b = 0b11111111 ^ b
+        out = a + b + self.cflag
+        self.regs[rc] = out % 256
+        self.flag_args = (a, b, out)
+
+    def exec_shrc(self, instr):
+        _, rc, ra, rb, b = instr
+        a = self.regs[ra]
+        if rb is not None:
+            b = self.regs[rb]
+        out = a + b
+        out >>= 1 | ((out & 0b1) << 8) # Put the shifted-out bit in cout
+        out |= self.cflag << 7 # Shifted-in number is carry flag
+        self.regs[rc] = out % 256
+        self.flag_args = (a, b, out)
+
+    def exec_cmpc(self, instr):
+        _, rc, ra, rb, b = instr
+        a = self.regs[ra]
+        if rb is not None:
+            b = self.regs[rb]
+        b = 0b11111111 ^ b
+        out = a + b + self.cflag
+        self.flag_args = (a, b, out)
+
+    def exec_jmpi(self, instr):
+        _, cond, ra, rb, imm = instr
+        if cond(self):
+            self.iptr = imm
+        self.flag_args = (0, 0, 0)
+
+    def exec_imm(self, instr):
+        _, rc, ra, rb, imm = instr
+        self.regs[rc] = imm
+        self.flag_args = (0, 0, 0)
+
+    def exec_sti(self, instr):
+        _, rc, ra, rb, imm = instr
+        self.do_store(self.regs[7], imm)
+        self.flag_args = (0, 0, 0)
+
+    def exec_rand(self, instr):
+        _, rc, ra, rb, b = instr
+        a = self.regs[ra]
+        if rb is not None:
+            b = self.regs[rb]
+        self.regs[rc] = self.rng.randint(0, 255)
+        self.flag_args = (a, b, 0)
+
+    def exec_halt(self, instr):
+        _, rc, ra, rb, b = instr
+        a = self.regs[ra]
+        if rb is not None:
+            b = self.regs[rb]
+        self.halted = True
+        self.flag_args = (a, b, 0)
+
+    def exec_illegal(self, instr):
+        iptr = (self.iptr - 2) % 256
+        raise IllegalInstruction("Illegal instruction at " + str(iptr) + ": " + hex(instr[1]))
+
+    def exec_illegal_cond(self, instr):
+        _, rc, ra, rb, b = instr
+        raise IllegalInstruction("Illegal jump condition: " + hex(rc))
+
+    def step_interp(self):
         hi = self.ram[self.iptr]
         lo = self.ram[(self.iptr + 1) % 256]
         iptr = self.iptr
@@ -239,97 +1011,1696 @@ class CPU:
         elif op == asm.INS_STI:
             self.do_store(self.regs[7], imm)
         elif op == asm.INS_RAND:
-            self.regs[rc] = random.randint(0, 255)
+            self.regs[rc] = self.rng.randint(0, 255)
         elif op == asm.INS_HALT:
             self.halted = True
         else:
-            raise Exception("Illegal instruction at " + str(iptr) + ": " + hex(op))
+            raise IllegalInstruction("Illegal instruction at " + str(iptr) + ": " + hex(op))
 
-        self.cflag = (out & 0b100000000) >> 8
-        self.sflag = (out & 0b10000000) >> 7
-        self.zflag = 1 if (out & 0b11111111) == 0 else 0
-        overflowed = a & 0b10000000 == b & 0b10000000 and a & 0b10000000 != out & 0b10000000
-        self.oflag = 1 if overflowed else 0
+        self.flag_args = (a, b, out)
+
+CPU.handlers = [None] * 32
+CPU.handlers[asm.INS_NOP] = CPU.exec_nop
+CPU.handlers[asm.INS_ADD] = CPU.exec_add
+CPU.handlers[asm.INS_SUB] = CPU.exec_sub
+CPU.handlers[asm.INS_XOR] = CPU.exec_xor
+CPU.handlers[asm.INS_NAND] = CPU.exec_nand
+CPU.handlers[asm.INS_OR] = CPU.exec_or
+CPU.handlers[asm.INS_AND] = CPU.exec_and
+CPU.handlers[asm.INS_SHR] = CPU.exec_shr
+CPU.handlers[asm.INS_CMP] = CPU.exec_cmp
+CPU.handlers[asm.INS_JMP] = CPU.exec_jmp
+CPU.handlers[asm.INS_LD] = CPU.exec_ld
+CPU.handlers[asm.INS_ST] = CPU.exec_st
+CPU.handlers[asm.INS_ADDC] = CPU.exec_addc
+CPU.handlers[asm.INS_SUBC] = CPU.exec_subc
+CPU.handlers[asm.INS_SHRC] = CPU.exec_shrc
+CPU.handlers[asm.INS_CMPC] = CPU.exec_cmpc
+CPU.handlers[asm.INS_JMPI] = CPU.exec_jmpi
+CPU.handlers[asm.INS_IMM] = CPU.exec_imm
+CPU.handlers[asm.INS_STI] = CPU.exec_sti
+CPU.handlers[asm.INS_RAND] = CPU.exec_rand
+CPU.handlers[asm.INS_HALT] = CPU.exec_halt
+
+# Jump condition checks, indexed by the condition code in the rc field
+CPU.conds = [None] * 6
+CPU.conds[asm.JC_ALWAYS] = lambda cpu: True
+CPU.conds[asm.JC_JEQ] = lambda cpu: cpu.zflag != 0
+CPU.conds[asm.JC_JGT] = lambda cpu: cpu.cflag != 0 and cpu.zflag == 0
+CPU.conds[asm.JC_JGE] = lambda cpu: cpu.cflag != 0
+CPU.conds[asm.JC_JGTS] = lambda cpu: cpu.zflag == 0 and cpu.oflag == cpu.sflag
+CPU.conds[asm.JC_JGES] = lambda cpu: cpu.oflag == cpu.sflag
+
+# The block translator turns a straight-line run of instructions into
+# the source code for one Python function, which executes the whole run
+# with registers and flags kept in local variables. Flags are only
+# computed when the next instruction reads them, or when they're the
+# final flags of the block.
+
+BLOCK_MAX_INSTRS = 64
+
+BLOCK_TERMINATORS = (
+        asm.INS_JMP, asm.INS_JMPI,
+        asm.INS_ST, asm.INS_STI, asm.INS_HALT)
+
+# Translated functions only depend on the start address and the code bytes,
+# so they're shared between all CPU instances. Every program brings its own
+# blocks, so the cache is emptied when it grows past BLOCK_CACHE_MAX, to bound
+# it when running many programs in one process. CPUs keep the blocks they
+# already use.
+BLOCK_CACHE_MAX = 4096
+block_cache = {}
+
+BLOCK_COND_EXPRS = {
+    asm.JC_ALWAYS: ("True", ""),
+    asm.JC_JEQ: ("z != 0", "z"),
+    asm.JC_JGT: ("c != 0 and z == 0", "cz"),
+    asm.JC_JGE: ("c != 0", "c"),
+    asm.JC_JGTS: ("z == 0 and o == s", "zos"),
+    asm.JC_JGES: ("o == s", "os"),
+}
+
+def block_flags_read(op, rc):
+    if op == asm.INS_ADDC or op == asm.INS_SUBC or op == asm.INS_SHRC or op == asm.INS_CMPC:
+        return "c"
+    elif op == asm.INS_JMP or op == asm.INS_JMPI:
+        return BLOCK_COND_EXPRS[rc][1]
+    else:
+        return ""
+
+def block_decode(ram, iptr):
+    hi = ram[iptr]
+    lo = ram[(iptr + 1) % 256]
+    op = (hi & 0b11111000) >> 3
+    rc = (hi & 0b00000111)
+
+    if CPU.handlers[op] is None:
+        return None
+    if (op == asm.INS_JMP or op == asm.INS_JMPI) and rc not in BLOCK_COND_EXPRS:
+        return None
+
+    if op >= asm.INS_IMM_START and op <= asm.INS_IMM_END:
+        return (op, rc, None, None, lo)
+
+    isel = (lo & 0b10000000) >> 7
+    ra =   (lo & 0b01110000) >> 4
+    rb =   (lo & 0b00001111)
+    if isel:
+        b = rb
+        if b & 0b1000:
+            b |= 0b11111000
+        return (op, rc, "r" + str(ra), str(b), None)
+    else:
+        return (op, rc, "r" + str(ra), "r" + str(rb % 8), None)
+
+def block_emit_flags(lines, flags, kind):
+    # kind is "out" if the flags come from a, b and out,
+    # "zero" if out is 0 but a and b are real operands,
+    # or "imm" for the I-format instructions, where a, b and out are all 0
+    if kind == "out":
+        if "c" in flags:
+            lines.append("c = (out >> 8) & 1")
+        if "s" in flags:
+            lines.append("s = (out >> 7) & 1")
+        if "z" in flags:
+            lines.append("z = 0 if out & 0b11111111 else 1")
+        if "o" in flags:
+            lines.append("o = 1 if not ((a ^ b) & 0b10000000) and (a ^ out) & 0b10000000 else 0")
+    elif kind == "zero":
+        if "c" in flags:
+            lines.append("c = 0")
+        if "s" in flags:
+            lines.append("s = 0")
+        if "z" in flags:
+            lines.append("z = 1")
+        if "o" in flags:
+            lines.append("o = 1 if a & b & 0b10000000 else 0")
+    else:
+        if "c" in flags:
+            lines.append("c = 0")
+        if "s" in flags:
+            lines.append("s = 0")
+        if "z" in flags:
+            lines.append("z = 1")
+        if "o" in flags:
+            lines.append("o = 0")
+
+# The a, b and out values the flags come from, for each kind of
+# instruction (see block_emit_flags)
+BLOCK_FLAG_ARGS = {
+    "out": "(a, b, out)",
+    "zero": "(a, b, 0)",
+    "imm": "(0, 0, 0)",
+}
+
+def block_flags_kind(op):
+    if op == asm.INS_NOP or op == asm.INS_LD or op == asm.INS_RAND or op == asm.INS_HALT:
+        return "zero"
+    elif op >= asm.INS_IMM_START and op <= asm.INS_IMM_END:
+        return "imm"
+    else:
+        return "out"
+
+def translate_block(ram, start):
+    instrs = []
+    iptr = start
+    while len(instrs) < BLOCK_MAX_INSTRS:
+        instr = block_decode(ram, iptr)
+        if instr is None:
+            break
+        instrs.append((iptr, instr))
+        iptr = (iptr + 2) % 256
+        if instr[0] in BLOCK_TERMINATORS:
+            break
+
+    if len(instrs) == 0:
+        return None
+
+    iptrs = tuple(addr for addr, instr in instrs)
+    addrs = []
+    for addr in iptrs:
+        addrs.append(addr)
+        addrs.append((addr + 1) % 256)
+
+    key = (start, bytes(ram[addr] for addr in addrs))
+    func = block_cache.get(key)
+    if func is not None:
+        return func, iptrs
+
+    # Flags needed after each instruction: whatever the next instruction
+    # reads. The last instruction's a, b and out are kept ("L") and
+    # stored for the CPU to evaluate the flags lazily.
+    needed = []
+    for i in range(0, len(instrs)):
+        if i + 1 < len(instrs):
+            op, rc = instrs[i + 1][1][0], instrs[i + 1][1][1]
+            needed.append(block_flags_read(op, rc))
+        else:
+            needed.append("L")
+    entry_flags = block_flags_read(instrs[0][1][0], instrs[0][1][1])
+
+    used = set()
+    written = set()
+    body = []
+    # Instructions already added to cpu.cycles, which is brought up to date
+    # before touching the bus, like the interpreter has it
+    counted = 0
+    for i, (addr, (op, rc, ra, rb, imm)) in enumerate(instrs):
+        flags = needed[i]
+        next_iptr = (addr + 2) % 256
+        dest = "r" + str(rc)
+        for r in (ra, rb):
+            if r is not None and r.startswith("r"):
+                used.add(r)
+
+        if ra is not None:
+            if "o" in flags or "L" in flags:
+                body.append(f"a = {ra}")
+                body.append(f"b = {rb}")
+                ra, rb = "a", "b"
+
+        if op == asm.INS_NOP:
+            block_emit_flags(body, flags, "zero")
+        elif op == asm.INS_ADD or op == asm.INS_ADDC:
+            carry = " + c" if op == asm.INS_ADDC else ""
+            body.append(f"out = {ra} + {rb}{carry}")
+            body.append(f"{dest} = out & 0b11111111")
+            written.add(dest)
+            block_emit_flags(body, flags, "out")
+        elif (
+                op == asm.INS_SUB or op == asm.INS_CMP or
+                op == asm.INS_SUBC or op == asm.INS_CMPC):
+            if rb == "b":
+                body.append("b = 0b11111111 ^ b")
+            else:
+                rb = f"(0b11111111 ^ {rb})"
+            carry = " + 1" if op == asm.INS_SUB or op == asm.INS_CMP else " + c"
+            body.append(f"out = {ra} + {rb}{carry}")
+            if op == asm.INS_SUB or op == asm.INS_SUBC:
+                body.append(f"{dest} = out & 0b11111111")
+                written.add(dest)
+            block_emit_flags(body, flags, "out")
+        elif op == asm.INS_XOR:
+            body.append(f"out = {ra} ^ {rb}")
+            body.append(f"{dest} = out & 0b11111111")
+            written.add(dest)
+            block_emit_flags(body, flags, "out")
+        elif op == asm.INS_NAND:
+            body.append(f"out = ~({ra} | {rb})")
+            body.append(f"{dest} = out & 0b11111111")
+            written.add(dest)
+            block_emit_flags(body, flags, "out")
+        elif op == asm.INS_OR:
+            body.append(f"out = {ra} | {rb}")
+            body.append(f"{dest} = out & 0b11111111")
+            written.add(dest)
+            block_emit_flags(body, flags, "out")
+        elif op == asm.INS_AND:
+            body.append(f"out = {ra} & {rb}")
+            body.append(f"{dest} = out & 0b11111111")
+            written.add(dest)
+            block_emit_flags(body, flags, "out")
+        elif op == asm.INS_SHR or op == asm.INS_SHRC:
+            body.append(f"out = {ra} + {rb}")
+            body.append("out >>= 1 | ((out & 0b1) << 8)")
+            if op == asm.INS_SHRC:
+                body.append("out |= c << 7")
+            body.append(f"{dest} = out & 0b11111111")
+            written.add(dest)
+            block_emit_flags(body, flags, "out")
+        elif op == asm.INS_RAND:
+            body.append(f"{dest} = cpu.rng.randint(0, 255)")
+            written.add(dest)
+            block_emit_flags(body, flags, "zero")
+        elif op == asm.INS_IMM:
+            body.append(f"{dest} = {imm}")
+            written.add(dest)
+            block_emit_flags(body, flags, "imm")
+        elif op == asm.INS_JMP:
+            cond = BLOCK_COND_EXPRS[rc][0]
+            body.append(f"out = {ra} + {rb}")
+            body.append(f"cpu.iptr = out & 0b11111111 if {cond} else {next_iptr}")
+            block_emit_flags(body, flags, "out")
+        elif op == asm.INS_JMPI:
+            cond = BLOCK_COND_EXPRS[rc][0]
+            body.append(f"cpu.iptr = {imm} if {cond} else {next_iptr}")
+            block_emit_flags(body, flags, "imm")
+        elif op == asm.INS_LD:
+            # Loads can't change code, so they don't need to end the block
+            used.add("r7")
+            body.append(f"cpu.cycles += {i + 1 - counted}")
+            counted = i + 1
+            body.append(f"{dest} = cpu.do_load(r7)")
+            written.add(dest)
+            block_emit_flags(body, flags, "zero")
+        elif op == asm.INS_ST or op == asm.INS_STI:
+            # Devices are visible from the outside,
+            # so flush registers before touching the bus
+            used.add("r7")
+            if "o" not in flags and ra is not None:
+                body.append(f"a = {ra}")
+                body.append(f"b = {rb}")
+            for r in sorted(written):
+                body.append(f"regs[{r[1]}] = {r}")
+            body.append(f"cpu.iptr = {next_iptr}")
+            body.append(f"cpu.cycles += {i + 1 - counted}")
+            counted = i + 1
+            if op == asm.INS_ST:
+                body.append("out = a + b")
+                body.append("cpu.do_store(r7, out & 0b11111111)")
+                block_emit_flags(body, flags, "out")
+            else:
+                body.append(f"cpu.do_store(r7, {imm})")
+                block_emit_flags(body, flags, "imm")
+            written = set()
+        elif op == asm.INS_HALT:
+            body.append("cpu.halted = True")
+            block_emit_flags(body, flags, "zero")
+
+    last_op = instrs[-1][1][0]
+    if last_op != asm.INS_ST and last_op != asm.INS_STI:
+        if counted < len(instrs):
+            body.append(f"cpu.cycles += {len(instrs) - counted}")
+        if last_op != asm.INS_JMP and last_op != asm.INS_JMPI:
+            body.append(f"cpu.iptr = {iptr}")
+
+    lines = ["def block(cpu):", "    regs = cpu.regs"]
+    for r in sorted(used | written):
+        lines.append(f"    {r} = regs[{r[1]}]")
+    for f in entry_flags:
+        lines.append(f"    {f} = cpu.{f}flag")
+    for line in body:
+        lines.append("    " + line)
+    for r in sorted(written):
+        lines.append(f"    regs[{r[1]}] = {r}")
+    lines.append("    cpu.flag_args = " + BLOCK_FLAG_ARGS[block_flags_kind(last_op)])
+    lines.append(f"    return {len(instrs)}")
+
+    namespace = {}
+    exec("\n".join(lines), namespace)
+
+    func = namespace["block"]
+    if len(block_cache) >= BLOCK_CACHE_MAX:
+        block_cache.clear()
+    block_cache[key] = func
+    return func, iptrs
+
+# Same as CPU.run(), but one instruction at a time: 'step(iptr)' is called
+# to execute the instruction at iptr through cpu.step(), so that it can look
+# at the CPU before and after. Profiler, Timer and Tracer are built on this.
+def run_stepped(cpu, step, max_cycles=None, breakpoints=(), until_addr=None, detect_loops=False):
+    stops = set(breakpoints)
+    if until_addr is not None:
+        stops.add(until_addr)
+
+    end = None
+    if max_cycles is not None:
+        end = cpu.cycles + max_cycles
+
+    detector = None
+    if detect_loops:
+        detector = LoopDetector(cpu)
+
+    first = True
+    try:
+        while not cpu.halted:
+            iptr = cpu.iptr
+            if stops and not first and iptr in stops:
+                return StopReason(STOP_BREAKPOINT, cpu)
+            if end is not None and cpu.cycles >= end:
+                return StopReason(STOP_BUDGET, cpu)
+            if detector is not None and detector.check(iptr):
+                return StopReason(STOP_LOOP, cpu)
+            first = False
+            step(iptr)
+    except IllegalInstruction as ex:
+        return StopReason(STOP_ILLEGAL, cpu, (cpu.iptr - 2) % 256, str(ex))
+    finally:
+        if detector is not None:
+            detector.close()
+
+    return StopReason(STOP_HALTED, cpu, (cpu.iptr - 2) % 256)
+
+# Collects execution counts while single-stepping a CPU:
+# per instruction address, per opcode, taken/not taken per branch
+# (and the targets of taken branches), and device reads and writes.
+class Profiler:
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.counts = [0] * 256
+        self.ops = [0] * 32
+        self.taken = [0] * 256
+        self.not_taken = [0] * 256
+        self.targets = {}
+        self.dev_reads = [0] * 256
+        self.dev_writes = [0] * 256
+
+    # Same as CPU.run(), but profiles every instruction
+    def run(self, max_cycles=None, breakpoints=(), until_addr=None, detect_loops=False):
+        return run_stepped(self.cpu, self.step, max_cycles, breakpoints, until_addr, detect_loops)
+
+    def step(self, iptr):
+        cpu = self.cpu
+        regs = cpu.regs
+        table = cpu.bus.table
+
+        hi = cpu.ram[iptr]
+        op = hi >> 3
+        self.counts[iptr] += 1
+        self.ops[op] += 1
+
+        if op == asm.INS_JMP or op == asm.INS_JMPI:
+            cond = hi & 0b111
+            taken = cond < len(cpu.conds) and cpu.conds[cond](cpu)
+            cpu.step()
+            if taken:
+                self.taken[iptr] += 1
+                key = (iptr, cpu.iptr)
+                self.targets[key] = self.targets.get(key, 0) + 1
+            else:
+                self.not_taken[iptr] += 1
+            return
+
+        if op == asm.INS_LD:
+            if table[regs[7]] is not None:
+                self.dev_reads[regs[7]] += 1
+        elif op == asm.INS_ST or op == asm.INS_STI:
+            if table[regs[7]] is not None:
+                self.dev_writes[regs[7]] += 1
+        cpu.step()
+
+    # Returns (where, line number or None) for the instruction at addr,
+    # using the assembler's debug info if available
+    def locate(self, addr, debug):
+        if debug is not None and addr < len(debug["addrs"]):
+            linenum, label = debug["addrs"][addr]
+            return linenum, label
+        return None, None
+
+    def describe(self, addr, debug):
+        linenum, label = self.locate(addr, debug)
+        if linenum is not None:
+            return f"line {linenum}: " + debug["lines"][linenum - 1].strip()
+
+        try:
+            return f"{addr}: " + disassemble(self.cpu.ram[addr], self.cpu.ram[(addr + 1) % 256])
+        except Exception:
+            return f"{addr}: ???"
+
+    def loops(self):
+        loops = []
+        for (src, dest), count in self.targets.items():
+            if dest <= src:
+                cycles = sum(self.counts[dest:src + 1])
+                loops.append((cycles, count, dest, src))
+        loops.sort(reverse=True)
+        return loops
+
+    def report(self, f=sys.stdout, debug=None, top=20):
+        total = sum(self.counts)
+        if total == 0:
+            f.write("Profile: no instructions executed\n")
+            return
+
+        def pct(n):
+            return f"{100 * n / total:5.1f}%"
+
+        f.write(f"Profile: {total} instructions executed\n")
+
+        f.write("\nOpcodes:\n")
+        for op, count in sorted(enumerate(self.ops), key=lambda x: -x[1]):
+            if count > 0:
+                name = OP_NAMES.get(op, hex(op))
+                f.write(f"  {name:<6} {count:>10} {pct(count)}\n")
+
+        # Hot lines: sum the counts of every instruction on the same line,
+        # or just use instruction addresses without debug info
+        lines = {}
+        for addr, count in enumerate(self.counts):
+            if count == 0:
+                continue
+            linenum, label = self.locate(addr, debug)
+            key = addr if linenum is None else linenum
+            if key in lines:
+                lines[key] = (lines[key][0] + count, lines[key][1])
+            else:
+                lines[key] = (count, addr)
+
+        f.write("\nHot lines:\n")
+        for key, (count, addr) in sorted(lines.items(), key=lambda x: -x[1][0])[:top]:
+            f.write(f"  {count:>10} {pct(count)}  {self.describe(addr, debug)}\n")
+
+        loops = self.loops()
+        if len(loops) > 0:
+            f.write("\nHot loops:\n")
+        for cycles, count, start, end in loops[:top]:
+            linenum, label = self.locate(start, debug)
+            name = f"{start}-{end}"
+            if label is not None:
+                name = f"{label} ({name})"
+            if linenum is not None:
+                endline = self.locate(end, debug)[0]
+                name += f", lines {linenum}-{endline}"
+            f.write(f"  {cycles:>10} {pct(cycles)}  {count} iterations  {name}\n")
+
+        branches = [addr for addr in range(0, 256) if self.taken[addr] + self.not_taken[addr] > 0]
+        if len(branches) > 0:
+            f.write("\nBranches (taken / not taken):\n")
+        for addr in branches:
+            f.write(f"  {self.taken[addr]:>10} / {self.not_taken[addr]:<10}  {self.describe(addr, debug)}\n")
+
+        devs = [addr for addr in range(0, 256) if self.dev_reads[addr] + self.dev_writes[addr] > 0]
+        if len(devs) > 0:
+            f.write("\nDevice accesses (reads / writes):\n")
+        for addr in devs:
+            f.write(f"  {self.dev_reads[addr]:>10} / {self.dev_writes[addr]:<10}  address {addr}\n")
+
+# Cycle costs, for estimating how long programs take on the physical
+# machine. A cost model file is a JSON object with any of these keys:
+# * "clock_hz": Clock rate of the machine (default 1)
+# * "classes": Clock cycles for each class of instruction (see COST_CLASSES),
+#   1 by default
+# * "ops": Clock cycles for single opcodes by name (see OP_NAMES), like
+#   {"shr": 2}, instead of their class's cost
+# * "branch_taken", "branch_not_taken": Extra cycles for jumps which are,
+#   or aren't, taken
+# * "ram_latency", "device_latency": Extra cycles for loads and stores which
+#   go to RAM, or to devices
+COST_CLASSES = {
+    "alu": (
+        asm.INS_ADD, asm.INS_SUB, asm.INS_XOR, asm.INS_NAND, asm.INS_OR, asm.INS_AND,
+        asm.INS_SHR, asm.INS_CMP, asm.INS_ADDC, asm.INS_SUBC, asm.INS_SHRC, asm.INS_CMPC),
+    "jump": (asm.INS_JMP, asm.INS_JMPI),
+    "load": (asm.INS_LD,),
+    "store": (asm.INS_ST, asm.INS_STI),
+    "imm": (asm.INS_IMM,),
+    "rand": (asm.INS_RAND,),
+    "nop": (asm.INS_NOP,),
+    "halt": (asm.INS_HALT,),
+}
+OP_CLASSES = {op: name for name, ops in COST_CLASSES.items() for op in ops}
+COST_KEYS = (
+    "clock_hz", "classes", "ops", "branch_taken", "branch_not_taken",
+    "ram_latency", "device_latency")
+
+# Costs must be non-negative numbers, and the clock rate must be positive
+def check_cost(name, val, positive=False):
+    if isinstance(val, bool) or not isinstance(val, (int, float)) or val != val or val == float("inf"):
+        raise Exception("Cost model " + name + " must be a number, not " + json.dumps(val))
+    if positive and val <= 0:
+        raise Exception("Cost model " + name + " must be positive")
+    if val < 0:
+        raise Exception("Cost model " + name + " can't be negative")
+    return val
+
+class CostModel:
+    def __init__(self, config=None):
+        if config is None:
+            config = {}
+        if not isinstance(config, dict):
+            raise Exception("Cost model must be a JSON object")
+        for key in config:
+            if key not in COST_KEYS:
+                raise Exception("Unknown cost model key: " + key)
+
+        self.clock_hz = check_cost("clock_hz", config.get("clock_hz", 1), True)
+        self.branch_taken = check_cost("branch_taken", config.get("branch_taken", 0))
+        self.branch_not_taken = check_cost("branch_not_taken", config.get("branch_not_taken", 0))
+        self.ram_latency = check_cost("ram_latency", config.get("ram_latency", 0))
+        self.device_latency = check_cost("device_latency", config.get("device_latency", 0))
+
+        classes = config.get("classes", {})
+        ops = config.get("ops", {})
+        if not isinstance(classes, dict) or not isinstance(ops, dict):
+            raise Exception("Cost model classes and ops must be JSON objects")
+        for name in classes:
+            if name not in COST_CLASSES:
+                raise Exception("Unknown instruction class: " + name)
+            check_cost("class " + name, classes[name])
+        op_numbers = {name: op for op, name in OP_NAMES.items()}
+        for name in ops:
+            if name not in op_numbers:
+                raise Exception("Unknown opcode: " + name)
+            check_cost("op " + name, ops[name])
+
+        # Illegal opcodes stop the CPU, so they never cost anything
+        self.op_costs = [0] * 32
+        for op, name in OP_CLASSES.items():
+            self.op_costs[op] = classes.get(name, 1)
+        for name, cost in ops.items():
+            self.op_costs[op_numbers[name]] = cost
+
+    # The cost of an instruction as far as it can be known without running
+    # it: 'taken' says whether a jump is taken, and memory accesses count as RAM
+    def static_cost(self, op, taken=False):
+        cost = self.op_costs[op]
+        if op == asm.INS_JMP or op == asm.INS_JMPI:
+            cost += self.branch_taken if taken else self.branch_not_taken
+        elif op in (asm.INS_LD, asm.INS_ST, asm.INS_STI):
+            cost += self.ram_latency
+        return cost
+
+def load_cost_model(path):
+    with open(path, "r") as f:
+        return CostModel(json.load(f))
+
+def format_duration(seconds):
+    if seconds < 60:
+        return f"{seconds:.1f}s"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    if days > 0:
+        return f"{days}d {hours}h {minutes:02}m"
+    if hours > 0:
+        return f"{hours}h {minutes:02}m {seconds:02}s"
+    return f"{minutes}m {seconds:02}s"
+
+# Runs the program while adding up the clock cycles it would take
+# on the physical machine, according to a CostModel
+class Timer:
+    def __init__(self, cpu, model):
+        self.cpu = cpu
+        self.model = model
+        self.counts = [0] * 256
+        self.costs = [0] * 256
+        self.op_counts = [0] * 32
+        self.op_totals = [0] * 32
+
+        # Addresses which execution got to through a jump,
+        # or by not taking one, where basic blocks start
+        self.leaders = {0}
+
+    # Same as CPU.run(), but adds up the cost of every instruction
+    def run(self, max_cycles=None, breakpoints=(), until_addr=None, detect_loops=False):
+        return run_stepped(self.cpu, self.step, max_cycles, breakpoints, until_addr, detect_loops)
+
+    def step(self, iptr):
+        cpu = self.cpu
+        model = self.model
+
+        op = cpu.ram[iptr] >> 3
+        cost = model.op_costs[op]
+        if op == asm.INS_JMP or op == asm.INS_JMPI:
+            cond = cpu.ram[iptr] & 0b111
+            taken = cond < len(cpu.conds) and cpu.conds[cond](cpu)
+            cpu.step()
+            cost += model.branch_taken if taken else model.branch_not_taken
+            self.leaders.add(cpu.iptr)
+        else:
+            if op == asm.INS_LD or op == asm.INS_ST or op == asm.INS_STI:
+                if cpu.bus.table[cpu.regs[7]] is None:
+                    cost += model.ram_latency
+                else:
+                    cost += model.device_latency
+            cpu.step()
+
+        self.counts[iptr] += 1
+        self.costs[iptr] += cost
+        self.op_counts[op] += 1
+        self.op_totals[op] += cost
+
+    def total(self):
+        return sum(self.costs)
+
+    # Executed basic blocks, as (start, end) address pairs, where end
+    # is the address of the last instruction
+    def blocks(self):
+        blocks = []
+        prev = None
+        for addr in range(0, 256):
+            if self.counts[addr] == 0:
+                continue
+            if prev is not None and addr == prev + 2 and addr not in self.leaders:
+                blocks[-1][1] = addr
+            else:
+                blocks.append([addr, addr])
+            prev = addr
+        return [tuple(block) for block in blocks]
+
+    def report(self, f=sys.stdout, debug=None, top=20):
+        total = self.total()
+        instrs = sum(self.counts)
+        if instrs == 0:
+            f.write("Timing: no instructions executed\n")
+            return
+
+        hz = self.model.clock_hz
+        def pct(n):
+            return f"{100 * n / total:5.1f}%" if total > 0 else "    -"
+        def line(cost, name):
+            return f"  {cost:>10} {pct(cost)} {format_duration(cost / hz):>12}  {name}\n"
+
+        f.write(f"Timing: {total} clock cycles for {instrs} instructions ({total / instrs:.2f} per instruction)\n")
+        f.write(f"Estimated time at {hz:g} Hz: {format_duration(total / hz)}\n")
+
+        f.write("\nInstruction classes:\n")
+        classes = {}
+        for op, cost in enumerate(self.op_totals):
+            if self.op_counts[op] > 0:
+                name = OP_CLASSES[op]
+                classes[name] = classes.get(name, 0) + cost
+        for name, cost in sorted(classes.items(), key=lambda x: -x[1]):
+            f.write(line(cost, name))
+
+        if debug is not None:
+            labels = {}
+            for addr, cost in enumerate(self.costs):
+                if cost > 0:
+                    label = debug["addrs"][addr][1] if addr < len(debug["addrs"]) else None
+                    labels[label] = labels.get(label, 0) + cost
+            f.write("\nLabels:\n")
+            for label, cost in sorted(labels.items(), key=lambda x: -x[1])[:top]:
+                f.write(line(cost, "(before any label)" if label is None else label))
+
+        blocks = []
+        for start, end in self.blocks():
+            cost = sum(self.costs[start:end + 1])
+            name = f"{start}-{end}"
+            if debug is not None and start < len(debug["addrs"]):
+                linenum, label = debug["addrs"][start]
+                endline = debug["addrs"][end][0] if end < len(debug["addrs"]) else linenum
+                if label is not None:
+                    name = f"{label} ({name})"
+                name += f", lines {linenum}-{endline}"
+            blocks.append((cost, name))
+        f.write("\nBasic blocks:\n")
+        for cost, name in sorted(blocks, key=lambda x: -x[0])[:top]:
+            f.write(line(cost, name))
+
+# Records every retired instruction to a tracefile.TraceWriter.
+# Tracing steps one instruction at a time, so it's slower than CPU.run().
+class Tracer:
+    def __init__(self, cpu, writer):
+        self.cpu = cpu
+        self.writer = writer
+        self.store = None
+
+    def do_store(self, addr, val):
+        self.store = (addr, val)
+        self.cpu_store(addr, val)
+
+    # Same as CPU.run(), but records every instruction
+    def run(self, max_cycles=None, breakpoints=(), until_addr=None, detect_loops=False):
+        # Catch stores to memory and devices through the CPU
+        cpu = self.cpu
+        self.cpu_store = cpu.do_store
+        cpu.do_store = self.do_store
+        try:
+            return run_stepped(cpu, self.step, max_cycles, breakpoints, until_addr, detect_loops)
+        finally:
+            del cpu.do_store
+
+    def step(self, iptr):
+        cpu = self.cpu
+        hi = cpu.ram[iptr]
+        lo = cpu.ram[(iptr + 1) % 256]
+        self.store = None
+        cpu.step()
+
+        reg = tracefile.TRACE_NO_REG
+        val = 0
+        if hi >> 3 in tracefile.DEST_OPS:
+            reg = hi & 0b111
+            val = cpu.regs[reg]
+        flags = cpu.cflag | (cpu.sflag << 1) | (cpu.zflag << 2) | (cpu.oflag << 3)
+        waddr, wval = 0, 0
+        if self.store is not None:
+            flags |= tracefile.TRACE_WRITE
+            waddr, wval = self.store
+        self.writer.record(iptr, hi, lo, reg, val, flags, waddr, wval)
+
+# Interactive debugger. Between stops the program runs through CPU.run(),
+# so breakpoints cost nothing per instruction. Memory watchpoints wrap
+# CPU.do_load and CPU.do_store only while any are set, and make the CPU
+# look halted so that run() returns right after the access. Watching a
+# register means single-stepping, since registers have no hook.
+DEBUG_HELP = """Commands:
+  s, step [n]        Execute n instructions (default 1)
+  n, next            Run until the next instruction in memory, stepping over calls and loops
+  c, continue        Run until a breakpoint, watchpoint or halt (Ctrl-C to interrupt)
+  b, break <loc>     Set a breakpoint at an address or label
+  d, delete <loc>    Remove a breakpoint
+  w, watch <what>    Stop when a register changes, or when an address or label is written
+  rwatch <loc>       Stop when an address or label is read
+  unwatch <what>     Remove a watchpoint
+  r, regs            Show the registers and flags
+  x <loc> [n]        Show n bytes of memory (default 16)
+  l, list [loc] [n]  Disassemble n instructions (default 8)
+  info               List breakpoints and watchpoints
+  q, quit            Stop debugging
+An empty line repeats the last command."""
+
+# Continue runs in slices of this many cycles, so Ctrl-C is noticed
+DEBUG_SLICE = 100000
+
+class Debugger:
+    def __init__(self, cpu, debug=None, f=sys.stdout):
+        self.cpu = cpu
+        self.debug = debug
+        self.f = f
+        self.breakpoints = set()
+        self.watch_regs = {}
+        self.watch_writes = set()
+        self.watch_reads = set()
+        self.hit = None
+        self.interrupted = False
+        self.last = ""
+
+    def parse_loc(self, s):
+        if self.debug is not None and s in self.debug["labels"]:
+            return self.debug["labels"][s]
+        try:
+            addr = int(s, 0)
+        except ValueError:
+            raise Exception("Unknown address or label: " + s)
+        if addr < 0 or addr > 255:
+            raise Exception("Address out of range: " + s)
+        return addr
+
+    def describe(self, addr):
+        ram = self.cpu.ram
+        try:
+            text = disassemble(ram[addr], ram[(addr + 1) % 256])
+        except Exception:
+            text = "???"
+        out = f"{addr:>3}: {text}"
+        if self.debug is not None and addr < len(self.debug["addrs"]):
+            linenum, label = self.debug["addrs"][addr]
+            out += f"  (line {linenum}: {self.debug['lines'][linenum - 1].strip()})"
+        return out
+
+    def show_regs(self):
+        cpu = self.cpu
+        self.f.write(f"  regs: {cpu.regs}  c:{cpu.cflag} s:{cpu.sflag} z:{cpu.zflag} o:{cpu.oflag}"
+                     f"  cycles: {cpu.cycles}\n")
+
+    def show_stop(self, reason=None):
+        if reason is not None and reason.kind not in (STOP_BREAKPOINT, STOP_HALTED):
+            self.f.write(f"Stopped: {reason}\n")
+        if not self.cpu.halted:
+            self.f.write("=> " + self.describe(self.cpu.iptr) + "\n")
+        self.show_regs()
+
+    def do_load(self, addr):
+        val = self.cpu_load(addr)
+        if addr in self.watch_reads:
+            self.hit = f"read {val} from {addr}"
+            self.cpu.halted = True
+        return val
+
+    def do_store(self, addr, val):
+        self.cpu_store(addr, val)
+        if addr in self.watch_writes:
+            self.hit = f"wrote {val} to {addr}"
+            self.cpu.halted = True
+
+    # Run with the memory hooks installed, and turn a watchpoint hit
+    # back into a stop reason
+    def run(self, max_cycles=None, breakpoints=()):
+        cpu = self.cpu
+        hooked = len(self.watch_reads) > 0 or len(self.watch_writes) > 0
+        use_blocks = cpu.use_blocks
+        if hooked:
+            self.cpu_load = cpu.do_load
+            self.cpu_store = cpu.do_store
+            cpu.do_load = self.do_load
+            cpu.do_store = self.do_store
+            # Loads don't end blocks, so stop after the exact instruction
+            if self.watch_reads:
+                cpu.use_blocks = False
+
+        self.hit = None
+        try:
+            reason = cpu.run(max_cycles, breakpoints)
+        finally:
+            if hooked:
+                del cpu.do_load
+                del cpu.do_store
+                cpu.use_blocks = use_blocks
+
+        if self.hit is not None:
+            # Stores end blocks, and loads are single-stepped,
+            # so the access was the last instruction, not a halt
+            cpu.halted = False
+            reason = StopReason(STOP_WATCHPOINT, cpu, message=self.hit)
+        return reason
+
+    # Execute up to 'count' instructions one at a time. Returns the stop
+    # reason, or None if all of them were executed.
+    def step(self, count, breakpoints=()):
+        for i in range(0, count):
+            if self.cpu.halted:
+                return StopReason(STOP_HALTED, self.cpu, (self.cpu.iptr - 2) % 256)
+            reason = self.run(1)
+            if reason.kind != STOP_BUDGET:
+                return reason
+            reason = self.check_regs()
+            if reason is not None:
+                return reason
+            if self.cpu.iptr in breakpoints:
+                return StopReason(STOP_BREAKPOINT, self.cpu)
+        return None
+
+    def check_regs(self):
+        for r, val in self.watch_regs.items():
+            if self.cpu.regs[r] != val:
+                self.watch_regs[r] = self.cpu.regs[r]
+                message = f"r{r} changed from {val} to {self.cpu.regs[r]}"
+                return StopReason(STOP_WATCHPOINT, self.cpu, message=message)
+        return None
+
+    def cont(self, breakpoints):
+        import signal
+
+        def interrupt(sig, frame):
+            self.interrupted = True
+
+        self.interrupted = False
+        old = signal.signal(signal.SIGINT, interrupt)
+        try:
+            while not self.interrupted:
+                if self.watch_regs:
+                    reason = self.step(DEBUG_SLICE, breakpoints)
+                    if reason is not None:
+                        return reason
+                    continue
+                reason = self.run(DEBUG_SLICE, breakpoints)
+                if reason.kind != STOP_BUDGET:
+                    return reason
+        finally:
+            signal.signal(signal.SIGINT, old)
+        self.f.write("Interrupted\n")
+        return None
+
+    def command(self, line):
+        words = line.split()
+        if len(words) == 0:
+            words = self.last.split()
+            if len(words) == 0:
+                return True
+        else:
+            self.last = line if words[0] in ("s", "step", "n", "next", "c", "continue") else ""
+        cmd, args = words[0], words[1:]
+        cpu = self.cpu
+
+        if cmd in ("q", "quit"):
+            return False
+        elif cmd in ("h", "help"):
+            self.f.write(DEBUG_HELP + "\n")
+        elif cmd in ("s", "step"):
+            self.show_stop(self.step(int(args[0], 0) if args else 1, self.breakpoints))
+        elif cmd in ("n", "next"):
+            target = (cpu.iptr + 2) % 256
+            reason = self.step(1)
+            if reason is None and cpu.iptr != target:
+                reason = self.cont(self.breakpoints | {target})
+            self.show_stop(reason)
+        elif cmd in ("c", "continue"):
+            self.show_stop(self.cont(self.breakpoints))
+        elif cmd in ("b", "break"):
+            addr = self.parse_loc(args[0])
+            self.breakpoints.add(addr)
+            self.f.write("Breakpoint at " + self.describe(addr) + "\n")
+        elif cmd in ("d", "delete"):
+            self.breakpoints.discard(self.parse_loc(args[0]))
+        elif cmd in ("w", "watch") and args[0] in asm.REGISTERS:
+            r = asm.REGISTERS[args[0]][1]
+            self.watch_regs[r] = cpu.regs[r]
+        elif cmd in ("w", "watch"):
+            self.watch_writes.add(self.parse_loc(args[0]))
+        elif cmd == "rwatch":
+            self.watch_reads.add(self.parse_loc(args[0]))
+        elif cmd == "unwatch" and args[0] in asm.REGISTERS:
+            self.watch_regs.pop(asm.REGISTERS[args[0]][1], None)
+        elif cmd == "unwatch":
+            addr = self.parse_loc(args[0])
+            self.watch_writes.discard(addr)
+            self.watch_reads.discard(addr)
+        elif cmd in ("r", "regs"):
+            self.show_regs()
+        elif cmd == "x":
+            addr = self.parse_loc(args[0])
+            count = int(args[1], 0) if len(args) > 1 else 16
+            for start in range(addr, min(addr + count, 256), 8):
+                vals = cpu.ram[start:min(start + 8, addr + count, 256)]
+                self.f.write(f"  {start:>3}: " + " ".join(f"{v:>3}" for v in vals) + "\n")
+        elif cmd in ("l", "list"):
+            addr = self.parse_loc(args[0]) if args else cpu.iptr
+            count = int(args[1], 0) if len(args) > 1 else 8
+            for i in range(0, count):
+                mark = "=> " if addr == cpu.iptr else "   "
+                self.f.write(mark + self.describe(addr) + "\n")
+                addr = (addr + 2) % 256
+        elif cmd == "info":
+            self.f.write("Breakpoints: " + ", ".join(str(a) for a in sorted(self.breakpoints)) + "\n")
+            watches = [f"r{r}" for r in sorted(self.watch_regs)]
+            watches += [f"{a} (write)" for a in sorted(self.watch_writes)]
+            watches += [f"{a} (read)" for a in sorted(self.watch_reads)]
+            self.f.write("Watchpoints: " + ", ".join(watches) + "\n")
+        else:
+            self.f.write("Unknown command, try 'help'\n")
+        return True
+
+    # Read commands until 'quit' or the end of input.
+    # Returns the last stop reason, like CPU.run().
+    def loop(self, inf=sys.stdin):
+        self.show_stop()
+        while True:
+            if self.cpu.halted:
+                return StopReason(STOP_HALTED, self.cpu, (self.cpu.iptr - 2) % 256)
+            self.f.write("(dbg) ")
+            self.f.flush()
+            line = inf.readline()
+            if line == "":
+                return None
+            try:
+                if not self.command(line):
+                    return None
+            except Exception as ex:
+                self.f.write(f"Error: {ex}\n")
+
+# Devices normally print their output and sleep to make it readable.
+# When given a Clock, they instead timestamp every event with the CPU's
+# cycle count and keep it in memory; 'headless' devices don't print at all,
+# while others print as they go, paced by the clock.
+class Clock:
+    def __init__(self, cpu, rate=None):
+        self.cpu = cpu
+        self.rate = rate
+        self.start_time = time.monotonic()
+        self.start_cycles = cpu.cycles
+
+    def now(self):
+        return self.cpu.cycles
+
+    def fork(self, cpu):
+        clock = Clock(cpu, self.rate)
+        clock.start_time = self.start_time
+        clock.start_cycles = self.start_cycles
+        return clock
+
+    # With a target clock rate (in instructions per second),
+    # sleep until wall-clock time has caught up with the CPU
+    def pace(self):
+        if self.rate is None:
+            return
+
+        target = self.start_time + (self.cpu.cycles - self.start_cycles) / self.rate
+        delay = target - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
 
 class CharacterDisplay:
+    def __init__(self, clock=None, headless=False):
+        self.clock = clock
+        self.headless = headless
+        self.events = []
+
     def read(self): return 0
 
     def write(self, val):
-        print("Char Display:", chr(val))
-        time.sleep(0.2)
+        if self.clock is None:
+            print("Char Display:", chr(val))
+            time.sleep(0.2)
+            return
+
+        self.events.append((self.clock.now(), chr(val)))
+        if not self.headless:
+            self.clock.pace()
+            print("Char Display:", chr(val))
+
+    def text(self):
+        return "".join(ch for cycle, ch in self.events)
+
+    def snapshot(self):
+        return tuple(self.events)
+
+    def restore(self, state):
+        self.events = list(state)
+
+    def fork(self, cpu):
+        clock = None
+        if self.clock is not None:
+            clock = self.clock.fork(cpu)
+        disp = CharacterDisplay(clock, self.headless)
+        disp.events = list(self.events)
+        return disp
+
+    def dump(self, f=sys.stdout):
+        if len(self.events) == 0:
+            return
+        f.write("Char Display: " + self.text() + "\n")
+
+# The cells of 8 pixels, for each byte of a frame
+PIXEL_CELLS = ["".join("██" if (b >> i) & 1 else "  " for i in range(0, 8)) for b in range(0, 256)]
+
+# Frames are ints with one bit per pixel: pixel (x, row) is bit
+# row * width + x, where row 0 is the top row
+def render_frame(pixels, width, height):
+    lines = ["╔" + ("══" * width) + "╗"]
+    mask = (1 << width) - 1
+    for row in range(0, height):
+        bits = (pixels >> (row * width)) & mask
+        cells = "".join(PIXEL_CELLS[(bits >> shift) & 0xff] for shift in range(0, width, 8))
+        lines.append("║" + cells[:width * 2] + "║")
+    lines.append("╚" + ("══" * width) + "╝")
+    return "\n".join(lines)
 
 class PixelDisplay:
     width = 16
     height = 15
 
-    def __init__(self):
-        self.backbuffer = []
+    # Frames go to 'sink' as they're displayed, if given (see open_frame_sink),
+    # and are otherwise kept in 'frames' to be dumped at the end
+    def __init__(self, clock=None, headless=False, sink=None):
+        self.clock = clock
+        self.headless = headless
+        self.sink = sink
+        self.frames = []
+        self.backbuffer = 0
         self.used = False
-        for y in range(0, self.height):
-            arr = []
-            for x in range(0, self.width):
-                arr.append(False)
-            self.backbuffer.append(arr)
 
     def read(self): return 0
 
+    def render(self, pixels=None):
+        if pixels is None:
+            pixels = self.backbuffer
+        return render_frame(pixels, self.width, self.height)
+
+    def clear(self):
+        self.backbuffer = 0
+
     def write(self, val):
         if val == 0b11111111: # Display and clear the backbuffer
             if not self.used:
                 # This is just an initial clear, don't print anything
-                for y in range(0, self.height):
-                    for x in range(0, self.width):
-                        self.backbuffer[y][x] = False
+                self.clear()
                 self.used = True
                 return
 
-            print("Pixel Display:")
-            print("╔" + ("══" * self.width) + "╗")
-            for y in range(0, self.height):
-                print("║", end="")
-                for x in range(0, self.width):
-                    print("██" if self.backbuffer[y][x] else "  ", end="")
-                    self.backbuffer[y][x] = False
-                print("║")
-            print("╚" + ("══" * self.width) + "╝")
-            time.sleep(0.5)
+            pixels = self.backbuffer
+            self.clear()
+            if self.clock is None:
+                sys.stdout.write("Pixel Display:\n" + self.render(pixels) + "\n")
+                time.sleep(0.5)
+                return
+
+            cycle = self.clock.now()
+            if self.sink is not None:
+                self.sink.write_frame(cycle, pixels)
+            else:
+                self.frames.append((cycle, pixels))
+            if not self.headless:
+                self.clock.pace()
+                sys.stdout.write("Pixel Display:\n" + self.render(pixels) + "\n")
 
         else:
             x = (val & 0b11110000) >> 4
             y = (val & 0b00001111)
-            self.backbuffer[self.height - y - 1][x] = True
+            row = (self.height - y - 1) % self.height
+            self.backbuffer |= 1 << (row * self.width + x)
             self.used = True
 
+    def snapshot(self):
+        return (self.used, self.backbuffer, tuple(self.frames))
+
+    def restore(self, state):
+        used, backbuffer, frames = state
+        self.used = used
+        self.backbuffer = backbuffer
+        self.frames = list(frames)
+
+    def fork(self, cpu):
+        clock = None
+        if self.clock is not None:
+            clock = self.clock.fork(cpu)
+        disp = PixelDisplay(clock, self.headless)
+        disp.restore(self.snapshot())
+        return disp
+
+    def dump(self, f=sys.stdout):
+        for cycle, pixels in self.frames:
+            f.write("Pixel Display (cycle " + str(cycle) + "):\n")
+            f.write(self.render(pixels) + "\n")
+
+# A frame log is a header with the display size, followed by a record
+# for each frame: the cycle count, and the frame's pixels as a little
+# endian bitmask (see render_frame).
+FRAME_LOG_MAGIC = b"OCTFRAME"
+FRAME_LOG_HEADER = struct.Struct("<8sBB")
+FRAME_LOG_CYCLE = struct.Struct("<Q")
+
+def frame_bytes(width, height):
+    return (width * height + 7) // 8
+
+class FrameLog:
+    def __init__(self, f, width, height):
+        self.f = f
+        self.size = frame_bytes(width, height)
+        f.write(FRAME_LOG_HEADER.pack(FRAME_LOG_MAGIC, width, height))
+
+    def write_frame(self, cycle, pixels):
+        self.f.write(FRAME_LOG_CYCLE.pack(cycle) + pixels.to_bytes(self.size, "little"))
+
+    def close(self):
+        self.f.close()
+
+# Returns the width and height in a frame log,
+# and an iterator over (cycle, pixels) for each frame
+def read_frame_log(f):
+    header = f.read(FRAME_LOG_HEADER.size)
+    if len(header) < FRAME_LOG_HEADER.size:
+        raise Exception("Not a frame log")
+    magic, width, height = FRAME_LOG_HEADER.unpack(header)
+    if magic != FRAME_LOG_MAGIC:
+        raise Exception("Not a frame log")
+
+    def frames():
+        size = FRAME_LOG_CYCLE.size + frame_bytes(width, height)
+        while True:
+            rec = f.read(size)
+            if len(rec) < size:
+                return
+            yield FRAME_LOG_CYCLE.unpack_from(rec)[0], int.from_bytes(rec[FRAME_LOG_CYCLE.size:], "little")
+    return width, height, frames()
+
+# Writes each frame to its own binary PGM file, named by formatting
+# 'pattern' (like "frame%05d.pgm") with the frame number
+class PGMSequence:
+    # Bits as '0' and '1' characters to pixel values
+    LEVELS = bytes.maketrans(b"01", b"\x00\xff")
+
+    def __init__(self, pattern, width, height):
+        self.pattern = pattern
+        self.width = width
+        self.height = height
+        self.count = 0
+
+    def write_frame(self, cycle, pixels):
+        bits = format(pixels, "0" + str(self.width * self.height) + "b")[::-1]
+        with open(self.pattern % self.count, "wb") as f:
+            f.write(f"P5\n{self.width} {self.height}\n255\n".encode())
+            f.write(bits.encode().translate(self.LEVELS))
+        self.count += 1
+
+    def close(self):
+        pass
+
+# A pattern with a '%' gives a PGM sequence, anything else a frame log
+def open_frame_sink(path, width=PixelDisplay.width, height=PixelDisplay.height):
+    if "%" in path:
+        return PGMSequence(path, width, height)
+    return FrameLog(open(path, "wb"), width, height)
+
+# Extended memory, in banks of 'window' bytes. The device covers the window
+# followed by two control registers, which hold the low and high byte of
+# the selected bank. Loads and stores in the window go to that bank.
+# 'buf' can be any buffer, like a bytearray or an mmap; addresses past its
+# end read as 0 and ignore writes. 'buf' is never written to: a bank is
+# copied into 'pages' the first time it's written, so snapshots and forks
+# only copy the banks which were written, and forks share 'buf'.
+class BankedMemory:
+    def __init__(self, buf, window=asm.BANK_WINDOW_SIZE):
+        self.buf = buf
+        self.window = window
+        self.pages = {}
+        self.select(0)
+
+    def select(self, bank):
+        self.bank = bank
+        self.base = bank * self.window
+        self.page = self.pages.get(bank)
+
+    def read_at(self, offset):
+        if offset < self.window:
+            page = self.page
+            if page is not None:
+                return page[offset] if offset < len(page) else 0
+            addr = self.base + offset
+            return self.buf[addr] if addr < len(self.buf) else 0
+        elif offset == self.window:
+            return self.bank & 0xff
+        else:
+            return self.bank >> 8
+
+    def write_at(self, offset, val):
+        if offset < self.window:
+            page = self.page
+            if page is None:
+                page = bytearray(self.buf[self.base:self.base + self.window])
+                self.pages[self.bank] = page
+                self.page = page
+            if offset < len(page):
+                page[offset] = val
+        elif offset == self.window:
+            self.select((self.bank & 0xff00) | val)
+        else:
+            self.select((self.bank & 0xff) | (val << 8))
+
+    def snapshot(self):
+        return (self.bank, tuple((bank, bytes(page)) for bank, page in self.pages.items()))
+
+    def restore(self, state):
+        bank, pages = state
+        self.pages = {bank: bytearray(page) for bank, page in pages}
+        self.select(bank)
+
+    def fork(self, cpu):
+        mem = BankedMemory(self.buf, self.window)
+        mem.restore(self.snapshot())
+        return mem
+
+# Map a file as the contents of extended memory. Writes only go to memory,
+# the file is never modified.
+def map_bank_file(path):
+    with open(path, "rb") as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        except ValueError:
+            # Empty files can't be mapped
+            return bytearray()
+
+# Load a plain or banked image (see assembler.py). If the image has banks,
+# or there's a 'bank_file', extended memory is attached at the window
+# address with the banks copied in. Returns the BankedMemory, if any.
+def load_program_image(cpu, bs, bank_file=None):
+    main, addr, window, banks = asm.read_banked_image(bs)
+    cpu.load_program(main)
+    if len(banks) == 0 and bank_file is None:
+        return None
+
+    if bank_file is not None:
+        buf = map_bank_file(bank_file)
+    else:
+        buf = bytearray((max(banks) + 1) * window)
+    for bank, data in banks.items():
+        start = bank * window
+        if start + len(data) > len(buf):
+            raise Exception("Bank " + str(bank) + " doesn't fit in the bank file")
+        buf[start:start + len(data)] = data
+
+    mem = BankedMemory(buf, window)
+    cpu.add_hardware(addr, mem, window + 2)
+    return mem
+
+# Attach the standard displays. 'mode' is one of:
+# * "terminal": print output immediately, with fixed sleeps
+# * "headless": record output against the virtual clock, print nothing
+# * "realtime": print output immediately, paced to 'rate' instructions per second
+# Pixel display frames are also written to 'frames' (see open_frame_sink),
+# except in terminal mode.
+def attach_displays(cpu, mode="terminal", rate=None, frames=None):
+    if mode == "terminal":
+        clock = None
+    elif mode == "headless":
+        clock = Clock(cpu)
+    elif mode == "realtime":
+        if rate is None:
+            raise Exception("Realtime mode needs a clock rate")
+        clock = Clock(cpu, rate)
+    else:
+        raise Exception("Unknown display mode: " + mode)
+
+    chardisp = CharacterDisplay(clock, headless=mode == "headless")
+    pixdisp = PixelDisplay(clock, headless=mode == "headless", sink=frames)
+    cpu.add_hardware(254, chardisp)
+    cpu.add_hardware(253, pixdisp)
+    return chardisp, pixdisp
+
+# The batch runner executes the jobs in a manifest across a process pool.
+# A manifest is a JSON list of jobs, each an object with these keys:
+# * "program": Path to a binary, a ".schematic" or a ".s" file to assemble,
+#   relative to the manifest (or "source": assembly code to assemble)
+# * "seed": RNG seed (optional, defaults to 0)
+# * "max_cycles": Cycle budget (optional)
+# * "detect_loops": Stop programs which can never halt (optional)
+# * "expect": Expected results (optional), with any of the keys
+#   "regs" (a list of 8 values, or an object like {"r0": 55}),
+#   "output" (character display text), "frames" (pixel display frame count),
+#   "stop" (the stop reason kind) and "cycles"
+
+def load_job_program(job, basedir):
+    if "source" in job:
+        out = io.BytesIO()
+        asm.assemble(io.StringIO(job["source"]), out)
+        return out.getvalue()
+
+    path = os.path.join(basedir, job["program"])
+    if path.endswith(".s"):
+        out = io.BytesIO()
+        with open(path, "r") as f:
+            asm.assemble(f, out)
+        return out.getvalue()
+
+    return load_image(path)
+
+# Read a binary, or the ROM in a schematic from schemgen
+def load_image(path):
+    if path.endswith(".schematic"):
+        return schemgen.read_rom_file(path)
+    with open(path, "rb") as f:
+        return f.read()
+
+def check_job(result, expect):
+    mismatches = []
+    if "regs" in expect:
+        regs = expect["regs"]
+        if isinstance(regs, list):
+            regs = {f"r{i}": val for i, val in enumerate(regs)}
+        for name, val in regs.items():
+            actual = result["regs"][int(name[1:])]
+            if actual != val:
+                mismatches.append(f"{name}: expected {val}, got {actual}")
+    for key in ("output", "frames", "stop", "cycles"):
+        if key in expect and expect[key] != result[key]:
+            mismatches.append(f"{key}: expected {expect[key]!r}, got {result[key]!r}")
+    return mismatches
+
+def run_job(args):
+    index, job, basedir = args
+    result = {
+        "job": index,
+        "program": job.get("program", "<source>"),
+        "seed": job.get("seed", 0),
+    }
+
+    try:
+        cpu = CPU(rng=random.Random(result["seed"]))
+        load_program_image(cpu, load_job_program(job, basedir))
+        chardisp, pixdisp = attach_displays(cpu, "headless")
+        reason = cpu.run(job.get("max_cycles"), detect_loops=job.get("detect_loops", False))
+    except Exception as ex:
+        result["error"] = str(ex)
+        result["mismatches"] = ["error: " + str(ex)]
+        return result
+
+    result["stop"] = reason.kind
+    result["iptr"] = reason.iptr
+    result["cycles"] = reason.cycles
+    result["regs"] = list(cpu.regs)
+    result["output"] = chardisp.text()
+    result["frames"] = len(pixdisp.frames)
+    result["mismatches"] = check_job(result, job.get("expect", {}))
+    return result
+
+def run_batch(jobs, basedir=".", processes=None):
+    work = [(i, job, basedir) for i, job in enumerate(jobs)]
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(run_job, work, chunksize=max(1, len(work) // 256))
+
+def write_report(f, results, fmt):
+    if fmt == "json":
+        json.dump(results, f, indent=1)
+        f.write("\n")
+        return
+
+    w = csv.writer(f)
+    w.writerow(("job", "program", "seed", "stop", "iptr", "cycles", "regs", "output", "frames", "mismatches"))
+    for r in results:
+        w.writerow((
+            r["job"], r["program"], r["seed"], r.get("stop", "error"), r.get("iptr", ""),
+            r.get("cycles", ""), " ".join(str(x) for x in r.get("regs", [])),
+            r.get("output", ""), r.get("frames", ""), "; ".join(r["mismatches"])))
+
+def batch_main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="emulator.py batch")
+    parser.add_argument("manifest", help="JSON manifest of jobs")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of processes (default: all cores)")
+    parser.add_argument("-o", "--report", default=None, help="Report file, .json or .csv")
+    parser.add_argument(
+            "--detect-loops", default=False, action="store_true",
+            help="Stop jobs which get stuck in an infinite loop, unless the job says otherwise")
+    args = parser.parse_args(argv)
+
+    with open(args.manifest, "r") as f:
+        jobs = json.load(f)
+    if args.detect_loops:
+        for job in jobs:
+            job.setdefault("detect_loops", True)
+
+    start = time.monotonic()
+    results = run_batch(jobs, os.path.dirname(args.manifest), args.jobs)
+    elapsed = time.monotonic() - start
+
+    if args.report is not None:
+        fmt = "csv" if args.report.endswith(".csv") else "json"
+        with open(args.report, "w", newline="") as f:
+            write_report(f, results, fmt)
+
+    failed = 0
+    for r in results:
+        if len(r["mismatches"]) > 0:
+            failed += 1
+            print(f"FAIL job {r['job']} ({r['program']}, seed {r['seed']}):")
+            for mismatch in r["mismatches"]:
+                print("   ", mismatch)
+
+    cycles = sum(r.get("cycles", 0) for r in results)
+    print(f"{len(results) - failed}/{len(results)} jobs passed, {cycles} cycles in {elapsed:.2f}s")
+    return 1 if failed > 0 else 0
+
+def disasm_main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="emulator.py disasm")
+    parser.add_argument("infile", help="Binary to disassemble")
+    parser.add_argument(
+            "--entry", type=lambda s: int(s, 0), action="append", default=None,
+            help="Address where execution may start (default: 0, may be given multiple times)")
+    parser.add_argument("--debug-info", default=None, help="Take label names from this debug info file")
+    args = parser.parse_args(argv)
+
+    # Only the RAM image of banked images is disassembled
+    bs = asm.read_banked_image(load_image(args.infile))[0]
+
+    labels = None
+    if args.debug_info is not None:
+        with open(args.debug_info, "r") as f:
+            labels = asm.read_debug_info(f)["labels"]
+
+    sys.stdout.write(disassemble_image(bs, args.entry or (0,), labels))
+    return 0
+
+def frames_main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="emulator.py frames")
+    parser.add_argument("log", help="Frame log from --frames")
+    parser.add_argument("--start", type=int, default=0, help="First frame")
+    parser.add_argument("--count", type=int, default=None, help="Number of frames")
+    parser.add_argument(
+            "--pgm", default=None,
+            help="Write the frames to PGM files named by this pattern (like frame%%05d.pgm) instead of printing them")
+    args = parser.parse_args(argv)
+
+    with open(args.log, "rb") as f:
+        width, height, frames = read_frame_log(f)
+        sink = None
+        if args.pgm is not None:
+            sink = PGMSequence(args.pgm, width, height)
+
+        out = []
+        for index, (cycle, pixels) in enumerate(frames):
+            if index < args.start:
+                continue
+            if args.count is not None and index >= args.start + args.count:
+                break
+            if sink is not None:
+                sink.write_frame(cycle, pixels)
+            else:
+                out.append(f"Frame {index} (cycle {cycle}):\n" + render_frame(pixels, width, height) + "\n")
+        sys.stdout.write("".join(out))
+    return 0
+
 if __name__ == "__main__":
     import argparse
 
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        exit(batch_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "disasm":
+        exit(disasm_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "frames":
+        exit(frames_main(sys.argv[2:]))
+
     parser = argparse.ArgumentParser()
-    parser.add_argument("infile", help="Input file to execute")
-    parser.add_argument("--step", default=False, action="store_true", help="Step through the program")
+    parser.add_argument("infile", help="Binary or .schematic to execute")
+    parser.add_argument(
+            "--step", default=False, action="store_true",
+            help="Start the interactive debugger, with breakpoints, watchpoints and stepping")
+    parser.add_argument(
+            "--engine", default="block", choices=("interp", "predecode", "block"),
+            help="Execution engine: plain interpreter, predecoded dispatch, or translated basic blocks")
+    parser.add_argument(
+            "--display", default="terminal", choices=("terminal", "headless", "realtime"),
+            help="Print device output as it happens, record it and dump it at the end, " +
+                "or print it paced to --clock-rate")
+    parser.add_argument(
+            "--clock-rate", type=float, default=None,
+            help="Target clock rate in instructions per second for --display realtime")
+    parser.add_argument(
+            "--max-cycles", type=int, default=None,
+            help="Stop after executing this many instructions")
+    parser.add_argument(
+            "--break", dest="breakpoints", type=lambda s: int(s, 0), action="append", default=[],
+            help="Stop when reaching this address (may be given multiple times)")
+    parser.add_argument(
+            "--until", type=lambda s: int(s, 0), default=None,
+            help="Run until reaching this address")
+    parser.add_argument(
+            "--detect-loops", default=False, action="store_true",
+            help="Stop when the program gets back into an earlier state, so it can never halt")
+    parser.add_argument(
+            "--profile", default=False, action="store_true",
+            help="Count executed instructions, branches and device accesses, and print a report")
+    parser.add_argument(
+            "--timing", default=False, action="store_true",
+            help="Add up clock cycles with a cost model, and print a report with the estimated time")
+    parser.add_argument(
+            "--cost-model", default=None,
+            help="JSON file with the cycle costs for --timing (default: 1 cycle per instruction)")
+    parser.add_argument(
+            "--clock-hz", type=float, default=None,
+            help="Clock rate of the physical machine for --timing, instead of the cost model's")
+    parser.add_argument(
+            "--trace", default=None,
+            help="Record every instruction to this file (see tracefile.py)")
+    parser.add_argument(
+            "--trace-ring", type=int, default=None,
+            help="Only keep the last this many instructions in the --trace file")
+    parser.add_argument(
+            "--debug-info", default=None,
+            help="Debug info file from the assembler's --debug-info, used to annotate reports")
+    parser.add_argument(
+            "--bank-file", default=None,
+            help="Map this file as extended memory, with the image's banks copied over it")
+    parser.add_argument(
+            "--frames", default=None,
+            help="Write pixel display frames to this frame log, " +
+                "or to PGM files if it's a pattern like frame%%05d.pgm")
     args = parser.parse_args()
+    if args.trace is not None and (args.step or args.profile):
+        parser.error("--trace can't be combined with --step or --profile")
+    if args.timing and (args.step or args.profile or args.trace is not None):
+        parser.error("--timing can't be combined with --step, --profile or --trace")
+    if args.detect_loops and args.step:
+        parser.error("--detect-loops can't be combined with --step")
+    if args.trace_ring is not None and args.trace_ring < 1:
+        parser.error("--trace-ring must be at least 1")
+    if args.frames is not None and args.display == "terminal":
+        parser.error("--frames needs --display headless or realtime")
+
+    debug = None
+    if args.debug_info is not None:
+        with open(args.debug_info, "r") as f:
+            debug = asm.read_debug_info(f)
 
     random.seed()
 
-    cpu = CPU()
-    with open(args.infile, "rb") as f:
-        cpu.load_program(f.read())
+    cpu = CPU(predecode=args.engine != "interp", blocks=args.engine == "block")
+    load_program_image(cpu, load_image(args.infile), args.bank_file)
+
+    if args.display == "realtime" and args.clock_rate is None:
+        parser.error("--display realtime requires --clock-rate")
+    frames = None
+    if args.frames is not None:
+        frames = open_frame_sink(args.frames)
+    chardisp, pixdisp = attach_displays(cpu, args.display, args.clock_rate, frames)
 
-    cpu.add_hardware(254, CharacterDisplay())
-    cpu.add_hardware(253, PixelDisplay())
+    model = None
+    if args.timing:
+        model = CostModel()
+        if args.cost_model is not None:
+            try:
+                model = load_cost_model(args.cost_model)
+            except Exception as ex:
+                parser.error(args.cost_model + ": " + str(ex))
+        if args.clock_hz is not None:
+            if args.clock_hz <= 0:
+                parser.error("--clock-hz must be positive")
+            model.clock_hz = args.clock_hz
 
+    reason = None
+    profiler = None
+    timer = None
     if args.step:
-        while not cpu.halted:
-            print(cpu.ram)
-            print(
-                    f"{cpu.iptr}:",
-                    disassemble(cpu.ram[cpu.iptr], cpu.ram[cpu.iptr + 1]),
-                    cpu.regs,
-                    f"z:{cpu.zflag} c:{cpu.cflag} s:{cpu.sflag} o:{cpu.oflag}")
-            input()
-            cpu.step()
+        debugger = Debugger(cpu, debug)
+        debugger.breakpoints.update(args.breakpoints)
+        reason = debugger.loop()
+    elif args.profile:
+        profiler = Profiler(cpu)
+        reason = profiler.run(args.max_cycles, args.breakpoints, args.until, args.detect_loops)
+    elif model is not None:
+        timer = Timer(cpu, model)
+        reason = timer.run(args.max_cycles, args.breakpoints, args.until, args.detect_loops)
+    elif args.trace is not None:
+        with open(args.trace, "wb") as f:
+            writer = tracefile.TraceWriter(f, cpu, args.trace_ring)
+            reason = Tracer(cpu, writer).run(args.max_cycles, args.breakpoints, args.until, args.detect_loops)
+            writer.close()
     else:
-        while not cpu.halted:
-            cpu.step()
+        reason = cpu.run(args.max_cycles, args.breakpoints, args.until, args.detect_loops)
 
+    if frames is not None:
+        frames.close()
+
+    if args.display == "headless":
+        chardisp.dump()
+        if frames is None:
+            pixdisp.dump()
+
+    if reason is not None:
+        print("Stopped:", reason)
     print("Registers after execution:")
     print(cpu.regs)
+    if profiler is not None:
+        print()
+        profiler.report(debug=debug)
+    if timer is not None:
+        print()
+        timer.report(debug=debug)
+
+    if reason is not None and reason.kind == STOP_ILLEGAL:
+        exit(1)
@@ -19,10 +19,10 @@
 
 def maze 252
 def maze_size 16
-def maze_size_double 32
+def maze_size_double maze_size * 2
 def send_x_and_update 0b01000000
 def done_signal 0b10000000
-def erase 0b11000000
+def erase send_x_and_update | done_signal
 mov r7 maze
 st erase                        # erase maze
 mov r0 maze_size                # r0: new_yd << 1
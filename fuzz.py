@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+# Differential fuzzer. Random images are run on the plain interpreter as
+# the reference and on the other engines, and their states are compared
+# every few cycles. The interpreter's lazy flags are also compared after
+# every instruction against an interpreter which computes the flags right
+# away. Images are also disassembled and reassembled, which must give back
+# the same bytes.
+#
+#   fuzz.py [--count N] [--seed S] [--engines predecode,block] [--sample N]
+#
+# Compiling blocks and reassembling are much slower than running a case,
+# so the block engine and the round trip are only checked on every
+# '--sample'th case. Every case is generated from its seed alone, so a
+# failure can be reproduced with '--seed <seed> --count 1 --sample 1'.
+
+import assembler as asm
+import emulator
+import multiprocessing
+import random
+import sys
+import time
+import zlib
+
+ENGINES = {
+    "interp": dict(predecode=False, blocks=False),
+    "predecode": dict(predecode=True, blocks=False),
+    "block": dict(predecode=True, blocks=True),
+}
+REFERENCE = "interp"
+
+LEGAL_OPS = [op for op in range(0, 32) if emulator.CPU.handlers[op] is not None]
+
+# Cases handed to a worker process at a time
+FUZZ_CHUNK = 100
+
+# The interpreter with all four flags computed right after every
+# instruction, like before flags were made lazy. This is the reference
+# for the lazy flag properties, which every engine shares.
+class EagerCPU(emulator.CPU):
+    def step_interp(self):
+        emulator.CPU.step_interp(self)
+        a, b, out = self.flag_args
+        overflowed = a & 0b10000000 == b & 0b10000000 and a & 0b10000000 != out & 0b10000000
+        self.flag_values = [
+                (out & 0b100000000) >> 8,
+                (out & 0b10000000) >> 7,
+                1 if (out & 0b11111111) == 0 else 0,
+                1 if overflowed else 0]
+        self.flag_args = None
+
+# A device with reads that only depend on how many reads came before and
+# on the cycle count, and which folds every write into a CRC instead of
+# logging it. Using the cycle count catches engines which let devices see
+# a stale one.
+class FuzzDevice:
+    def __init__(self, seed, cpu):
+        self.val = seed & 0xff
+        self.cpu = cpu
+        self.crc = 0
+
+    def read_at(self, offset):
+        self.val = (self.val * 73 + 41 + offset) & 0xff
+        return self.val ^ (self.cpu.cycles & 0xff)
+
+    def write_at(self, offset, val):
+        self.crc = zlib.crc32(bytes((offset, val)), self.crc)
+
+# Instructions are mostly legal, with the occasional illegal opcode or
+# jump condition, and some slots are just random bytes
+def gen_image(rng):
+    img = bytearray()
+    while len(img) < 255:
+        if rng.random() < 0.1:
+            img.append(rng.randrange(0, 256))
+            continue
+        if rng.random() < 0.97:
+            op = rng.choice(LEGAL_OPS)
+        else:
+            op = rng.randrange(0, 32)
+        rc = rng.randrange(0, 8)
+        if op in (asm.INS_JMP, asm.INS_JMPI) and rng.random() < 0.98:
+            rc = rng.randrange(0, 6)
+        img += bytes(((op << 3) | rc, rng.randrange(0, 256)))
+    return bytes(img[:255])
+
+def gen_case(seed):
+    rng = random.Random(seed)
+    img = gen_image(rng)
+    regs = [rng.randrange(0, 256) for i in range(0, 8)]
+    flags = [rng.randrange(0, 2) for i in range(0, 4)]
+    return img, regs, flags
+
+def make_cpu(engine, seed, case, cls=emulator.CPU):
+    img, regs, flags = case
+    cpu = cls(rng=random.Random(seed), **ENGINES[engine])
+    cpu.load_program(img)
+    cpu.regs[:] = regs
+    cpu.cflag, cpu.sflag, cpu.zflag, cpu.oflag = flags
+    devices = [FuzzDevice(seed, cpu), FuzzDevice(seed + 1, cpu)]
+    cpu.add_hardware(254, devices[0])
+    cpu.add_hardware(240, devices[1], 4)
+    return cpu, devices
+
+# A cheap fingerprint of everything the program can affect
+def fingerprint(cpu, devices, reason):
+    return hash((cpu.core_state(), tuple(d.crc for d in devices), reason.kind, reason.message))
+
+# Run one case on the reference and 'engines', comparing every 'interval'
+# cycles. Returns the engines which diverged.
+def run_case(seed, case, engines, cycles, interval):
+    ref = make_cpu(REFERENCE, seed, case)
+    others = {engine: make_cpu(engine, seed, case) for engine in engines}
+
+    failed = []
+    done = 0
+    while done < cycles and others:
+        reason = ref[0].run(interval)
+        expected = fingerprint(ref[0], ref[1], reason)
+        for engine in list(others):
+            cpu, devices = others[engine]
+            if fingerprint(cpu, devices, cpu.run(interval)) != expected:
+                failed.append(engine)
+                del others[engine]
+        if reason.kind != emulator.STOP_BUDGET:
+            break
+        done += interval
+    return failed
+
+# Step two CPUs one instruction at a time, and describe where they
+# first differ, or return None if they never do
+def step_compare(ref, refdevs, cpu, devices, cycles):
+    for cycle in range(0, cycles):
+        iptr = ref.iptr
+        a = ref.run(1)
+        b = cpu.run(1)
+        if fingerprint(ref, refdevs, a) == fingerprint(cpu, devices, b):
+            if a.kind != emulator.STOP_BUDGET:
+                break
+            continue
+
+        diffs = []
+        if ref.regs != cpu.regs:
+            diffs.append(f"regs {ref.regs} != {cpu.regs}")
+        ram = [addr for addr in range(0, 256) if ref.ram[addr] != cpu.ram[addr]]
+        if ram:
+            diffs.append(f"RAM at {ram[:8]}")
+        for name in ("iptr", "halted", "cflag", "sflag", "zflag", "oflag"):
+            if getattr(ref, name) != getattr(cpu, name):
+                diffs.append(f"{name} {getattr(ref, name)} != {getattr(cpu, name)}")
+        if [d.crc for d in refdevs] != [d.crc for d in devices]:
+            diffs.append("device writes")
+        if (a.kind, a.message) != (b.kind, b.message):
+            diffs.append(f"stop {a} != {b}")
+        try:
+            text = emulator.disassemble(ref.ram[iptr], ref.ram[(iptr + 1) % 256])
+        except Exception:
+            text = "???"
+        return f"cycle {cycle + 1}, after {iptr}: {text}: " + ", ".join(diffs)
+    return None
+
+# Find where the reference and an engine first differ
+def locate(seed, case, engine, cycles):
+    ref, refdevs = make_cpu(REFERENCE, seed, case)
+    cpu, devices = make_cpu(engine, seed, case)
+    msg = step_compare(ref, refdevs, cpu, devices, cycles)
+    return msg if msg is not None else "could not reproduce by single-stepping"
+
+def flag_tuple(cpu):
+    return (cpu.iptr, cpu.cflag, cpu.sflag, cpu.zflag, cpu.oflag)
+
+# Compare the reference's lazy flags against eagerly computed ones
+# after every instruction. This steps the CPUs directly, and only goes
+# through step_compare to describe a difference.
+def flags_case(seed, case, cycles):
+    ref = make_cpu(REFERENCE, seed, case, EagerCPU)[0]
+    cpu = make_cpu(REFERENCE, seed, case)[0]
+    for cycle in range(0, cycles):
+        if ref.halted:
+            return None
+        try:
+            ref.step()
+        except emulator.IllegalInstruction:
+            return None
+        try:
+            cpu.step()
+        except emulator.IllegalInstruction:
+            break
+        if flag_tuple(ref) != flag_tuple(cpu):
+            break
+    else:
+        return None
+
+    ref, refdevs = make_cpu(REFERENCE, seed, case, EagerCPU)
+    cpu, devices = make_cpu(REFERENCE, seed, case)
+    return step_compare(ref, refdevs, cpu, devices, cycles)
+
+# Labels like the ones in debug info, with names which may collide with
+# the ones the disassembler generates, and some at or past the end
+def gen_labels(rng, img):
+    targets = sorted(emulator.trace_code(img)[1]) or [0]
+    labels = {}
+    for i in range(0, rng.randrange(0, 16)):
+        name = rng.choice(("l", "lbl")) + str(rng.choice(targets))
+        labels[name] = rng.choice((rng.choice(targets), rng.randrange(0, len(img) + 4), len(img)))
+    return labels
+
+# Disassembling and reassembling an image must give back the same bytes,
+# with or without label names
+def roundtrip_case(seed, img):
+    rng = random.Random(seed)
+    for labels in (None, gen_labels(rng, img)):
+        source = emulator.disassemble_image(img, labels=labels)
+        try:
+            out = asm.assemble_source(source)
+        except asm.AsmError as ex:
+            return str(ex)
+        if out != img:
+            addr = next((i for i in range(0, len(img)) if i >= len(out) or out[i] != img[i]), len(img))
+            return f"reassembled image differs at {addr}"
+    return None
+
+def fuzz_chunk(args):
+    start, count, engines, cycles, interval, roundtrip, flags, sample = args
+    cheap = [engine for engine in engines if engine != "block"]
+    failures = []
+    for seed in range(start, start + count):
+        case = gen_case(seed)
+        sampled = seed % sample == 0
+        for engine in run_case(seed, case, engines if sampled else cheap, cycles, interval):
+            failures.append((seed, engine, locate(seed, case, engine, cycles)))
+        if flags:
+            err = flags_case(seed, case, cycles)
+            if err is not None:
+                failures.append((seed, "flags", err))
+        if roundtrip and sampled:
+            err = roundtrip_case(seed, case[0])
+            if err is not None:
+                failures.append((seed, "roundtrip", err))
+    return count, failures
+
+def fuzz(
+        seed, count, engines, cycles, interval, roundtrip=True, flags=True,
+        sample=1, processes=None, f=sys.stdout):
+    work = []
+    for start in range(seed, seed + count, FUZZ_CHUNK):
+        work.append((
+            start, min(FUZZ_CHUNK, seed + count - start), engines,
+            cycles, interval, roundtrip, flags, sample))
+
+    failures = []
+    done = 0
+    start = time.perf_counter()
+    with multiprocessing.Pool(processes) as pool:
+        for n, fails in pool.imap_unordered(fuzz_chunk, work):
+            done += n
+            for seed, engine, msg in fails:
+                f.write(f"FAIL seed {seed} {engine}: {msg}\n")
+            failures += fails
+
+    elapsed = time.perf_counter() - start
+    f.write(f"{done} cases, {len(failures)} failures in {elapsed:.1f}s ({done / elapsed:.0f} cases/s)\n")
+    return failures
+
+if __name__ == "__main__":
+    import argparse
+
+    def engine_list(s):
+        engines = s.split(",")
+        for engine in engines:
+            if engine not in ENGINES or engine == REFERENCE:
+                raise argparse.ArgumentTypeError(
+                        "engines must be among " + ", ".join(e for e in ENGINES if e != REFERENCE))
+        return engines
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", type=int, default=0, help="First case seed")
+    parser.add_argument("--count", type=int, default=10000, help="Number of cases")
+    parser.add_argument(
+            "--engines", type=engine_list, default=["predecode", "block"],
+            help="Comma separated engines to compare against the interpreter")
+    parser.add_argument("--cycles", type=int, default=1000, help="Cycles to run each case for")
+    parser.add_argument("--interval", type=int, default=64, help="Cycles between state comparisons")
+    parser.add_argument(
+            "--no-roundtrip", dest="roundtrip", action="store_false",
+            help="Skip the disassemble/assemble round trip")
+    parser.add_argument(
+            "--no-flags", dest="flags", action="store_false",
+            help="Skip comparing the lazy flags against eagerly computed ones")
+    parser.add_argument(
+            "--sample", type=int, default=10,
+            help="Check the block engine and the round trip on every Nth case")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of processes (default: all cores)")
+    args = parser.parse_args()
+    if args.sample < 1:
+        parser.error("--sample must be at least 1")
+
+    failures = fuzz(
+            args.seed, args.count, args.engines, args.cycles, args.interval,
+            args.roundtrip, args.flags, args.sample, args.jobs)
+    exit(1 if failures else 0)
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
+import assembler as asm
 import struct
-import sys
 import gzip
 
 NBT_END = 0
@@ -44,22 +44,107 @@ class NBT:
     def start_byte_array(self, length):
         self.write_int(length)
 
+    # Writes the length and contents of a whole byte array at once
+    def write_byte_array(self, bs):
+        self.start_byte_array(len(bs))
+        self.f.write(bs)
+
+NBT_INT_ARRAY = 11
+NBT_LONG_ARRAY = 12
+
+# Reads NBT data from a file, as it's decompressed. Compounds become dicts
+# and lists become lists, but byte arrays stay bytes, so big arrays are
+# never turned into lists of ints.
+class NBTReader:
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, fmt):
+        return struct.unpack(fmt, self.read_bytes(struct.calcsize(fmt)))[0]
+
+    def read_bytes(self, n):
+        if n < 0:
+            raise Exception("Truncated NBT data")
+        bs = self.f.read(n)
+        if len(bs) != n:
+            raise Exception("Truncated NBT data")
+        return bs
+
+    def read_string(self):
+        return str(self.read_bytes(self.read(">H")), "utf-8")
+
+    def read_payload(self, tag):
+        if tag == NBT_BYTE:
+            return self.read(">b")
+        elif tag == NBT_SHORT:
+            return self.read(">h")
+        elif tag == NBT_INT:
+            return self.read(">i")
+        elif tag == NBT_LONG:
+            return self.read(">q")
+        elif tag == NBT_FLOAT:
+            return self.read(">f")
+        elif tag == NBT_DOUBLE:
+            return self.read(">d")
+        elif tag == NBT_BYTE_ARRAY:
+            return self.read_bytes(self.read(">i"))
+        elif tag == NBT_STRING:
+            return self.read_string()
+        elif tag == NBT_LIST:
+            subtag = self.read(">b")
+            return [self.read_payload(subtag) for i in range(0, self.read(">i"))]
+        elif tag == NBT_COMPOUND:
+            out = {}
+            while True:
+                subtag = self.read(">b")
+                if subtag == NBT_END:
+                    return out
+                name = self.read_string()
+                out[name] = self.read_payload(subtag)
+        elif tag == NBT_INT_ARRAY:
+            n = self.read(">i")
+            return list(struct.unpack(f">{n}i", self.read_bytes(n * 4)))
+        elif tag == NBT_LONG_ARRAY:
+            n = self.read(">i")
+            return list(struct.unpack(f">{n}q", self.read_bytes(n * 8)))
+        else:
+            raise Exception("Unknown NBT tag: " + str(tag))
+
+    # Returns (name, value) for the root tag
+    def read_root(self):
+        tag = self.read(">b")
+        name = self.read_string()
+        return name, self.read_payload(tag)
+
 BLOCK_ZERO = (0, 0)
 BLOCK_ONE = (75, 3)
 
-def nbt_range_xyz(width, height, length):
-    for y in range(0, height):
-        for z in range(0, length):
-            for x in range(0, width):
-                yield (x, y, z)
+# The size of the schematic for a ROM
+def rom_size(bs):
+    return (len(bs) * 2, 16, 1)
+
+# Returns the Blocks and Data arrays for a ROM, in NBT's y, z, x order.
+# Each byte is a column at odd x, with bit n at y = n * 2 + 1;
+# everything else is air.
+def rom_arrays(bs):
+    width, height, length = rom_size(bs)
+    bs = bytes(bs)
+    arrays = []
+    for p in (0, 1):
+        table = bytes((BLOCK_ZERO[p], BLOCK_ONE[p])) + bytes(254)
+        arr = bytearray(width * height * length)
+        for bitidx in range(0, height // 2):
+            bits = bytes(((b >> bitidx) & 1) for b in bs)
+            row = (bitidx * 2 + 1) * width * length
+            arr[row + 1:row + width:2] = bits.translate(table)
+        arrays.append(arr)
+    return arrays
 
 def write_rom(f, bs):
     nbt = NBT(f)
     nbt.start_named_tag(NBT_COMPOUND, "Schematic")
 
-    width = len(bs) * 2
-    height = 16
-    length = 1
+    width, height, length = rom_size(bs)
 
     nbt.start_named_tag(NBT_SHORT, "Width")
     nbt.write_short(width)
@@ -70,27 +155,125 @@ def write_rom(f, bs):
     nbt.start_named_tag(NBT_STRING, "Materials")
     nbt.write_string("Alpha")
 
-    for name, p in (("Blocks", 0), ("Data", 1)):
+    for name, arr in zip(("Blocks", "Data"), rom_arrays(bs)):
         nbt.start_named_tag(NBT_BYTE_ARRAY, name)
-        nbt.start_byte_array(width * height * length)
-        for x, y, z in nbt_range_xyz(width, height, length):
-            if x % 2 == 0 or y % 2 == 0:
-                nbt.write_byte(0)
-            else:
-                byteidx = int(x / 2)
-                bitidx = int(y / 2)
-                bit = bs[byteidx] & (1 << bitidx)
-                if bit:
-                    nbt.write_byte(BLOCK_ONE[p])
-                else:
-                    nbt.write_byte(BLOCK_ZERO[p])
+        nbt.write_byte_array(arr)
 
     nbt.write_end()
 
+def write_rom_file(path, bs, compresslevel=9):
+    with gzip.open(path, "wb", compresslevel=compresslevel) as f:
+        write_rom(f, bs)
+
+def read_schematic(f):
+    return NBTReader(f).read_root()[1]
+
+def read_schematic_file(path):
+    with gzip.open(path, "rb") as f:
+        return read_schematic(f)
+
+# Decode the ROM from a schematic laid out like write_rom's output.
+# Anything else, like other blocks or data values, or blocks which aren't
+# air outside the ROM's cells, means it isn't a ROM.
+def schematic_rom(schem):
+    for key in ("Width", "Height", "Length", "Blocks", "Data"):
+        if key not in schem:
+            raise Exception("Not a ROM schematic: no " + key)
+    width, height, length = schem["Width"], schem["Height"], schem["Length"]
+    blocks = schem["Blocks"]
+    data = schem["Data"]
+    if width % 2 != 0 or height != 16 or length != 1:
+        raise Exception(f"Not a ROM schematic: size {width}x{height}x{length}")
+    if len(blocks) != width * height * length:
+        raise Exception("Blocks array has the wrong size")
+    if len(data) != width * height * length:
+        raise Exception("Data array has the wrong size")
+
+    # Every bit row becomes a byte per ROM byte holding 0 or 1, which
+    # is shifted into place on a big integer so all columns are done at once
+    table = bytearray([2] * 256)
+    table[BLOCK_ZERO[0]] = 0
+    table[BLOCK_ONE[0]] = 1
+    table = bytes(table)
+    rom = 0
+    for bitidx in range(0, height // 2):
+        row = (bitidx * 2 + 1) * width * length
+        bits = bytes(blocks[row + 1:row + width:2]).translate(table)
+        if 2 in bits:
+            x = bits.index(2) * 2 + 1
+            raise Exception(f"Unexpected block {blocks[row + x]} at x={x}, y={bitidx * 2 + 1}")
+        rom |= int.from_bytes(bits, "big") << bitidx
+    rom = rom.to_bytes(width // 2, "big")
+
+    # The ROM's blocks are fine, so any difference from a freshly
+    # generated ROM is a data value, or a block outside the ROM's cells
+    for name, arr, expected in zip(("block", "data value"), (blocks, data), rom_arrays(rom)):
+        arr = bytes(arr)
+        if arr != expected:
+            idx = next(i for i in range(0, len(arr)) if arr[i] != expected[i])
+            y, x = divmod(idx, width * length)
+            raise Exception(f"Unexpected {name} {arr[idx]} at x={x}, y={y}")
+    return rom
+
+def read_rom_file(path):
+    return schematic_rom(read_schematic_file(path))
+
+# Write many ROMs in one go. 'roms' is an iterable of (path, bytes) pairs.
+def write_roms(roms, compresslevel=9):
+    for path, bs in roms:
+        write_rom_file(path, bs, compresslevel)
+
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: " + sys.argv[0] + " <infile> <outfile>")
-        exit(1)
-    with open(sys.argv[1], "rb") as inf:
-        with gzip.open(sys.argv[2], "wb") as outf:
-            write_rom(outf, inf.read())
+    import argparse
+    import os
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="+", help="<infile> <outfile>, or input files with --outdir")
+    parser.add_argument(
+            "-d", "--outdir", default=None,
+            help="Write a schematic for each input file to this directory")
+    parser.add_argument(
+            "--check", action="store_true",
+            help="Instead of writing schematics, check that existing ones hold the input ROMs")
+    parser.add_argument(
+            "-l", "--level", type=int, default=9, choices=range(0, 10), metavar="0-9",
+            help="gzip compression level")
+    args = parser.parse_args()
+
+    if args.outdir is None:
+        if len(args.files) != 2:
+            parser.error("expected <infile> <outfile>")
+        pairs = [(args.files[0], args.files[1])]
+    else:
+        pairs = []
+        for path in args.files:
+            name = os.path.splitext(os.path.basename(path))[0] + ".schematic"
+            pairs.append((path, os.path.join(args.outdir, name)))
+
+    # ROMs can only hold the RAM image, so images with banks are rejected
+    def roms():
+        for inpath, outpath in pairs:
+            with open(inpath, "rb") as inf:
+                bs, addr, size, banks = asm.read_banked_image(inf.read())
+            if len(banks) > 0:
+                print(f"{inpath}: Images with banks can't be written to a ROM schematic")
+                exit(1)
+            yield outpath, bs
+
+    if not args.check:
+        write_roms(roms(), args.level)
+        exit(0)
+
+    failed = 0
+    for path, bs in roms():
+        try:
+            ok = read_rom_file(path) == bs
+        except Exception as ex:
+            print(f"{path}: {ex}")
+            ok = None
+        if ok is False:
+            print(f"{path}: ROM doesn't match")
+        if not ok:
+            failed += 1
+    print(f"{len(pairs) - failed}/{len(pairs)} schematics match")
+    exit(1 if failed > 0 else 0)
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+# Binary execution traces, as recorded by 'emulator.py --trace', and a tool
+# to look at them without re-running the program:
+#
+#   tracefile.py show trace.bin [--start N] [--count N] [--regs]
+#   tracefile.py search trace.bin [--iptr ADDR] [--reg rN] [--value V] [--write ADDR]
+#   tracefile.py diff a.bin b.bin
+#
+# A trace is a header followed by one 8 byte record per retired instruction:
+# iptr, the instruction's two bytes, the register written (255 for none)
+# and its new value, the flags (c | s << 1 | z << 2 | o << 3, plus
+# TRACE_WRITE if the instruction stored to memory), and the store's
+# address and value.
+# Streamed traces start with the registers and RAM from when recording
+# started, so registers can be reconstructed. Ring buffer traces only hold
+# the last instructions, so they don't.
+
+import assembler as asm
+import mmap
+import struct
+import sys
+
+TRACE_MAGIC = b"OCTTRACE"
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct("<8sBBBxQ")
+TRACE_HAS_STATE = 1
+
+TRACE_RECORD = struct.Struct("<8B")
+TRACE_WRITE = 0b10000
+TRACE_NO_REG = 255
+
+# Records are buffered and written this many at a time
+TRACE_CHUNK = 65536
+
+# Opcodes which write register C
+DEST_OPS = set(asm.ALU_WRITE_OPS) | {asm.INS_IMM, asm.INS_LD, asm.INS_RAND}
+
+class TraceWriter:
+    # If 'ring' is a record count, only the last 'ring' records are kept
+    # and written by close(). Otherwise records are streamed to 'f'.
+    def __init__(self, f, cpu, ring=None):
+        self.f = f
+        self.count = 0
+        self.start_cycle = cpu.cycles
+        self.ring = None
+        if ring is not None:
+            if ring < 1:
+                raise Exception("Trace ring must hold at least 1 record")
+            self.ring = bytearray(ring * TRACE_RECORD.size)
+            self.ringpos = 0
+            return
+
+        self.buf = bytearray()
+        f.write(TRACE_HEADER.pack(
+                TRACE_MAGIC, TRACE_VERSION, TRACE_HAS_STATE, TRACE_RECORD.size, cpu.cycles))
+        f.write(bytes(cpu.regs))
+        f.write(bytes(cpu.ram))
+
+    def record(self, iptr, hi, lo, reg, val, flags, waddr, wval):
+        rec = TRACE_RECORD.pack(iptr, hi, lo, reg, val, flags, waddr, wval)
+        self.count += 1
+        if self.ring is None:
+            self.buf += rec
+            if len(self.buf) >= TRACE_CHUNK * TRACE_RECORD.size:
+                self.f.write(self.buf)
+                self.buf = bytearray()
+            return
+
+        pos = self.ringpos
+        self.ring[pos:pos + TRACE_RECORD.size] = rec
+        pos += TRACE_RECORD.size
+        self.ringpos = 0 if pos == len(self.ring) else pos
+
+    def close(self):
+        if self.ring is None:
+            self.f.write(self.buf)
+            self.buf = bytearray()
+            return
+
+        kept = min(self.count, len(self.ring) // TRACE_RECORD.size)
+        self.f.write(TRACE_HEADER.pack(
+                TRACE_MAGIC, TRACE_VERSION, 0, TRACE_RECORD.size,
+                self.start_cycle + self.count - kept))
+        if kept * TRACE_RECORD.size == len(self.ring):
+            self.f.write(self.ring[self.ringpos:])
+            self.f.write(self.ring[:self.ringpos])
+        else:
+            self.f.write(self.ring[:self.ringpos])
+
+class Trace:
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            self.map = b""
+        self.buf = memoryview(self.map)
+
+        if len(self.buf) < TRACE_HEADER.size:
+            raise Exception(path + ": Not a trace file")
+        magic, version, flags, size, self.start_cycle = TRACE_HEADER.unpack_from(self.buf)
+        if magic != TRACE_MAGIC or version != TRACE_VERSION or size != TRACE_RECORD.size:
+            raise Exception(path + ": Not a trace file, or an unsupported version")
+
+        pos = TRACE_HEADER.size
+        self.regs = None
+        self.ram = None
+        if flags & TRACE_HAS_STATE:
+            self.regs = list(self.buf[pos:pos + 8])
+            self.ram = bytearray(self.buf[pos + 8:pos + 8 + 256])
+            pos += 8 + 256
+
+        self.records = self.buf[pos:]
+        self.count = len(self.records) // TRACE_RECORD.size
+
+    def close(self):
+        self.records.release()
+        self.buf.release()
+        if not isinstance(self.map, bytes):
+            self.map.close()
+        self.file.close()
+
+    def record(self, index):
+        return TRACE_RECORD.unpack_from(self.records, index * TRACE_RECORD.size)
+
+    # Iterates over (index, record) from 'start'
+    def iter(self, start=0, end=None):
+        size = TRACE_RECORD.size
+        if end is None or end > self.count:
+            end = self.count
+        index = start
+        while index < end:
+            stop = min(end, index + TRACE_CHUNK)
+            for rec in TRACE_RECORD.iter_unpack(self.records[index * size:stop * size]):
+                yield index, rec
+                index += 1
+
+    # Indices of the records at 'iptr'. The iptr column is sliced out of
+    # each chunk and searched with bytes.find, so this is fast on huge traces.
+    def find_iptr(self, iptr, start=0):
+        size = TRACE_RECORD.size
+        needle = bytes((iptr,))
+        index = start
+        while index < self.count:
+            stop = min(self.count, index + TRACE_CHUNK * 16)
+            column = bytes(self.records[index * size:stop * size:size])
+            pos = column.find(needle)
+            while pos >= 0:
+                yield index + pos
+                pos = column.find(needle, pos + 1)
+            index = stop
+
+    # The registers before record 'index', replayed from the initial state
+    def regs_at(self, index):
+        if self.regs is None:
+            return None
+        regs = list(self.regs)
+        for i, rec in self.iter(0, index):
+            if rec[3] != TRACE_NO_REG:
+                regs[rec[3]] = rec[4]
+        return regs
+
+def format_record(trace, index, rec):
+    import emulator
+
+    iptr, hi, lo, reg, val, flags, waddr, wval = rec
+    try:
+        text = emulator.disassemble(hi, lo)
+    except Exception:
+        text = "???"
+    parts = [f"{trace.start_cycle + index + 1:>10}  {iptr:>3}: {text:<16}"]
+    if reg != TRACE_NO_REG:
+        parts.append(f"r{reg}={val}")
+    if flags & TRACE_WRITE:
+        parts.append(f"[{waddr}]={wval}")
+    parts.append(f"c:{flags & 1} s:{(flags >> 1) & 1} z:{(flags >> 2) & 1} o:{(flags >> 3) & 1}")
+    return "  ".join(parts)
+
+def show(trace, start, count, regs, f=sys.stdout):
+    state = trace.regs_at(start) if regs else None
+    for index, rec in trace.iter(start, start + count):
+        line = format_record(trace, index, rec)
+        if state is not None:
+            if rec[3] != TRACE_NO_REG:
+                state[rec[3]] = rec[4]
+            line += f"  {state}"
+        f.write(line + "\n")
+
+def search(trace, iptr=None, reg=None, value=None, write=None, limit=None, f=sys.stdout):
+    def matches(rec):
+        if iptr is not None and rec[0] != iptr:
+            return False
+        if reg is not None and rec[3] != reg:
+            return False
+        if value is not None and rec[4] != value:
+            return False
+        if write is not None and (not rec[5] & TRACE_WRITE or rec[6] != write):
+            return False
+        return True
+
+    if iptr is not None:
+        candidates = ((index, trace.record(index)) for index in trace.find_iptr(iptr))
+    else:
+        candidates = trace.iter()
+
+    found = 0
+    for index, rec in candidates:
+        if matches(rec):
+            f.write(format_record(trace, index, rec) + "\n")
+            found += 1
+            if limit is not None and found >= limit:
+                break
+    return found
+
+# Returns the index of the first record which differs between the traces,
+# or None if they're the same. Whole chunks are compared at once.
+def first_difference(a, b):
+    size = TRACE_RECORD.size
+    offset = a.start_cycle - b.start_cycle
+    astart, bstart = max(0, -offset), max(0, offset)
+    count = min(a.count - astart, b.count - bstart)
+
+    index = 0
+    while index < count:
+        stop = min(count, index + TRACE_CHUNK * 16)
+        achunk = a.records[(astart + index) * size:(astart + stop) * size]
+        bchunk = b.records[(bstart + index) * size:(bstart + stop) * size]
+        if bytes(achunk) != bytes(bchunk):
+            for i in range(index, stop):
+                if a.record(astart + i) != b.record(bstart + i):
+                    return astart + i, bstart + i
+        index = stop
+
+    if a.count - astart != b.count - bstart:
+        return astart + count, bstart + count
+    return None
+
+def diff(a, b, context=3, f=sys.stdout):
+    res = first_difference(a, b)
+    if res is None:
+        f.write("Traces are identical\n")
+        return False
+
+    ai, bi = res
+    f.write(f"Traces differ at cycle {a.start_cycle + ai + 1}\n")
+    for index, rec in a.iter(max(0, ai - context), ai):
+        f.write("  " + format_record(a, index, rec) + "\n")
+    for name, trace, index in (("a", a, ai), ("b", b, bi)):
+        if index < trace.count:
+            f.write(f"{name} " + format_record(trace, index, trace.record(index)) + "\n")
+        else:
+            f.write(f"{name} (trace ends)\n")
+    return True
+
+if __name__ == "__main__":
+    import argparse
+
+    def number(s):
+        return int(s, 0)
+
+    def register(s):
+        if s not in asm.REGISTERS:
+            raise argparse.ArgumentTypeError("expected a register, like r3")
+        return asm.REGISTERS[s][1]
+
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    showparser = sub.add_parser("show", help="Print records")
+    showparser.add_argument("trace", help="Trace file")
+    showparser.add_argument("--start", type=int, default=0, help="First record to print")
+    showparser.add_argument("--count", type=int, default=100, help="Number of records to print")
+    showparser.add_argument(
+            "--regs", action="store_true",
+            help="Reconstruct and print the registers after each instruction")
+
+    searchparser = sub.add_parser("search", help="Print records which match all the given conditions")
+    searchparser.add_argument("trace", help="Trace file")
+    searchparser.add_argument("--iptr", type=number, default=None, help="Instruction address")
+    searchparser.add_argument("--reg", type=register, default=None, help="Register written")
+    searchparser.add_argument("--value", type=number, default=None, help="Value written to the register")
+    searchparser.add_argument("--write", type=number, default=None, help="Address stored to")
+    searchparser.add_argument("--limit", type=int, default=None, help="Stop after this many matches")
+
+    diffparser = sub.add_parser("diff", help="Find where two traces diverge")
+    diffparser.add_argument("a", help="Trace file")
+    diffparser.add_argument("b", help="Trace file")
+    diffparser.add_argument("--context", type=int, default=3, help="Identical records to show first")
+    args = parser.parse_args()
+
+    if args.command == "show":
+        trace = Trace(args.trace)
+        if args.regs and trace.regs is None:
+            print("Registers can't be reconstructed from a ring buffer trace")
+            exit(1)
+        show(trace, args.start, args.count, args.regs)
+    elif args.command == "search":
+        trace = Trace(args.trace)
+        found = search(trace, args.iptr, args.reg, args.value, args.write, args.limit)
+        exit(0 if found > 0 else 1)
+    else:
+        exit(1 if diff(Trace(args.a), Trace(args.b), args.context) else 0)